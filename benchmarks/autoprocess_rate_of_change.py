@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Benchmark the time consistency (rate of change) check.
+
+Compares RateOfChangeCheck.check_timeseries() with the old way, in which rocc was
+always run and the failing records were then found by searching the flags for
+"TEMPORAL". The time series is synthetic, ten-minute, and covers several years;
+it is checked once as is and once with some spikes added. The database is not
+involved.
+
+Run it from the project directory:
+
+    python benchmarks/autoprocess_rate_of_change.py --years 5
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from enhydris import set_django_settings_module  # NOQA
+
+set_django_settings_module()
+django.setup()
+
+import numpy as np  # NOQA
+import pandas as pd  # NOQA
+from htimeseries import HTimeseries  # NOQA
+from rocc import Threshold, rocc  # NOQA
+
+from enhydris.autoprocess.models import RateOfChangeCheck  # NOQA
+
+THRESHOLDS = [Threshold("10min", 5.0), Threshold("1h", 10.0), Threshold("1D", 25.0)]
+
+
+def make_data(years, spikes):
+    index = pd.date_range(
+        "2000-01-01", periods=years * 365 * 144, freq="10min", tz="Etc/GMT-2"
+    )
+    rng = np.random.default_rng(42)
+    values = 15 + 10 * np.sin(np.arange(len(index)) * 2 * np.pi / 144)
+    values += rng.normal(0, 0.3, len(index))
+    values[rng.random(len(index)) < 0.01] = np.nan
+    if spikes:
+        values[rng.choice(len(index), size=spikes, replace=False)] += 30
+    return pd.DataFrame(
+        data={"value": values, "flags": ""}, columns=["value", "flags"], index=index
+    )
+
+
+def check_old(data):
+    ahtimeseries = HTimeseries(data.copy())
+    rocc(timeseries=ahtimeseries, thresholds=THRESHOLDS, symmetric=True)
+    result = ahtimeseries.data
+    result.loc[result["flags"].str.contains("TEMPORAL"), "value"] = np.nan
+    return result
+
+
+def check_new(data):
+    check = RateOfChangeCheck(symmetric=True, remove_failing_values=True)
+    check._thresholds = THRESHOLDS
+    return check.check_timeseries(HTimeseries(data.copy())).data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--spikes", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for spikes in (0, args.spikes):
+        data = make_data(args.years, spikes)
+        pd.testing.assert_frame_equal(check_old(data), check_new(data))
+        print(f"Records: {len(data)}, spikes: {spikes}")
+        for name, func in (("old", check_old), ("new", check_new)):
+            times = timeit.repeat(lambda: func(data), number=1, repeat=args.repeat)
+            print(f"{name:>8}: best {min(times):.3f} s, worst {max(times):.3f} s")
+
+
+if __name__ == "__main__":
+    main()
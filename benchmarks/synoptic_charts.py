@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""Benchmark the rendering of the charts of a synoptic group.
+
+Compares drawing each chart on a new pyplot figure, which is how charts used to be
+rendered, with drawing it on the reused ChartTemplate, in each of the chart formats.
+The group is synthetic: each station has a rain, a temperature, and a wind speed
+time series grouped with wind gust, with the last 24 hours of ten-minute data.
+The database is not involved, and the fingerprints are disabled, so that all charts
+are rendered every time.
+
+Run it from the project directory:
+
+    python benchmarks/synoptic_charts.py --stations 30
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from enhydris import set_django_settings_module  # NOQA
+
+set_django_settings_module()
+django.setup()
+
+from django.test import override_settings  # NOQA
+
+import matplotlib  # NOQA
+import matplotlib.pyplot as plt  # NOQA
+import numpy as np  # NOQA
+import pandas as pd  # NOQA
+
+from enhydris.synoptic.models import SynopticTimeseriesGroup  # NOQA
+from enhydris.synoptic.views import Chart  # NOQA
+
+
+class PyplotChart(Chart):
+    """A chart drawn on a new pyplot figure, like before ChartTemplate."""
+
+    def _draw(self):
+        fig = plt.figure()
+        fig.set_dpi(100)
+        fig.set_size_inches(3.2, 2)
+        fig.subplots_adjust(left=0.10, right=0.99, bottom=0.15, top=0.97)
+        matplotlib.rcParams.update({"font.size": 7})
+        self.template = argparse.Namespace(fig=fig)
+        self.ax = fig.add_subplot(1, 1, 1)
+        self._draw_lines()
+        if len(self.xdata):
+            self._change_plot_limits()
+            self._fill()
+            self._set_x_ticks_and_labels()
+            self._set_gridlines_and_legend()
+
+    def _save_plot(self):
+        super()._save_plot()
+        plt.close(self.template.fig)
+
+
+def make_station(first_id, rng):
+    index = pd.date_range("2024-06-01 00:10", periods=144, freq="10min", tz="Etc/GMT-2")
+    hours = np.arange(len(index)) / 6
+
+    def make(offset, subtitle, values, group_with=None):
+        result = SynopticTimeseriesGroup(
+            id=first_id + offset, subtitle=subtitle, group_with=group_with
+        )
+        result.data = pd.DataFrame(
+            data={"value": values, "flags": ""}, columns=["value", "flags"], index=index
+        )
+        return result
+
+    rain = np.where(rng.random(len(index)) < 0.1, rng.gamma(1, 0.5, len(index)), 0)
+    temperature = 20 + 6 * np.sin((hours - 9) * 2 * np.pi / 24)
+    wind_speed = np.abs(4 + rng.normal(0, 1.5, len(index)))
+    wind_gust = wind_speed + np.abs(rng.normal(3, 1.5, len(index)))
+    wind = make(2, "speed", wind_speed)
+    return [
+        make(0, "rain", rain),
+        make(1, "temperature", temperature + rng.normal(0, 0.2, len(index))),
+        wind,
+        make(3, "gust", wind_gust, group_with=wind),
+    ]
+
+
+def render_group(stations, chart_class):
+    for synoptic_timeseries_groups in stations:
+        for s in synoptic_timeseries_groups:
+            if s.group_with is None:
+                chart_class(s, synoptic_timeseries_groups).render()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stations", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    stations = [make_station(i * 4 + 1, rng) for i in range(args.stations)]
+    print(f"Stations: {args.stations}, charts: {args.stations * 3}")
+    root = tempfile.mkdtemp()
+    try:
+        for name, chart_class, chart_format in (
+            ("pyplot png", PyplotChart, "png"),
+            ("template png", Chart, "png"),
+            ("template svg", Chart, "svg"),
+            ("json", Chart, "json"),
+        ):
+            with override_settings(
+                ENHYDRIS_SYNOPTIC_ROOT=root,
+                ENHYDRIS_SYNOPTIC_CHART_FORMAT=chart_format,
+                CACHES={
+                    "default": {
+                        "BACKEND": "django.core.cache.backends.dummy.DummyCache"
+                    }
+                },
+            ):
+                times = timeit.repeat(
+                    lambda: render_group(stations, chart_class),
+                    number=1,
+                    repeat=args.repeat,
+                )
+            size = os.path.getsize(os.path.join(root, "chart", f"3.{chart_format}"))
+            print(
+                f"{name:>12}: best {min(times):.3f} s, worst {max(times):.3f} s, "
+                f"wind chart {size} bytes"
+            )
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
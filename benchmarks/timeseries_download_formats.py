@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Benchmark the formats in which time series data can be downloaded.
+
+For each format, shows the size of the result and the time it takes to encode
+the data, which is retrieved once with Timeseries.get_data() and is the same
+for all formats.
+
+Run it from the project directory, specifying the id of a (preferably large)
+time series:
+
+    python benchmarks/timeseries_download_formats.py 1234
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from io import StringIO
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from enhydris import set_django_settings_module  # NOQA
+
+set_django_settings_module()
+django.setup()
+
+from htimeseries import HTimeseries  # NOQA
+
+from enhydris.api.views import TimeseriesViewSet  # NOQA
+from enhydris.models import Timeseries  # NOQA
+
+
+def encode_csv(ahtimeseries):
+    f = StringIO()
+    ahtimeseries.write(f, format=HTimeseries.TEXT)
+    return f.getvalue().encode()
+
+
+def encode_parquet(ahtimeseries):
+    return TimeseriesViewSet()._get_columnar_data(ahtimeseries.data, "parquet")
+
+
+def encode_arrow(ahtimeseries):
+    return TimeseriesViewSet()._get_columnar_data(ahtimeseries.data, "arrow")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("timeseries_id", type=int)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    ahtimeseries = Timeseries.objects.get(id=args.timeseries_id).get_data()
+    print(f"Records: {len(ahtimeseries.data)}")
+
+    for name, func in (
+        ("csv", encode_csv),
+        ("parquet", encode_parquet),
+        ("arrow", encode_arrow),
+    ):
+        size = len(func(ahtimeseries))
+        times = timeit.repeat(lambda: func(ahtimeseries), number=1, repeat=args.repeat)
+        print(
+            f"{name:>8}: {size / 1e6:.1f} MB, "
+            f"best {min(times):.3f} s, worst {max(times):.3f} s"
+        )
+
+
+if __name__ == "__main__":
+    main()
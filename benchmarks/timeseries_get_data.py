@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Benchmark retrieval of time series data from the database.
+
+Compares the binary columnar retrieval used by Timeseries.get_data() with the
+old way, in which the database formatted the records as one large CSV string
+which was then parsed by HTimeseries. The cache is not involved.
+
+Run it from the project directory, specifying the id of a (preferably large)
+time series:
+
+    python benchmarks/timeseries_get_data.py 1234
+"""
+
+import argparse
+import datetime as dt
+import os
+import sys
+import timeit
+from io import StringIO
+
+import django
+from django.db import connection
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from enhydris import set_django_settings_module  # NOQA
+
+set_django_settings_module()
+django.setup()
+
+import pandas as pd  # NOQA
+from htimeseries import HTimeseries  # NOQA
+
+from enhydris.models import Timeseries  # NOQA
+
+START_DATE = dt.datetime(1678, 1, 1, 0, 0, tzinfo=dt.timezone.utc)
+END_DATE = dt.datetime(2261, 12, 31, 23, 59, tzinfo=dt.timezone.utc)
+
+
+def retrieve_as_text(timeseries):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT STRING_AGG(
+                TO_CHAR(timestamp AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')
+                    || ','
+                    || CASE WHEN value is NULL THEN DOUBLE PRECISION 'NaN'
+                       ELSE value END
+                    || ','
+                    || flags,
+                E'\n'
+                ORDER BY timestamp
+            ) || E'\n'
+            FROM enhydris_timeseriesrecord
+            WHERE timeseries_id=%s AND timestamp >= %s AND timestamp <= %s
+            """,
+            [timeseries.id, START_DATE, END_DATE],
+        )
+        result_string = StringIO(cursor.fetchone()[0])
+    return HTimeseries(result_string, default_tzinfo=dt.timezone.utc).data
+
+
+def retrieve_as_binary(timeseries):
+    return timeseries._retrieve_data(START_DATE, END_DATE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("timeseries_id", type=int)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    timeseries = Timeseries.objects.get(id=args.timeseries_id)
+    text_result = retrieve_as_text(timeseries)
+    binary_result = retrieve_as_binary(timeseries)
+    pd.testing.assert_frame_equal(text_result, binary_result)
+    print(f"Records: {len(binary_result)}")
+
+    for name, func in (("text", retrieve_as_text), ("binary", retrieve_as_binary)):
+        times = timeit.repeat(lambda: func(timeseries), number=1, repeat=args.repeat)
+        print(f"{name:>8}: best {min(times):.3f} s, worst {max(times):.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 import csv
 from io import BytesIO, StringIO
+from itertools import islice
 from zipfile import ZIP_DEFLATED, ZipFile
 
+from enhydris import models
+
 _station_list_csv_headers = [
     "id",
     "Name",
@@ -77,3 +80,62 @@ def prepare_csv(queryset):
                 zipfile.writestr("timeseries.csv", timeseries_csv.getvalue())
 
         return result.getvalue()
+
+
+def iter_timeseries_data_csv(
+    timeseries_list, start_date, end_date, tzinfo, batch_size=100, chunk_size=10000
+):
+    """Yield the data of many time series as CSV, in chunks.
+
+    Each line contains the time series id, the date (in tzinfo), the value and the
+    flags. The records are read with one query per batch_size time series, using a
+    server-side cursor.
+    """
+    precisions = {t.id: t.timeseries_group.precision for t in timeseries_list}
+    date_filters = {}
+    if start_date:
+        date_filters["timestamp__gte"] = start_date
+    if end_date:
+        date_filters["timestamp__lte"] = end_date
+    ids = iter(sorted(precisions))
+    while True:
+        batch = list(islice(ids, batch_size))
+        if not batch:
+            break
+        rows = (
+            models.TimeseriesRecord.objects.filter(
+                timeseries_id__in=batch, **date_filters
+            )
+            .order_by("timeseries_id", "timestamp")
+            .values_list("timeseries_id", "timestamp", "value", "flags")
+            .iterator(chunk_size=chunk_size)
+        )
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            yield _format_timeseries_data_rows(chunk, precisions, tzinfo)
+
+
+def _format_timeseries_data_rows(rows, precisions, tzinfo):
+    with StringIO() as result:
+        csvwriter = csv.writer(result, lineterminator="\r\n")
+        for timeseries_id, timestamp, value, flags in rows:
+            csvwriter.writerow(
+                [
+                    timeseries_id,
+                    timestamp.astimezone(tzinfo).strftime("%Y-%m-%d %H:%M"),
+                    _format_value(value, precisions[timeseries_id]),
+                    flags,
+                ]
+            )
+        return result.getvalue()
+
+
+def _format_value(value, precision):
+    if value is None:
+        return ""
+    elif precision >= 0:
+        return f"{value:.{precision}f}"
+    else:
+        return f"{round(value, precision):.0f}"
@@ -1,17 +1,17 @@
 import datetime as dt
 import json
-from io import StringIO
+from io import BytesIO, StringIO
 from unittest.mock import patch
 from zoneinfo import ZoneInfo
 
 from django.contrib.auth.models import User
 from django.test.utils import override_settings
-from rest_framework.test import APITestCase
+from django.utils.http import parse_http_date
+from rest_framework.test import APITestCase, APITransactionTestCase
 
 import iso8601
 import numpy as np
 import pandas as pd
-from htimeseries import HTimeseries
 from model_bakery import baker
 
 from enhydris import models
@@ -39,7 +39,7 @@ class Tsdata404TestCase(APITestCase):
         self.assertEqual(response.status_code, 404)
 
 
-@patch("enhydris.models.Timeseries.get_data", return_value=HTimeseries())
+@patch("enhydris.models.Timeseries.iter_formatted_data", return_value=[])
 @override_settings(ENHYDRIS_ENABLE_TIMESERIES_DATA_VIEWERS=False)
 @override_settings(ENHYDRIS_AUTHENTICATION_REQUIRED=False)
 class TsdataGetPermissionsTestCase(APITestCase):
@@ -106,18 +106,18 @@ class GetDataTestCase(APITestCase, TimeseriesDataMixin):
     def test_response_content(self):
         response = self._get_response()
         self.assertEqual(
-            response.content.decode(),
+            response.getvalue().decode(),
             "2017-11-23 17:23,1.00,\r\n2018-11-25 01:00,2.00,\r\n",
         )
 
     def test_request_with_start_date(self):
         response = self._get_response(urlsuffix="?start_date=2017-11-23T17:24")
-        self.assertEqual(response.content.decode(), "2018-11-25 01:00,2.00,\r\n")
+        self.assertEqual(response.getvalue().decode(), "2018-11-25 01:00,2.00,\r\n")
 
     def test_response_content_in_other_timezone(self):
         response = self._get_response(urlsuffix="?timezone=UTC")
         self.assertEqual(
-            response.content.decode(),
+            response.getvalue().decode(),
             "2017-11-23 15:23,1.00,\r\n2018-11-24 23:00,2.00,\r\n",
         )
 
@@ -135,22 +135,17 @@ class GetDataInVariousFormatsTestCase(APITestCase, TimeseriesDataMixin):
     def setUp(self):
         super().setUp()
         self.create_timeseries(publicly_available=True)
-        self.get_data_patch = patch(
-            "enhydris.models.Timeseries.get_data", return_value=self.htimeseries
-        )
         self.base_url = (
             f"/api/stations/{self.station.id}/timeseriesgroups/"
             f"{self.timeseries_group.id}/timeseries/{self.timeseries.id}/data/"
         )
 
     def test_response_content_hts_version_2(self):
-        with self.get_data_patch:
-            response = self.client.get(self.base_url + "?fmt=hts2")
-        self.assertTrue(response.content.decode().startswith("Version=2\r\n"))
+        response = self.client.get(self.base_url + "?fmt=hts2")
+        self.assertTrue(response.getvalue().decode().startswith("Version=2\r\n"))
 
     def test_response_headers_hts_version_2(self):
-        with self.get_data_patch:
-            response = self.client.get(self.base_url + "?fmt=hts2")
+        response = self.client.get(self.base_url + "?fmt=hts2")
         self.assertEqual(
             response["Content-Type"], "text/vnd.openmeteo.timeseries; charset=utf-8"
         )
@@ -160,13 +155,11 @@ class GetDataInVariousFormatsTestCase(APITestCase, TimeseriesDataMixin):
         )
 
     def test_response_content_hts_version_5(self):
-        with self.get_data_patch:
-            response = self.client.get(self.base_url + "?fmt=hts")
-        self.assertTrue(response.content.decode().startswith("Count=2\r\n"))
+        response = self.client.get(self.base_url + "?fmt=hts")
+        self.assertTrue(response.getvalue().decode().startswith("Count=2\r\n"))
 
     def test_response_headers_hts_version_5(self):
-        with self.get_data_patch:
-            response = self.client.get(self.base_url + "?fmt=hts")
+        response = self.client.get(self.base_url + "?fmt=hts")
         self.assertEqual(
             response["Content-Type"], "text/vnd.openmeteo.timeseries; charset=utf-8"
         )
@@ -176,13 +169,11 @@ class GetDataInVariousFormatsTestCase(APITestCase, TimeseriesDataMixin):
         )
 
     def test_response_content_csv(self):
-        with self.get_data_patch:
-            response = self.client.get(self.base_url + "?fmt=csv")
-        self.assertTrue(response.content.decode().startswith("2017-11-23 17:23,"))
+        response = self.client.get(self.base_url + "?fmt=csv")
+        self.assertTrue(response.getvalue().decode().startswith("2017-11-23 17:23,"))
 
     def test_response_headers_csv(self):
-        with self.get_data_patch:
-            response = self.client.get(self.base_url + "?fmt=csv")
+        response = self.client.get(self.base_url + "?fmt=csv")
         self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
         self.assertEqual(
             response["Content-Disposition"],
@@ -190,19 +181,43 @@ class GetDataInVariousFormatsTestCase(APITestCase, TimeseriesDataMixin):
         )
 
     def test_response_content_csv_default(self):
-        with self.get_data_patch:
-            response = self.client.get(self.base_url)
-        self.assertTrue(response.content.decode().startswith("2017-11-23 17:23,"))
+        response = self.client.get(self.base_url)
+        self.assertTrue(response.getvalue().decode().startswith("2017-11-23 17:23,"))
 
     def test_response_headers_csv_default(self):
-        with self.get_data_patch:
-            response = self.client.get(self.base_url)
+        response = self.client.get(self.base_url)
         self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
         self.assertEqual(
             response["Content-Disposition"],
             f'inline; filename="{self.timeseries.id}.csv"',
         )
 
+    def test_response_content_parquet(self):
+        response = self.client.get(self.base_url + "?fmt=parquet")
+        data = pd.read_parquet(BytesIO(response.content))
+        pd.testing.assert_frame_equal(data, self.timeseries.get_data().data)
+
+    def test_response_headers_parquet(self):
+        response = self.client.get(self.base_url + "?fmt=parquet")
+        self.assertEqual(response["Content-Type"], "application/vnd.apache.parquet")
+        self.assertEqual(
+            response["Content-Disposition"],
+            f'inline; filename="{self.timeseries.id}.parquet"',
+        )
+
+    def test_response_content_arrow(self):
+        response = self.client.get(self.base_url + "?fmt=arrow")
+        data = pd.read_feather(BytesIO(response.content)).set_index("date")
+        pd.testing.assert_frame_equal(data, self.timeseries.get_data().data)
+
+    def test_response_headers_arrow(self):
+        response = self.client.get(self.base_url + "?fmt=arrow")
+        self.assertEqual(response["Content-Type"], "application/vnd.apache.arrow.file")
+        self.assertEqual(
+            response["Content-Disposition"],
+            f'inline; filename="{self.timeseries.id}.arrow"',
+        )
+
 
 @override_settings(ENHYDRIS_AUTHENTICATION_REQUIRED=False)
 class TsdataPostTestCase(APITestCase):
@@ -342,6 +357,45 @@ class TsdataPostDuplicateTimestampsTestCase(APITestCase):
         )
 
 
+@override_settings(ENHYDRIS_AUTHENTICATION_REQUIRED=False)
+class TsdataPostExistingTimestampTestCase(APITransactionTestCase):
+    # A failed insert aborts the transaction, so we need APITransactionTestCase (see
+    # enhydris.autoprocess.tests.test_apps for why available_apps is needed).
+    available_apps = ["django.contrib.sites", "enhydris"]
+
+    @patch("enhydris.models.TimeseriesRecord.COPY_CHUNK_SIZE", 1)
+    @patch("enhydris.models.Timeseries._check_new_data_is_newer")
+    def setUp(self, m):
+        # The check that the new records are later than the existing ones is
+        # disabled, as if another request had inserted a record concurrently.
+        user = baker.make(User, username="admin", is_superuser=True)
+        station = baker.make(models.Station)
+        timeseries_group = baker.make(models.TimeseriesGroup, gentity=station)
+        self.timeseries = baker.make(
+            models.Timeseries, timeseries_group=timeseries_group
+        )
+        self.timeseries.append_data(
+            StringIO("2018-11-23 17:23,1,\n"), default_timezone="Etc/GMT-2"
+        )
+        self.client.force_authenticate(user=user)
+        self.response = self.client.post(
+            f"/api/stations/{station.id}/timeseriesgroups/{timeseries_group.id}"
+            f"/timeseries/{self.timeseries.id}/data/",
+            data={
+                "timezone": "Etc/GMT-2",
+                "timeseries_records": (
+                    "2018-11-23 17:00,2.000000,\r\n2018-11-23 17:23,3.000000,\r\n"
+                ),
+            },
+        )
+
+    def test_status_code(self):
+        self.assertEqual(self.response.status_code, 400)
+
+    def test_no_records_were_inserted(self):
+        self.assertEqual(self.timeseries.timeseriesrecord_set.count(), 1)
+
+
 @override_settings(ENHYDRIS_AUTHENTICATION_REQUIRED=False)
 class TsdataStartAndEndDateTestCase(APITestCase):
     def setUp(self):
@@ -543,6 +597,94 @@ class TimeseriesBottomPermissionsTestCase(APITestCase):
         self.assertEqual(self.response.status_code, 200)
 
 
+@override_settings(ENHYDRIS_AUTHENTICATION_REQUIRED=False)
+class TimeseriesConditionalGetTestCase(APITestCase, TimeseriesDataMixin):
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_timeseries(publicly_available=True)
+
+    def _get_response(self, action, **headers):
+        return self.client.get(
+            f"/api/stations/{self.station.id}/timeseriesgroups/"
+            f"{self.timeseries_group.id}/timeseries/{self.timeseries.id}/{action}/",
+            headers=headers,
+        )
+
+    def test_etag(self):
+        response = self._get_response("data")
+        self.assertTrue(response["ETag"].startswith(f'"{self.timeseries.id}-'))
+
+    def test_last_modified(self):
+        response = self._get_response("data")
+        self.assertEqual(
+            parse_http_date(response["Last-Modified"]),
+            int(self.timeseries.last_modified.timestamp()),
+        )
+
+    def test_cache_control(self):
+        response = self._get_response("data")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+
+    @patch("enhydris.models.Timeseries.iter_formatted_data")
+    def test_data_not_modified(self, m):
+        etag = self._get_response("data")["ETag"]
+        m.reset_mock()
+        response = self._get_response("data", if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        m.assert_not_called()
+
+    @patch("enhydris.models.Timeseries.get_chart_stats", return_value=[])
+    def test_chart_not_modified(self, m):
+        etag = self._get_response("chart")["ETag"]
+        m.reset_mock()
+        response = self._get_response("chart", if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        m.assert_not_called()
+
+    @patch("enhydris.models.Timeseries.get_last_record_as_string", return_value="")
+    def test_bottom_not_modified(self, m):
+        etag = self._get_response("bottom")["ETag"]
+        m.reset_mock()
+        response = self._get_response("bottom", if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        m.assert_not_called()
+
+    def test_not_modified_since(self):
+        last_modified = self._get_response("data")["Last-Modified"]
+        response = self._get_response("data", if_modified_since=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_modified_after_etag(self):
+        etag = self._get_response("data")["ETag"]
+        self.timeseries.append_data(
+            StringIO("2019-01-01 00:00,3,\n"), default_timezone="Etc/GMT-2"
+        )
+        response = self._get_response("data", if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_metadata_modified_after_etag(self):
+        etag = self._get_response("data")["ETag"]
+        self.timeseries_group.precision += 1
+        self.timeseries_group.save()
+        response = self._get_response("data", if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_time_zone_modified_after_etag(self):
+        etag = self._get_response("data")["ETag"]
+        self.station.display_timezone = "Etc/GMT-5"
+        self.station.save()
+        response = self._get_response("data", if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_modified_since(self):
+        response = self._get_response(
+            "data", if_modified_since="Sat, 01 Jan 2000 00:00:00 GMT"
+        )
+        self.assertEqual(response.status_code, 200)
+
+
 @override_settings(ENHYDRIS_USERS_CAN_ADD_CONTENT=True)
 @override_settings(ENHYDRIS_AUTHENTICATION_REQUIRED=False)
 class TimeseriesPostTestCase(APITestCase):
@@ -795,40 +937,39 @@ class TimeseriesValidationTestCase(APITestCase):
 
 
 @override_settings(ENHYDRIS_AUTHENTICATION_REQUIRED=False)
-@patch("enhydris.api.views.TimeseriesViewSet._get_stats_for_all_intervals")
-@patch("enhydris.models.Timeseries.get_data")
+@patch("enhydris.models.Timeseries.get_chart_stats", return_value=[])
 class TimeseriesChartDateBoundsTestCase(APITestCase, TimeseriesDataMixin):
     def setUp(self):
-        # "_get_sampled_data_to_plot" is mocked to avoid executing the actual logic of
-        # comparisons in the view, which would compare mocks, raising an exception
         self.create_timeseries(publicly_available=True)
         self.url = (
             f"/api/stations/{self.station.id}/timeseriesgroups"
             f"/{self.timeseries_group.id}/timeseries/{self.timeseries.id}/chart/"
         )
 
-    def test_no_bounds_supplied(self, mock, _):
+    def test_no_bounds_supplied(self, mock):
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, 200)
-        mock.assert_called_once_with(start_date=None, end_date=None)
+        mock.assert_called_once_with(start_date=None, end_date=None, max_intervals=200)
 
-    def test_start_date_filter(self, mock, _):
+    def test_start_date_filter(self, mock):
         response = self.client.get(self.url + "?start_date=2012-03-01T00:00")
         self.assertEqual(response.status_code, 200)
         mock.assert_called_once_with(
             start_date=dt.datetime(2012, 3, 1, 0, 0, tzinfo=ZoneInfo(self.timezone)),
             end_date=None,
+            max_intervals=200,
         )
 
-    def test_end_date_filter(self, mock, _):
+    def test_end_date_filter(self, mock):
         response = self.client.get(self.url + "?end_date=2012-03-01T00:00")
         self.assertEqual(response.status_code, 200)
         mock.assert_called_once_with(
             start_date=None,
             end_date=dt.datetime(2012, 3, 1, 0, 0, tzinfo=ZoneInfo(self.timezone)),
+            max_intervals=200,
         )
 
-    def test_start_and_end_date_filters(self, mock, _):
+    def test_start_and_end_date_filters(self, mock):
         response = self.client.get(
             self.url + "?start_date=2012-03-01T00:00&end_date=2017-03-01T00:00"
         )
@@ -836,6 +977,7 @@ class TimeseriesChartDateBoundsTestCase(APITestCase, TimeseriesDataMixin):
         mock.assert_called_once_with(
             start_date=dt.datetime(2012, 3, 1, 0, 0, tzinfo=ZoneInfo(self.timezone)),
             end_date=dt.datetime(2017, 3, 1, 0, 0, tzinfo=ZoneInfo(self.timezone)),
+            max_intervals=200,
         )
 
 
@@ -869,7 +1011,6 @@ class TimeseriesChartTestMixin:
 
 @override_settings(ENHYDRIS_AUTHENTICATION_REQUIRED=False)
 @patch("enhydris.api.views.TimeseriesViewSet.CHART_MAX_INTERVALS", new=20)
-@patch("enhydris.models.Timeseries.get_data")
 @override_settings(ENHYDRIS_ENABLE_TIMESERIES_DATA_VIEWERS=False)
 class TimeseriesChartTestCase(
     APITestCase, TimeseriesDataMixin, TimeseriesChartTestMixin
@@ -877,32 +1018,33 @@ class TimeseriesChartTestCase(
     def _create_timeseries(self, publicly_available=None):
         # Create the timeseries so that we have 5 entries, one per year
         super().create_timeseries(publicly_available=publicly_available)
-        self.htimeseries.data = pd.DataFrame(
-            index=[dt.datetime(year, 1, 1) for year in range(2010, 2015)],
+        self.data = pd.DataFrame(
+            index=[
+                dt.datetime(year, 1, 1, tzinfo=dt.timezone.utc)
+                for year in range(2010, 2015)
+            ],
             data={"value": [year for year in range(2010, 2015)], "flags": [""] * 5},
             columns=["value", "flags"],
         )
+        self.timeseries.set_data(self.data)
         self.url = (
             f"/api/stations/{self.station.id}/timeseriesgroups"
             f"/{self.timeseries_group.id}/timeseries/{self.timeseries.id}/chart/"
         )
 
-    def test_unauthenticated_user_denied(self, mock):
+    def test_unauthenticated_user_denied(self):
         self._create_timeseries(publicly_available=False)
-        mock.return_value = self.htimeseries
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, 401)
 
-    def test_authenticated_user_allowed(self, mock):
+    def test_authenticated_user_allowed(self):
         self._create_timeseries(publicly_available=False)
         self.client.force_authenticate(user=baker.make(User, is_active=True))
-        mock.return_value = self.htimeseries
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, 200)
 
-    def test_all_values_returned(self, mock):
+    def test_all_values_returned(self):
         self._create_timeseries(publicly_available=True)
-        mock.return_value = self.htimeseries
         response = self.client.get(self.url)
         expected = [
             self._value((2010, 5, 27, 2, 24), min=2010, max=2010, mean=2010),
@@ -913,10 +1055,10 @@ class TimeseriesChartTestCase(
         ]
         self._assertChartResponse(response, expected)
 
-    def test_null_values_are_dropped(self, mock):
+    def test_null_values_are_dropped(self):
         self._create_timeseries(publicly_available=True)
-        self.htimeseries.data.loc["2010-01-01", "value"] = np.nan
-        mock.return_value = self.htimeseries
+        self.data.loc["2010-01-01", "value"] = np.nan
+        self.timeseries.set_data(self.data)
         response = self.client.get(self.url)
         expected = [
             self._value((2011, 5, 18, 0, 0), min=2011, max=2011, mean=2011),
@@ -929,24 +1071,29 @@ class TimeseriesChartTestCase(
 
 @override_settings(ENHYDRIS_AUTHENTICATION_REQUIRED=False)
 @patch("enhydris.api.views.TimeseriesViewSet.CHART_MAX_INTERVALS", new=3)
-@patch("enhydris.models.Timeseries.get_data")
 class TimeseriesChartValuesTestCase(
     APITestCase, TimeseriesDataMixin, TimeseriesChartTestMixin
 ):
     def setUp(self):
         self.create_timeseries(publicly_available=True)
-        self.htimeseries.data = pd.DataFrame(
-            index=[dt.datetime(year, 1, 1) for year in range(2010, 2021)],
-            data={"value": [year for year in range(2010, 2021)], "flags": [""] * 11},
-            columns=["value", "flags"],
-        )
         self.url = (
             f"/api/stations/{self.station.id}/timeseriesgroups"
             f"/{self.timeseries_group.id}/timeseries/{self.timeseries.id}/chart/"
         )
 
-    def test_simple(self, mock):
-        mock.return_value = self.htimeseries
+    def _set_data(self, years):
+        self.timeseries.set_data(
+            pd.DataFrame(
+                index=[
+                    dt.datetime(year, 1, 1, tzinfo=dt.timezone.utc) for year in years
+                ],
+                data={"value": years, "flags": [""] * len(years)},
+                columns=["value", "flags"],
+            )
+        )
+
+    def test_simple(self):
+        self._set_data(list(range(2010, 2021)))
         response = self.client.get(self.url)
         expected = [
             self._value((2011, 9, 1, 16, 0), min=2010, max=2013, mean=2011.5),
@@ -955,7 +1102,22 @@ class TimeseriesChartValuesTestCase(
         ]
         self._assertChartResponse(response, expected)
 
-    def test_null(self, mock):
+    def test_simple_with_cached_data(self):
+        self._set_data(list(range(2010, 2021)))
+        self.timeseries.get_data()
+        with patch(
+            "enhydris.models.timeseries.TimeseriesRollup.get_level", return_value=None
+        ), patch("enhydris.models.Timeseries._get_chart_stats_from_database") as m:
+            response = self.client.get(self.url)
+        m.assert_not_called()
+        expected = [
+            self._value((2011, 9, 1, 16, 0), min=2010, max=2013, mean=2011.5),
+            self._value((2015, 1, 1, 0, 0), min=2014, max=2016, mean=2015),
+            self._value((2018, 5, 2, 8, 0), min=2017, max=2020, mean=2018.5),
+        ]
+        self._assertChartResponse(response, expected)
+
+    def test_null(self):
         """Test that unspecified data points get a value of null.
 
         In this test we use this test time series:
@@ -965,16 +1127,7 @@ class TimeseriesChartValuesTestCase(
             2020-01-01 2020
         In this case, the second interval should get min and max = None.
         """
-        mock.return_value = self.htimeseries
-        self.htimeseries.data = pd.DataFrame(
-            index=[
-                dt.datetime(2010, 1, 1),
-                dt.datetime(2011, 1, 1),
-                dt.datetime(2020, 1, 1),
-            ],
-            data={"value": [2010, 2011, 2020], "flags": ["", "", ""]},
-            columns=["value", "flags"],
-        )
+        self._set_data([2010, 2011, 2020])
         response = self.client.get(self.url)
         expected = [
             self._value((2011, 9, 1, 16, 0), min=2010, max=2011, mean=2010.5),
@@ -983,13 +1136,7 @@ class TimeseriesChartValuesTestCase(
         ]
         self._assertChartResponse(response, expected)
 
-    def test_insufficient_number_of_records(self, mock):
-        mock.return_value = self.htimeseries
-        self.htimeseries.data = pd.DataFrame(
-            index=[dt.datetime(2010, 1, 1)],
-            data={"value": [2010], "flags": [""]},
-            columns=["value", "flags"],
-        )
+    def test_insufficient_number_of_records(self):
+        self._set_data([2010])
         response = self.client.get(self.url)
-        expected = []
-        self._assertChartResponse(response, expected)
+        self.assertEqual(response.json(), [])
@@ -0,0 +1,97 @@
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.test.utils import override_settings
+from rest_framework.test import APITestCase
+
+from model_bakery import baker
+
+from enhydris import models
+from enhydris.tests import TestTimeseriesMixin
+
+
+@override_settings(
+    ENHYDRIS_AUTHENTICATION_REQUIRED=False,
+    ENHYDRIS_ENABLE_TIMESERIES_DATA_VIEWERS=True,
+)
+class TimeseriesDataTestCase(APITestCase, TestTimeseriesMixin):
+    @classmethod
+    def setUpTestData(cls):
+        cls._create_test_timeseries(
+            "2017-11-23 17:23,1,\n2018-11-25 01:00,2,\n", publicly_available=True
+        )
+        cls.timeseries1 = cls.timeseries
+        cls.timeseries2 = baker.make(
+            models.Timeseries,
+            timeseries_group=cls.timeseries_group,
+            type=models.Timeseries.AGGREGATED,
+            time_step="D",
+            publicly_available=False,
+        )
+        cls.timeseries2.set_data(
+            StringIO("2018-11-25 00:00,3.14159,A B\n"), default_timezone="UTC"
+        )
+        cls.user = baker.make(User, is_active=True)
+
+    def _get_response(self, query_string):
+        return self.client.get(f"/api/timeseriesdata/?{query_string}")
+
+    def test_one_timeseries(self):
+        response = self._get_response(f"timeseries={self.timeseries1.id}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.getvalue().decode(),
+            f"{self.timeseries1.id},2017-11-23 15:23,1.0,\r\n"
+            f"{self.timeseries1.id},2018-11-24 23:00,2.0,\r\n",
+        )
+
+    def test_many_timeseries(self):
+        self.station.timeseries_data_viewers.add(self.user)
+        self.client.force_authenticate(user=self.user)
+        response = self._get_response(
+            f"timeseries={self.timeseries2.id},{self.timeseries1.id}"
+            "&start_date=2018-01-01T00:00&timezone=Etc/GMT-2"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.getvalue().decode(),
+            f"{self.timeseries1.id},2018-11-25 01:00,2.0,\r\n"
+            f"{self.timeseries2.id},2018-11-25 02:00,3.1,A B\r\n",
+        )
+
+    def test_content_type(self):
+        response = self._get_response(f"timeseries={self.timeseries1.id}")
+        self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
+
+    def test_anonymous_user_is_denied_if_any_timeseries_is_not_public(self):
+        response = self._get_response(
+            f"timeseries={self.timeseries1.id},{self.timeseries2.id}"
+        )
+        self.assertEqual(response.status_code, 401)
+
+    def test_user_without_permission_is_denied(self):
+        self.client.force_authenticate(user=self.user)
+        response = self._get_response(
+            f"timeseries={self.timeseries1.id},{self.timeseries2.id}"
+        )
+        self.assertEqual(response.status_code, 403)
+
+    def test_nonexistent_timeseries(self):
+        response = self._get_response(
+            f"timeseries={self.timeseries1.id},{self.timeseries2.id + 1000}"
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_invalid_timeseries_parameter(self):
+        response = self._get_response("timeseries=hello")
+        self.assertEqual(response.status_code, 400)
+
+    def test_missing_timeseries_parameter(self):
+        response = self._get_response("")
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_timezone(self):
+        response = self._get_response(
+            f"timeseries={self.timeseries1.id}&timezone=Mars/Olympus"
+        )
+        self.assertEqual(response.status_code, 400)
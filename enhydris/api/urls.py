@@ -40,6 +40,7 @@ router.register(
     "timeseries",
 )
 
+router.register("timeseriesdata", views.TimeseriesDataViewSet, "timeseriesdata")
 router.register("gareas", views.GareaViewSet)
 router.register("organizations", views.OrganizationViewSet)
 router.register("persons", views.PersonViewSet)
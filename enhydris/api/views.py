@@ -1,28 +1,32 @@
 import datetime as dt
+import hashlib
 import mimetypes
 import os
-from io import StringIO
+from io import BytesIO, StringIO
 from wsgiref.util import FileWrapper
-from zoneinfo import ZoneInfo
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from django.db import IntegrityError
 from django.db.models import Prefetch
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet, ViewSet
 
 import iso8601
-import numpy as np
 from htimeseries import HTimeseries
 
 from enhydris import models
+from enhydris.flags import get_text_flags
+from enhydris.rules import filter_timeseries_with_viewable_data
 from enhydris.views_common import StationListViewMixin
 
 from . import permissions, serializers
-from .csv import prepare_csv
+from .csv import iter_timeseries_data_csv, prepare_csv
 
 
 class StationViewSet(StationListViewMixin, ModelViewSet):
@@ -174,7 +178,28 @@ class TimeseriesGroupViewSet(ModelViewSet):
         return super().create(request, *args, **kwargs)
 
 
-class TimeseriesViewSet(ModelViewSet):
+class DateParametersMixin:
+    def _get_date_from_string(self, adate, tz):
+        date = self._parse_date(adate, tz)
+        if not date:
+            return None
+        return self._bring_date_within_system_limits(date)
+
+    def _parse_date(self, adate, tz):
+        try:
+            return iso8601.parse_date(adate, default_timezone=tz)
+        except iso8601.ParseError:
+            return None
+
+    def _bring_date_within_system_limits(self, date):
+        if date.isoformat() < "1680-01-01T00:00":
+            date = dt.datetime(1680, 1, 1, 0, 0, tzinfo=date.tzinfo)
+        if date.isoformat() > "2260-01-01T00:00":
+            date = dt.datetime(2260, 1, 1, 0, 0, tzinfo=date.tzinfo)
+        return date
+
+
+class TimeseriesViewSet(DateParametersMixin, ModelViewSet):
     CHART_MAX_INTERVALS = 200
     queryset = models.Timeseries.objects.all()
     serializer_class = serializers.TimeseriesSerializer
@@ -244,15 +269,25 @@ class TimeseriesViewSet(ModelViewSet):
     def bottom(self, request, pk=None, *, station_id, timeseries_group_id=None):
         ts = get_object_or_404(models.Timeseries, pk=int(pk))
         self.check_object_permissions(request, ts)
+        return self._get_conditional_response(
+            request, ts, lambda: self._get_bottom(request, ts)
+        )
+
+    def _get_bottom(self, request, timeseries):
         response = HttpResponse(content_type="text/plain")
         timezone_param = request.GET.get("timezone", None)
-        response.write(ts.get_last_record_as_string(timezone=timezone_param))
+        response.write(timeseries.get_last_record_as_string(timezone=timezone_param))
         return response
 
     @action(detail=True, methods=["get"])
     def chart(self, request, pk=None, *, station_id, timeseries_group_id=None):
         timeseries = get_object_or_404(models.Timeseries, pk=int(pk))
         self.check_object_permissions(request, timeseries)
+        return self._get_conditional_response(
+            request, timeseries, lambda: self._get_chart(request, timeseries)
+        )
+
+    def _get_chart(self, request, timeseries):
         serializer = serializers.TimeseriesRecordChartSerializer(
             self._get_chart_data(request, timeseries), many=True
         )
@@ -260,42 +295,11 @@ class TimeseriesViewSet(ModelViewSet):
 
     def _get_chart_data(self, request, timeseries):
         start_date, end_date = self._get_date_bounds(request, timeseries)
-        df = self._drop_nan_rows(timeseries, start_date, end_date)
-        return self._get_stats_for_all_intervals(df)
-
-    def _drop_nan_rows(self, timeseries, start_date, end_date):
-        return timeseries.get_data(
-            start_date=start_date, end_date=end_date
-        ).data.dropna(subset=["value"])
-
-    def _get_stats_for_all_intervals(self, df):
-        number_of_samples = min(self.CHART_MAX_INTERVALS, len(df.index))
-        if number_of_samples < 2:
-            return []
-        min_time = df.index.min()
-        max_time = df.index.max()
-        interval = (max_time - min_time) / number_of_samples
-        result = []
-        start_time = min_time
-        while start_time < max_time:
-            end_time = start_time + interval
-            result.append(self._get_stats_for_interval(df, start_time, end_time))
-            start_time = end_time
-        return result
-
-    def _get_stats_for_interval(self, df, start_time, end_time):
-        df_part = df[start_time:end_time]
-        min_value = df_part["value"].min()
-        max_value = df_part["value"].max()
-        mean_value = df_part["value"].mean()
-        if np.isnan(min_value):
-            min_value = max_value = mean_value = None
-        return {
-            "timestamp": (start_time + (end_time - start_time) / 2).timestamp(),
-            "min": min_value,
-            "max": max_value,
-            "mean": mean_value,
-        }
+        return timeseries.get_chart_stats(
+            start_date=start_date,
+            end_date=end_date,
+            max_intervals=self.CHART_MAX_INTERVALS,
+        )
 
     def _get_date_bounds(self, request, timeseries):
         tz = ZoneInfo(timeseries.timeseries_group.gentity.display_timezone)
@@ -305,9 +309,58 @@ class TimeseriesViewSet(ModelViewSet):
         end_date = self._get_date_from_string(end_date, tz)
         return start_date, end_date
 
+    def _get_conditional_response(self, request, timeseries, get_response):
+        """Return 304 if the client has the current version, else get_response().
+
+        The ETag and Last-Modified headers are derived from the time series'
+        last_modified, so answering a conditional request does not touch the
+        records. The ETag also depends on the metadata included in the
+        representations, such as the precision and the time zone, which can change
+        while the records don't. Representations of a time series differ in their
+        URL (i.e. query string), so they can share the same ETag.
+        """
+        if timeseries.last_modified is None:
+            return get_response()
+        last_modified = timeseries.last_modified.timestamp()
+        etag = quote_etag(
+            f"{timeseries.id}-{round(last_modified * 1e6)}-"
+            f"{self._get_metadata_hash(timeseries)}"
+        )
+        response = get_conditional_response(
+            request, etag=etag, last_modified=int(last_modified)
+        )
+        if response is None:
+            response = get_response()
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        patch_cache_control(response, no_cache=True)
+        return response
+
+    def _get_metadata_hash(self, timeseries):
+        group = timeseries.timeseries_group
+        gentity = group.gentity
+        location = gentity.geom and (gentity.geom.wkt, gentity.gpoint.altitude)
+        metadata = (
+            timeseries.time_step,
+            group.get_name(),
+            group.precision,
+            group.remarks,
+            group.unit_of_measurement.symbol,
+            group.variable.descr,
+            gentity.name,
+            gentity.display_timezone,
+            location,
+        )
+        return hashlib.md5(repr(metadata).encode()).hexdigest()[:8]
+
     def _get_data(self, request, pk, format=None):
         timeseries = self.get_object()
         self.check_object_permissions(request, timeseries)
+        return self._get_conditional_response(
+            request, timeseries, lambda: self._get_data_response(request, timeseries)
+        )
+
+    def _get_data_response(self, request, timeseries):
         start_date, end_date = self._get_date_bounds(request, timeseries)
         fmt_param = request.GET.get("fmt", "csv").lower()
         timezone_param = request.GET.get("timezone", None)
@@ -316,28 +369,60 @@ class TimeseriesViewSet(ModelViewSet):
             fmt = HTimeseries.FILE
             version = 5
             extension = "hts"
-            content_type = "text/vnd.openmeteo.timeseries"
+            content_type = "text/vnd.openmeteo.timeseries; charset=utf-8"
         elif fmt_param == "hts2":
             fmt = HTimeseries.FILE
             version = 2
             extension = "hts"
-            content_type = "text/vnd.openmeteo.timeseries"
+            content_type = "text/vnd.openmeteo.timeseries; charset=utf-8"
+        elif fmt_param == "parquet":
+            fmt = version = "irrelevant"
+            extension = "parquet"
+            content_type = "application/vnd.apache.parquet"
+        elif fmt_param == "arrow":
+            fmt = version = "irrelevant"
+            extension = "arrow"
+            content_type = "application/vnd.apache.arrow.file"
         else:
             fmt = HTimeseries.TEXT
             version = "irrelevant"
             extension = "csv"
-            content_type = "text/csv"
-        response = HttpResponse(content_type=content_type + "; charset=utf-8")
-        response["Content-Disposition"] = 'inline; filename="{}.{}"'.format(
-            pk, extension
-        )
-        if request.method == "GET":
+            content_type = "text/csv; charset=utf-8"
+        if request.method != "GET":
+            response = HttpResponse(content_type=content_type)
+        elif extension in ("parquet", "arrow"):
             ahtimeseries = timeseries.get_data(
                 start_date=start_date, end_date=end_date, timezone=timezone_param
             )
-            ahtimeseries.write(response, format=fmt, version=version)
+            response = HttpResponse(
+                self._get_columnar_data(ahtimeseries.data, extension),
+                content_type=content_type,
+            )
+        else:
+            response = StreamingHttpResponse(
+                timeseries.iter_formatted_data(
+                    start_date=start_date,
+                    end_date=end_date,
+                    timezone=timezone_param,
+                    format=fmt,
+                    version=version,
+                ),
+                content_type=content_type,
+            )
+        response["Content-Disposition"] = 'inline; filename="{}.{}"'.format(
+            timeseries.id, extension
+        )
         return response
 
+    def _get_columnar_data(self, data, extension):
+        data = data.assign(flags=get_text_flags(data))
+        result = BytesIO()
+        if extension == "parquet":
+            data.to_parquet(result, compression="zstd")
+        else:
+            data.reset_index().to_feather(result, compression="zstd")
+        return result.getvalue()
+
     def _post_data(self, request, pk, format=None):
         try:
             atimeseries = self.get_object()
@@ -354,21 +439,52 @@ class TimeseriesViewSet(ModelViewSet):
                 content_type="text/plain",
             )
 
-    def _get_date_from_string(self, adate, tz):
-        date = self._parse_date(adate, tz)
-        if not date:
-            return None
-        return self._bring_date_within_system_limits(date)
 
-    def _parse_date(self, adate, tz):
+class TimeseriesDataViewSet(DateParametersMixin, ViewSet):
+    """Data of many time series in one response.
+
+    The "timeseries" parameter is a comma-separated list of time series ids. The
+    result is CSV with one line per record, containing the time series id, the date,
+    the value and the flags. Dates are in UTC unless the "timezone" parameter is
+    specified.
+    """
+
+    permission_classes = [permissions.SatisfiesAuthenticationRequiredSetting]
+
+    def list(self, request):
         try:
-            return iso8601.parse_date(adate, default_timezone=tz)
-        except iso8601.ParseError:
-            return None
+            timeseries_ids = self._get_timeseries_ids(request)
+            tzinfo = ZoneInfo(request.GET.get("timezone", "UTC"))
+        except (ValueError, ZoneInfoNotFoundError) as e:
+            return HttpResponse(
+                status=status.HTTP_400_BAD_REQUEST,
+                content=str(e),
+                content_type="text/plain",
+            )
+        timeseries_list = self._get_timeseries_list(request, timeseries_ids)
+        start_date = self._get_date_from_string(request.GET.get("start_date"), tzinfo)
+        end_date = self._get_date_from_string(request.GET.get("end_date"), tzinfo)
+        response = StreamingHttpResponse(
+            iter_timeseries_data_csv(timeseries_list, start_date, end_date, tzinfo),
+            content_type="text/csv; charset=utf-8",
+        )
+        response["Content-Disposition"] = 'inline; filename="timeseries.csv"'
+        return response
 
-    def _bring_date_within_system_limits(self, date):
-        if date.isoformat() < "1680-01-01T00:00":
-            date = dt.datetime(1680, 1, 1, 0, 0, tzinfo=date.tzinfo)
-        if date.isoformat() > "2260-01-01T00:00":
-            date = dt.datetime(2260, 1, 1, 0, 0, tzinfo=date.tzinfo)
-        return date
+    def _get_timeseries_ids(self, request):
+        timeseries_param = request.GET.get("timeseries", "")
+        try:
+            return {int(x) for x in timeseries_param.split(",")}
+        except ValueError:
+            raise ValueError(f"Invalid timeseries parameter: {timeseries_param}")
+
+    def _get_timeseries_list(self, request, timeseries_ids):
+        queryset = models.Timeseries.objects.filter(
+            id__in=timeseries_ids
+        ).select_related("timeseries_group")
+        if queryset.count() != len(timeseries_ids):
+            raise Http404
+        result = list(filter_timeseries_with_viewable_data(request.user, queryset))
+        if len(result) != len(timeseries_ids):
+            self.permission_denied(request)
+        return result
@@ -1,6 +1,7 @@
 from io import StringIO
 
 from django import forms
+from django.contrib import admin, messages
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
@@ -15,6 +16,7 @@ from enhydris.models import TimeseriesGroup, check_time_step
 
 from .models import (
     Aggregation,
+    AutoProcess,
     Checks,
     CurveInterpolation,
     CurvePeriod,
@@ -22,6 +24,7 @@ from .models import (
     RateOfChangeCheck,
     RateOfChangeThreshold,
 )
+from .profiling import dry_run
 
 # We override StationAdmin's render_change_form method in order to specify a custom
 # template. We do this in order to offer some model-wide help (help_text is only
@@ -383,3 +386,34 @@ class AggregationInline(InlinePermissionsMixin, nested_admin.NestedStackedInline
 
 
 TimeseriesGroupInline.inlines.append(AggregationInline)
+
+
+@admin.action(description=_("Profile auto-process (dry run)"), permissions=["change"])
+def profile_auto_process(modeladmin, request, queryset):
+    """Execute the auto-process of a station without appending to its target.
+
+    The time, rows and memory of each stage are shown as a message. As this runs
+    in the request, the selected stations must have exactly one auto-process; to
+    profile more, use the profile_autoprocess management command.
+    """
+    auto_processes = list(
+        AutoProcess.objects.filter(
+            timeseries_group__gentity_id__in=queryset.values_list("id", flat=True)
+        )[:2]
+    )
+    if len(auto_processes) != 1:
+        modeladmin.message_user(
+            request,
+            _(
+                "The selected stations must have exactly one auto-process. To "
+                "profile more, use the profile_autoprocess management command."
+            ),
+            messages.ERROR,
+        )
+        return
+    auto_process = auto_processes[0].as_specific_instance
+    profile = dry_run(auto_process)
+    modeladmin.message_user(request, f"{auto_process}: {profile.format_line()}")
+
+
+StationAdmin.actions = [*StationAdmin.actions, profile_auto_process]
@@ -1,18 +1,40 @@
 from django.apps import AppConfig
+from django.core.cache import cache
 from django.db import transaction
-from django.db.models.signals import post_save
-
-from .tasks import execute_auto_process
+from django.db.models.signals import post_delete, post_save
 
 
 def enqueue_auto_process(sender, *, instance, **kwargs):
-    auto_processes = [
-        auto_process
-        for auto_process in instance.timeseries_group.autoprocess_set.all()
-        if auto_process.as_specific_instance.source_timeseries == instance
-    ]
-    for auto_process in auto_processes:
-        transaction.on_commit(lambda: execute_auto_process.delay(auto_process.id))
+    from .scheduler import AutoProcessGraph, schedule_auto_process
+
+    graph = AutoProcessGraph.get()
+    for auto_process_id in graph.get_triggered_auto_processes(instance):
+        schedule_auto_process(auto_process_id)
+
+
+def invalidate_auto_process_graph(sender, **kwargs):
+    from .scheduler import AutoProcessGraph
+
+    AutoProcessGraph.invalidate()
+
+
+def invalidate_auto_process_graph_if_checked(sender, *, instance, **kwargs):
+    # Whether a group has a checked time series affects the sources of the graph
+    # (see AutoProcess.get_checked_timeseries_group_ids()), but saving an existing
+    # one doesn't.
+    if instance.type == instance.CHECKED and kwargs.get("created", True):
+        invalidate_auto_process_graph(sender)
+
+
+def invalidate_curves(sender, *, instance, **kwargs):
+    from .models import CurveInterpolation, CurvePoint
+
+    if isinstance(instance, CurvePoint):
+        instance = instance.curve_period
+    key = CurveInterpolation.get_curves_cache_key(instance.curve_interpolation_id)
+    # Other processes may cache the old curves until the transaction commits
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
 
 
 class AutoprocessConfig(AppConfig):
@@ -20,3 +42,13 @@ class AutoprocessConfig(AppConfig):
 
     def ready(self):
         post_save.connect(enqueue_auto_process, sender="enhydris.Timeseries")
+        for signal in (post_save, post_delete):
+            signal.connect(
+                invalidate_auto_process_graph_if_checked, sender="enhydris.Timeseries"
+            )
+        post_delete.connect(
+            invalidate_auto_process_graph, sender="autoprocess.AutoProcess"
+        )
+        for model in ("autoprocess.CurvePeriod", "autoprocess.CurvePoint"):
+            post_save.connect(invalidate_curves, sender=model)
+            post_delete.connect(invalidate_curves, sender=model)
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from enhydris.autoprocess.models import AutoProcess
+from enhydris.autoprocess.profiling import dry_run
+
+
+class Command(BaseCommand):
+    help = (
+        "Execute auto-processes without appending to their target and report the "
+        "time, rows and memory of each stage."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("auto_process_ids", nargs="+", type=int)
+        parser.add_argument(
+            "--no-memory",
+            action="store_true",
+            help="Don't trace memory allocations, which slows execution down.",
+        )
+
+    def handle(self, *args, **options):
+        for auto_process_id in options["auto_process_ids"]:
+            try:
+                auto_process = AutoProcess.objects.get(id=auto_process_id)
+            except AutoProcess.DoesNotExist:
+                raise CommandError(f"AutoProcess with id={auto_process_id} not found")
+            auto_process = auto_process.as_specific_instance
+            profile = dry_run(auto_process, trace_memory=not options["no_memory"])
+            self.stdout.write(f"{auto_process} (id={auto_process_id})")
+            self.stdout.write(profile.format_table())
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("autoprocess", "0107_rateofchangecheck_remove_failing_values"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="aggregation",
+            name="state",
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
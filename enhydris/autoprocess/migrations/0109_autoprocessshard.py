@@ -0,0 +1,39 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("autoprocess", "0108_aggregation_state"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AutoProcessShard",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("index", models.PositiveIntegerField()),
+                ("result", models.BinaryField()),
+                (
+                    "auto_process",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="autoprocess.autoprocess",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "enhydris_autoprocess_shard",
+                "unique_together": {("auto_process", "index")},
+            },
+        ),
+    ]
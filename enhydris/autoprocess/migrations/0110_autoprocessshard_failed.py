@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("autoprocess", "0109_autoprocessshard"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="autoprocessshard",
+            name="result",
+            field=models.BinaryField(null=True),
+        ),
+    ]
@@ -2,8 +2,10 @@ import csv
 import datetime as dt
 import logging
 import re
+from copy import copy
 from io import StringIO
 
+from django.core.cache import cache
 from django.db import DataError, IntegrityError, models, transaction
 from django.db.models.signals import post_delete
 from django.utils.translation import gettext_lazy as _
@@ -13,24 +15,39 @@ import pandas as pd
 from haggregate import RegularizationMode as RM
 from haggregate import RegularizeError, aggregate, regularize
 from htimeseries import HTimeseries
+from pandas.tseries.frequencies import to_offset
 from rocc import Threshold, rocc
 
-from enhydris.models import Timeseries, TimeseriesGroup, check_time_step
+from enhydris.flags import add_flag, compact_flags, concat_data
+from enhydris.models import (
+    Timeseries,
+    TimeseriesGroup,
+    TimeseriesRecord,
+    check_time_step,
+)
 
-from . import tasks
+from .profiling import stage
+from .scheduler import AutoProcessGraph, schedule_auto_process
 
 
 class AutoProcess(models.Model):
     timeseries_group = models.ForeignKey(TimeseriesGroup, on_delete=models.CASCADE)
+    SHARD_SIZE = dt.timedelta(days=365)
+    can_be_sharded = False
 
     class Meta:
         db_table = "enhydris_autoprocess_autoprocess"
         verbose_name_plural = _("Auto processes")
 
-    def execute(self):
+    def execute(self, dry_run=False):
+        """Process the new part of the source and append it to the target.
+
+        Return the number of records appended. If dry_run is True, the result is not
+        appended (see profiling.dry_run()).
+        """
         try:
             result = self.process_timeseries()
-            self.target_timeseries.append_data(result)
+            return self._append_to_target(result, dry_run)
         except Exception as e:
             msg = (
                 f"{e.__class__.__name__} while executing AutoProcess with "
@@ -38,12 +55,62 @@ class AutoProcess(models.Model):
             )
             raise RuntimeError(msg)
 
+    def _append_to_target(self, data, dry_run):
+        if dry_run:
+            return 0
+        with stage("append", rows_in=data) as s:
+            s.rows_out = self.target_timeseries.append_data(data)
+        return s.rows_out
+
+    def get_shards(self):
+        """Return the (start_date, end_date) parts in which to process the source.
+
+        If the auto-process can be sharded, and the part of the source that hasn't
+        been processed yet is longer than SHARD_SIZE, it is split into parts of
+        SHARD_SIZE that can be processed in parallel with process_shard(). Otherwise
+        there is a single part, (None, None), and execute() determines the start date
+        itself; _get_start_date() is not called here, because for some auto-processes
+        (e.g. Aggregation) it modifies the target.
+        """
+        if not self.can_be_sharded:
+            return [(None, None)]
+        return list(self._get_windows(self.source_timeseries, self.SHARD_SIZE))
+
+    def process_shard(self, start_date, end_date):
+        """Process the part of the source between start_date and end_date.
+
+        Unlike execute(), this does not append the result to the target but returns
+        it, so that the caller can append the shards in order when all are ready.
+        """
+        with stage("fetch source") as s:
+            self._htimeseries = s.set_output(
+                self.source_timeseries.get_data(
+                    start_date=start_date, end_date=end_date
+                )
+            )
+        return self.process_timeseries()
+
+    def _get_windows(self, source_timeseries, window_size):
+        """Yield (start_date, end_date) of the windows to process.
+
+        The last window has no end_date, so that it also includes any records that
+        are added to the source time series while we are processing.
+        """
+        start_date = self._get_start_date() or source_timeseries.start_date
+        last_date = source_timeseries.end_date
+        while start_date and last_date and start_date + window_size <= last_date:
+            next_start_date = start_date + window_size
+            yield start_date, next_start_date - dt.timedelta(minutes=1)
+            start_date = next_start_date
+        yield start_date, None
+
     @property
     def htimeseries(self):
         if not hasattr(self, "_htimeseries"):
-            self._htimeseries = self.source_timeseries.get_data(
-                start_date=self._get_start_date()
-            )
+            with stage("fetch source") as s:
+                self._htimeseries = s.set_output(
+                    self.source_timeseries.get_data(start_date=self._get_start_date())
+                )
         return self._htimeseries
 
     @property
@@ -74,7 +141,8 @@ class AutoProcess(models.Model):
 
     def save(self, *args, **kwargs):
         result = super().save(*args, **kwargs)
-        transaction.on_commit(lambda: tasks.execute_auto_process.delay(self.id))
+        AutoProcessGraph.invalidate()
+        schedule_auto_process(self.id)
         return result
 
     @property
@@ -85,6 +153,59 @@ class AutoProcess(models.Model):
     def target_timeseries(self):
         raise NotImplementedError("This property is available only in subclasses")
 
+    @staticmethod
+    def get_checked_timeseries_group_ids(**filters):
+        """Return the ids of the time series groups whose data are checked.
+
+        These are the groups that have checks or a checked time series. Curve
+        interpolations and aggregations process the checked time series of these
+        groups and the initial time series of the rest. AutoProcessGraph uses this
+        too, so that it finds the same sources without touching the time series.
+        """
+        return set(
+            Checks.objects.filter(**filters).values_list(
+                "timeseries_group_id", flat=True
+            )
+        ) | set(
+            Timeseries.objects.filter(type=Timeseries.CHECKED, **filters).values_list(
+                "timeseries_group_id", flat=True
+            )
+        )
+
+    def _get_checked_or_initial_timeseries(self):
+        group_id = self.timeseries_group_id
+        if group_id not in self.get_checked_timeseries_group_ids(
+            timeseries_group_id=group_id
+        ):
+            obj, created = self.timeseries_group.timeseries_set.get_or_create(
+                type=Timeseries.INITIAL
+            )
+            return obj
+        try:
+            return self.timeseries_group.timeseries_set.get(type=Timeseries.CHECKED)
+        except Timeseries.DoesNotExist:
+            # The checks haven't run yet
+            checks = Checks.objects.filter(timeseries_group_id=group_id).first()
+            return checks.target_timeseries
+
+
+class AutoProcessShard(models.Model):
+    """The result of a shard that has been processed but not yet appended.
+
+    See scheduler.execute_scheduled_auto_process_shard(). The result is pickled, or
+    None if the shard has failed; it is stored in the database rather than in the
+    cache because it may be larger than the cache allows, and it must be available
+    to whichever worker appends it.
+    """
+
+    auto_process = models.ForeignKey(AutoProcess, on_delete=models.CASCADE)
+    index = models.PositiveIntegerField()
+    result = models.BinaryField(null=True)
+
+    class Meta:
+        db_table = "enhydris_autoprocess_shard"
+        unique_together = ["auto_process", "index"]
+
 
 class SelectRelatedManager(models.Manager):
     """A manager that calls select_related().
@@ -99,8 +220,19 @@ class SelectRelatedManager(models.Manager):
 
 
 class Checks(AutoProcess):
+    """Quality control checks.
+
+    The source time series is processed in windows of at most WINDOW_SIZE, so that
+    back-filling a long time series does not need to load it all in memory. Before
+    each window we put the already checked records that the checks need to look at
+    (see "look_back" and "_get_look_back_data()"); these are used by the checks but
+    are not part of the result. The result is therefore the same as if the entire
+    time series had been checked at once.
+    """
+
     objects = SelectRelatedManager()
     check_types = []
+    WINDOW_SIZE = dt.timedelta(days=365)
 
     class Meta:
         db_table = "enhydris_autoprocess_checks"
@@ -123,15 +255,97 @@ class Checks(AutoProcess):
         )
         return obj
 
+    @property
+    def can_be_sharded(self):
+        # Shards are processed independently, so they can't look back at the result
+        # of the previous shard.
+        return self.look_back == dt.timedelta(0)
+
+    @property
+    def look_back(self):
+        return max(
+            (check.look_back for check in self._get_checks()),
+            default=dt.timedelta(0),
+        )
+
+    def _get_checks(self):
+        """Return the checks, loading them from the database only the first time."""
+        if not hasattr(self, "_checks"):
+            self._checks = []
+            for check_type in self.check_types:
+                try:
+                    self._checks.append(check_type.objects.get(checks=self))
+                except check_type.DoesNotExist:
+                    pass
+        return self._checks
+
+    def execute(self, dry_run=False):
+        source_timeseries = self.source_timeseries
+        look_back = self.look_back
+        result = 0
+        windows = self._get_windows(source_timeseries, self.WINDOW_SIZE)
+        for start_date, end_date in windows:
+            self._window_start_date = start_date
+            with stage("fetch source") as s:
+                self._htimeseries = s.set_output(
+                    source_timeseries.get_data(start_date=start_date, end_date=end_date)
+                )
+            if look_back and start_date is not None:
+                self._add_look_back_data(look_back)
+            result += super().execute(dry_run)
+        return result
+
+    def _add_look_back_data(self, look_back):
+        with stage("fetch look-back") as s:
+            look_back_data = s.set_output(self._get_look_back_data(look_back))
+        if not look_back_data.empty:
+            self._htimeseries.data = concat_data(
+                [look_back_data, self._htimeseries.data]
+            )
+
+    def _get_look_back_data(self, look_back):
+        """Return the checked records preceding the window that the checks need.
+
+        These are the records of the last "look_back" before the window, plus the
+        last valid record, which the rate-of-change check compares with regardless
+        of how far back it is. Records that have failed the rate-of-change check get
+        a null value so that, like when checking all the time series at once, they
+        are not compared with.
+        """
+        target_timeseries = self.target_timeseries
+        start_date = self._window_start_date - look_back
+        try:
+            last_valid_record = (
+                target_timeseries.timeseriesrecord_set.filter(
+                    timestamp__lt=self._window_start_date, value__isnull=False
+                )
+                .exclude(flags__contains="TEMPORAL")
+                .latest()
+            )
+            start_date = min(start_date, last_valid_record.timestamp)
+        except TimeseriesRecord.DoesNotExist:
+            pass
+        data = target_timeseries.get_data(
+            start_date=start_date,
+            end_date=self._window_start_date - dt.timedelta(minutes=1),
+        ).data
+        data.loc[data["flags"].str.contains("TEMPORAL"), "value"] = np.nan
+        return data
+
     def process_timeseries(self):
-        for check_type in self.check_types:
-            checked_timeseries = self.htimeseries
-            try:
-                check = check_type.objects.get(checks=self)
-                checked_timeseries = check.check_timeseries(checked_timeseries)
-            except check_type.DoesNotExist:
-                pass
-        return checked_timeseries.data
+        checked_timeseries = self.htimeseries
+        for check in self._get_checks():
+            with stage(type(check).__name__, rows_in=checked_timeseries) as s:
+                checked_timeseries = s.set_output(
+                    check.check_timeseries(checked_timeseries)
+                )
+        return self._remove_look_back_data(checked_timeseries.data)
+
+    def _remove_look_back_data(self, data):
+        start_date = getattr(self, "_window_start_date", None)
+        if start_date is None or data.empty:
+            return data
+        return data.loc[start_date:]
 
 
 def delete_checks_if_no_check(sender, instance, **kwargs):
@@ -153,6 +367,7 @@ class RangeCheck(models.Model):
         blank=True, null=True, verbose_name=_("Soft lower bound")
     )
     objects = SelectRelatedManager()
+    look_back = dt.timedelta(0)
 
     class Meta:
         db_table = "enhydris_autoprocess_rangecheck"
@@ -195,9 +410,7 @@ class RangeCheck(models.Model):
         return ahtimeseries
 
     def _add_flag_to_out_of_bounds_values(self, ahtimeseries, mask, flag):
-        out_of_bounds_with_flags_mask = mask & (ahtimeseries.data["flags"] != "")
-        ahtimeseries.data.loc[out_of_bounds_with_flags_mask, "flags"] += " "
-        ahtimeseries.data.loc[mask, "flags"] += flag
+        add_flag(ahtimeseries.data, mask, flag)
         return ahtimeseries
 
 
@@ -237,26 +450,93 @@ class RateOfChangeCheck(models.Model):
         )
 
     def check_timeseries(self, source_htimeseries):
+        mask = self._flag_failing_records(source_htimeseries)
+        if self.remove_failing_values:
+            source_htimeseries.data.loc[mask, "value"] = np.nan
+        return source_htimeseries
+
+    def _flag_failing_records(self, ahtimeseries):
+        """Add the TEMPORAL flag to the records that fail and return a mask of them.
+
+        Running rocc is relatively costly, so we first find, with vectorized
+        operations, the records that may possibly fail. Usually there are none, and
+        then we don't need to run rocc at all.
+        """
+        if not self._find_possibly_failing_records(ahtimeseries.data).any():
+            return np.zeros(len(ahtimeseries.data), dtype=bool)
+        original_flags = ahtimeseries.data["flags"].to_numpy()
         rocc(
-            timeseries=source_htimeseries,
+            timeseries=ahtimeseries,
             thresholds=self.thresholds,
             symmetric=self.symmetric,
             flag="TEMPORAL",
         )
-        data = source_htimeseries.data
-        if self.remove_failing_values:
-            data.loc[data["flags"].str.contains("TEMPORAL"), "value"] = np.nan
-        return source_htimeseries
+        compact_flags(ahtimeseries.data)  # rocc returns the flags as text
+        return ahtimeseries.data["flags"].to_numpy() != original_flags
+
+    def _find_possibly_failing_records(self, data):
+        """Return a mask of the records that may fail the check.
+
+        For each record, rocc compares the value with the records within each
+        threshold's delta_t, ignoring records that have already failed; then with
+        the last valid record, allowing a difference that is the sum of one or more
+        allowed_diffs. Here we calculate the same thing assuming that there are no
+        failed records, and using the smallest allowed_diff for the comparison with
+        the last valid record. If no record fails in this way, then no record fails
+        in rocc either. The converse is not necessarily true.
+        """
+        values = data["value"]
+        result = np.zeros(len(values), dtype=bool)
+        if values.empty:
+            return result
+        for threshold in self.thresholds:
+            window = values.rolling(pd.Timedelta(threshold.delta_t), closed="left")
+            result |= self._exceeds(values - window.min(), threshold.allowed_diff)
+            result |= self._exceeds(values - window.max(), threshold.allowed_diff)
+        diffs = values - values.shift().ffill()
+        for allowed_diff in self._get_smallest_allowed_diffs():
+            result |= self._exceeds(diffs, allowed_diff)
+        return result
+
+    def _exceeds(self, diffs, allowed_diff):
+        diffs = diffs.to_numpy()
+        if self.symmetric:
+            return np.abs(diffs) > abs(allowed_diff)
+        elif allowed_diff > 0:
+            return diffs > allowed_diff
+        else:
+            return diffs < allowed_diff
+
+    def _get_smallest_allowed_diffs(self):
+        allowed_diffs = [t.allowed_diff for t in self.thresholds]
+        if self.symmetric:
+            return [min(abs(x) for x in allowed_diffs)]
+        positive = [x for x in allowed_diffs if x > 0]
+        negative = [x for x in allowed_diffs if x < 0]
+        return [min(positive)] * bool(positive) + [max(negative)] * bool(negative)
+
+    @property
+    def look_back(self):
+        """The largest delta_t of the thresholds.
+
+        When checking a record, we need the records up to that long before it.
+        """
+        return max(
+            (pd.Timedelta(t.delta_t).to_pytimedelta() for t in self.thresholds),
+            default=dt.timedelta(0),
+        )
 
     @property
     def thresholds(self):
-        thresholds = RateOfChangeThreshold.objects.filter(
-            rate_of_change_check=self
-        ).order_by("delta_t")
-        result = []
-        for threshold in thresholds:
-            result.append(Threshold(threshold.delta_t, threshold.allowed_diff))
-        return result
+        if not hasattr(self, "_thresholds"):
+            thresholds = RateOfChangeThreshold.objects.filter(
+                rate_of_change_check=self
+            ).order_by("delta_t")
+            self._thresholds = [
+                Threshold(threshold.delta_t, threshold.allowed_diff)
+                for threshold in thresholds
+            ]
+        return self._thresholds
 
     def get_thresholds_as_text(self):
         result = ""
@@ -265,6 +545,8 @@ class RateOfChangeCheck(models.Model):
         return result
 
     def set_thresholds(self, s):
+        if hasattr(self, "_thresholds"):
+            del self._thresholds
         self.rateofchangethreshold_set.all().delete()
         for line in s.splitlines():
             delta_t, allowed_diff = line.split()
@@ -310,6 +592,7 @@ class CurveInterpolation(AutoProcess):
         verbose_name=_("Target time series group"),
     )
     objects = SelectRelatedManager()
+    can_be_sharded = True
 
     class Meta:
         db_table = "enhydris_autoprocess_curveinterpolation"
@@ -321,14 +604,7 @@ class CurveInterpolation(AutoProcess):
 
     @property
     def source_timeseries(self):
-        try:
-            return self.timeseries_group.timeseries_set.get(type=Timeseries.CHECKED)
-        except Timeseries.DoesNotExist:
-            pass
-        obj, created = self.timeseries_group.timeseries_set.get_or_create(
-            type=Timeseries.INITIAL
-        )
-        return obj
+        return self._get_checked_or_initial_timeseries()
 
     @property
     def target_timeseries(self):
@@ -339,18 +615,82 @@ class CurveInterpolation(AutoProcess):
 
     def process_timeseries(self):
         source = self.htimeseries.data
-        target = source.copy()
-        target["value"] = np.nan
-        target["flags"] = ""
-        for period in self.curveperiod_set.order_by("start_date"):
-            x, y = period._get_curve()
-            utc = dt.timezone.utc
-            start = dt.datetime.combine(period.start_date, dt.time(0, 0), tzinfo=utc)
-            end = dt.datetime.combine(period.end_date, dt.time(23, 59), tzinfo=utc)
-            values_array = source.loc[start:end, "value"].values
-            new_array = np.interp(values_array, x, y, left=np.nan, right=np.nan)
-            target.loc[start:end, "value"] = new_array
-        return target
+        with stage("interpolate", rows_in=source) as s:
+            target = source.copy()
+            target["value"] = self._interpolate(source)
+            target["flags"] = ""
+            return s.set_output(target)
+
+    def _interpolate(self, source):
+        """Return an array with the interpolated values of the source.
+
+        Each record is assigned to the last period that starts before it (periods
+        are not expected to overlap); since both are sorted, the records of each
+        period are consecutive, and they are interpolated together.
+        """
+        result = np.full(len(source), np.nan)
+        starts, ends, curves = self._get_curves()
+        if not curves or source.empty:
+            return result
+        timestamps = source.index.as_unit("ns").asi8
+        values = source["value"].to_numpy(dtype=np.float64)
+        period_indexes = np.searchsorted(starts, timestamps, side="right") - 1
+        bounds = np.searchsorted(period_indexes, np.arange(len(curves) + 1))
+        for i, (x, y) in enumerate(curves):
+            first, last = bounds[i], bounds[i + 1]
+            if first == last:
+                continue
+            last = first + np.searchsorted(timestamps[first:last], ends[i], "right")
+            result[first:last] = np.interp(
+                values[first:last], x, y, left=np.nan, right=np.nan
+            )
+        return result
+
+    def _get_curves(self):
+        """Return the start dates, end dates and curves of the curve periods.
+
+        The dates are arrays of nanoseconds since the epoch, sorted by start date;
+        the curves are (x, y) pairs of arrays. They are loaded with a single query
+        and cached until a curve period or point of this curve interpolation
+        changes (see apps.py).
+        """
+        return cache.get_or_set(
+            self.get_curves_cache_key(self.id), self._load_curves, timeout=None
+        )
+
+    @classmethod
+    def get_curves_cache_key(cls, curve_interpolation_id):
+        return f"curve-interpolation-curves-{curve_interpolation_id}"
+
+    def _load_curves(self):
+        points = (
+            CurvePoint.objects.filter(curve_period__curve_interpolation=self)
+            .order_by("curve_period__start_date", "curve_period_id", "x")
+            .values_list(
+                "curve_period_id",
+                "curve_period__start_date",
+                "curve_period__end_date",
+                "x",
+                "y",
+            )
+        )
+        periods = {}
+        for period_id, start_date, end_date, x, y in points:
+            period = periods.setdefault(period_id, (start_date, end_date, [], []))
+            period[2].append(x)
+            period[3].append(y)
+        utc = dt.timezone.utc
+        starts = [
+            dt.datetime.combine(p[0], dt.time(0, 0), utc) for p in periods.values()
+        ]
+        ends = [
+            dt.datetime.combine(p[1], dt.time(23, 59), utc) for p in periods.values()
+        ]
+        return (
+            pd.DatetimeIndex(starts, tz=utc).as_unit("ns").asi8,
+            pd.DatetimeIndex(ends, tz=utc).as_unit("ns").asi8,
+            [(np.array(p[2]), np.array(p[3])) for p in periods.values()],
+        )
 
 
 class CurvePeriod(models.Model):
@@ -371,14 +711,6 @@ class CurvePeriod(models.Model):
             str(self.curve_interpolation), self.start_date, self.end_date
         )
 
-    def _get_curve(self):
-        x = []
-        y = []
-        for point in self.curvepoint_set.filter(curve_period=self).order_by("x"):
-            x.append(point.x)
-            y.append(point.y)
-        return x, y
-
     def set_curve(self, s):
         """Replaces all existing points with ones read from a string.
 
@@ -450,6 +782,7 @@ class Aggregation(AutoProcess):
         ),
         verbose_name=_("Resulting timestamp offset"),
     )
+    state = models.JSONField(null=True, blank=True, editable=False)
     objects = SelectRelatedManager()
 
     class Meta:
@@ -462,13 +795,7 @@ class Aggregation(AutoProcess):
 
     @property
     def source_timeseries(self):
-        try:
-            return self.timeseries_group.timeseries_set.get(type=Timeseries.CHECKED)
-        except Timeseries.DoesNotExist:
-            obj, created = self.timeseries_group.timeseries_set.get_or_create(
-                type=Timeseries.INITIAL
-            )
-            return obj
+        return self._get_checked_or_initial_timeseries()
 
     @property
     def target_timeseries(self):
@@ -482,13 +809,271 @@ class Aggregation(AutoProcess):
     def save(self, force_insert=False, force_update=False, *args, **kwargs):
         check_time_step(self.target_time_step)
         self._check_resulting_timestamp_offset()
+        self.state = None  # The configuration may have changed
         super().save(force_insert, force_update, *args, **kwargs)
 
+    def execute(self, dry_run=False):
+        """Aggregate the new part of the source and append it to the target.
+
+        The last target interval is usually incomplete. After each execution, its
+        partial aggregates are stored in "state" (see _get_state()). If they are
+        available, the next execution only reads and regularizes the source records
+        after them, and replaces the last target record with one calculated from
+        the partial aggregates and the new records. Otherwise, the last target
+        record is recalculated from the source if it has the MISS flag (see
+        _get_start_date()), and everything after it is aggregated from scratch.
+        """
+        return self.execute_batch([self], dry_run)
+
+    @classmethod
+    def execute_batch(cls, aggregations, dry_run=False):
+        """Execute aggregations that have the same source time series.
+
+        The source is read once, from the earliest date that any of the aggregations
+        needs. The part of it needed by the aggregations that have a state is
+        regularized once for each regularization mode. Return the total number of
+        records appended.
+        """
+        source_timeseries = aggregations[0].source_timeseries
+        for aggregation in aggregations:
+            aggregation._prepare_execution(source_timeseries)
+        start_dates = [x._source_start_date for x in aggregations]
+        with stage("fetch source") as s:
+            source_htimeseries = s.set_output(
+                source_timeseries.get_data(
+                    start_date=None if None in start_dates else min(start_dates)
+                )
+            )
+        regularized = {}
+        result = 0
+        for aggregation in aggregations:
+            if aggregation._state is None:
+                aggregation._htimeseries = aggregation._slice_htimeseries(
+                    source_htimeseries, aggregation._source_start_date
+                )
+                result += super(Aggregation, aggregation).execute(dry_run)
+            else:
+                result += aggregation._execute_incrementally(
+                    source_htimeseries, regularized, aggregations, dry_run
+                )
+            aggregation._save_state()
+        return result
+
+    def _prepare_execution(self, source_timeseries):
+        self._next_state = None
+        self._can_be_incremental = self._can_aggregate_incrementally(source_timeseries)
+        self._state = self._get_valid_state()
+        if self._state is None:
+            self._source_start_date = self._get_start_date()
+        else:
+            self._source_start_date = (
+                pd.Timestamp(self._state["grid_end"]) - self._source_step / 2
+            )
+
+    def _slice_htimeseries(self, ahtimeseries, start_date):
+        result = copy(ahtimeseries)
+        result.data = ahtimeseries.data.loc[start_date:]
+        return result
+
+    def _can_aggregate_incrementally(self, source_timeseries):
+        # The target intervals must be aligned with the days, otherwise they depend
+        # on where the aggregation starts.
+        try:
+            self._source_step = pd.to_timedelta(to_offset(source_timeseries.time_step))
+            self._target_step = self._get_target_step()
+            target_step = pd.Timedelta(self._target_step)
+        except (TypeError, ValueError):
+            return False
+        zero = pd.Timedelta(0)
+        return (
+            self._source_step > zero
+            and target_step % self._source_step == zero
+            and pd.Timedelta("1D") % target_step == zero
+        )
+
+    def _get_valid_state(self):
+        if not self.state or not self._can_be_incremental:
+            return None
+        saved_target_end_date = self.state["target_end_date"]
+        if saved_target_end_date is not None:
+            saved_target_end_date = pd.Timestamp(saved_target_end_date)
+        if saved_target_end_date != self.target_timeseries.end_date:
+            return None  # The target has been modified by something else
+        return self.state
+
+    def _execute_incrementally(self, source_htimeseries, regularized, batch, dry_run):
+        """Aggregate the source records after the state and update the target.
+
+        "regularized" is a dictionary that maps a regularization mode to the
+        regularized source, so that it can be shared by the aggregations of the
+        batch; if the mode isn't there yet, it is added.
+        """
+        state = self._state
+        grid_end = pd.Timestamp(state["grid_end"])
+        data = source_htimeseries.data
+        if data.empty or data.index[-1] <= pd.Timestamp(state["source_end_date"]):
+            self._next_state = state
+            return 0
+        mode = self._get_regularization_mode()
+        if mode not in regularized:
+            start_date = min(x._source_start_date for x in batch if x._state)
+            regularized[mode] = self._regularize_time_series(
+                self._slice_htimeseries(source_htimeseries, start_date)
+            ).data
+        new_regularized = regularized[mode].loc[grid_end:]
+        if new_regularized.empty or new_regularized.index[0] != grid_end:
+            return super().execute(dry_run)  # The source has been modified
+        result = self._aggregate_incrementally(
+            new_regularized, state, self._source_step
+        )
+        self._next_state = self._get_state(new_regularized, data.index[-1], state)
+        open_record_date = pd.Timestamp(state["label"]) + self._get_timestamp_offset()
+        if self.target_timeseries.end_date == open_record_date:
+            self._record_to_replace = open_record_date
+        return self._append_to_target(result, dry_run)
+
+    def _aggregate_incrementally(self, regularized, state, source_step):
+        """Aggregate regularized, which continues the source of state.
+
+        The result is what _aggregate_time_series() would give for the intervals
+        from state["label"] onwards if it were run on the entire source.
+        """
+        with stage("aggregate", rows_in=regularized) as s:
+            return s.set_output(
+                self._do_aggregate_incrementally(regularized, state, source_step)
+            )
+
+    def _do_aggregate_incrementally(self, regularized, state, source_step):
+        stats = self._get_interval_stats(regularized, state)
+        max_count = int(pd.Timedelta(self._target_step) / source_step)
+        min_count = max(max_count - self.max_missing, 1)
+        values = {
+            "sum": stats["sum"],
+            "mean": stats["sum"] / stats["count"],
+            "max": stats["max"],
+            "min": stats["min"],
+        }[self.method]
+        missing = max_count - stats["count"]
+        result = pd.DataFrame(
+            {
+                "value": values.where(stats["count"] >= min_count),
+                "flags": missing.map(lambda x: f"MISSING{x}" if x else ""),
+            }
+        )
+        not_null = result["value"].notna().to_numpy()
+        if not not_null.any():
+            return result.iloc[:0]
+        first, last = not_null.argmax(), len(not_null) - not_null[::-1].argmax()
+        result = result.iloc[first:last]
+        result.index = result.index + self._get_timestamp_offset()
+        result.index.name = "date"
+        return result
+
+    def _get_interval_stats(self, regularized, state):
+        """Return the count, sum, min and max of the values of each target interval.
+
+        The result is a dataframe indexed by the end of the interval (the target
+        timestamp before applying the resulting timestamp offset). If state is
+        specified, its partial aggregates are added to its interval.
+        """
+        values = regularized["value"].astype(np.float64)
+        grouped = values.groupby(values.index.ceil(self._target_step))
+        stats = pd.DataFrame(
+            {
+                "count": grouped.count(),
+                "sum": grouped.sum(),
+                "min": grouped.min(),
+                "max": grouped.max(),
+            }
+        )
+        if state is None:
+            return stats
+        label = pd.Timestamp(state["label"]).tz_convert(values.index.tz)
+        if label not in stats.index:
+            stats.loc[label] = [0, 0.0, np.nan, np.nan]
+            stats = stats.sort_index().astype({"count": int})
+        state_min = np.nan if state["min"] is None else state["min"]
+        state_max = np.nan if state["max"] is None else state["max"]
+        stats.loc[label, "count"] += state["count"]
+        stats.loc[label, "sum"] += state["sum"]
+        stats.loc[label, "min"] = np.fmin(stats.loc[label, "min"], state_min)
+        stats.loc[label, "max"] = np.fmax(stats.loc[label, "max"], state_max)
+        return stats
+
+    def _get_state(self, regularized, source_end_date, state=None):
+        """Return the partial aggregates of the last target interval.
+
+        These are calculated from all regularized records of the interval except for
+        the last one, which may change when more source records become available;
+        so the next execution starts with regularizing that record again.
+        """
+        grid_end = regularized.index[-1]
+        label = grid_end.ceil(self._target_step)
+        previous = regularized.iloc[:-1]
+        previous = previous.loc[
+            previous.index > label - pd.Timedelta(self._target_step)
+        ]
+        stats = self._get_interval_stats(previous, state)
+        if label in stats.index:
+            count, sum_, min_, max_ = stats.loc[label]
+        else:
+            count, sum_, min_, max_ = 0, 0.0, np.nan, np.nan
+        return {
+            "label": label.isoformat(),
+            "grid_end": grid_end.isoformat(),
+            "source_end_date": source_end_date.isoformat(),
+            "count": int(count),
+            "sum": float(sum_),
+            "min": None if np.isnan(min_) else float(min_),
+            "max": None if np.isnan(max_) else float(max_),
+        }
+
+    def _save_state(self):
+        state = self._next_state
+        if state is not None:
+            target_end_date = self.target_timeseries.end_date
+            state["target_end_date"] = target_end_date and target_end_date.isoformat()
+        Aggregation.objects.filter(id=self.id).update(state=state)
+        self.state = state
+
+    def _get_timestamp_offset(self):
+        # A positive resulting timestamp offset is subtracted from the timestamps
+        return -pd.Timedelta(self.resulting_timestamp_offset or 0)
+
     def _get_start_date(self):
-        if self._last_target_timeseries_record_needs_recalculation():
-            self.target_timeseries.timeseriesrecord_set.latest().delete()
-            self.target_timeseries.save()
-        return super()._get_start_date()
+        """Return the date from which the source needs to be aggregated.
+
+        If the last target record needs recalculation, it is aggregated again, and
+        it is replaced when the result is appended (see _append_to_target()).
+        """
+        self._record_to_replace = None
+        if not self._last_target_timeseries_record_needs_recalculation():
+            return super()._get_start_date()
+        timestamps = list(
+            self.target_timeseries.timeseriesrecord_set.order_by(
+                "-timestamp"
+            ).values_list("timestamp", flat=True)[:2]
+        )
+        self._record_to_replace = timestamps[0]
+        if len(timestamps) < 2:
+            return None
+        return timestamps[1] + dt.timedelta(minutes=1)
+
+    def _append_to_target(self, data, dry_run):
+        """Append data to the target, replacing the record to replace, if any.
+
+        The record is deleted in the same transaction as the append, and only if
+        there is something to append, so that it is never lost. On dry runs the
+        target is left alone.
+        """
+        record_to_replace = getattr(self, "_record_to_replace", None)
+        self._record_to_replace = None
+        records = data.data if isinstance(data, HTimeseries) else data
+        if dry_run or record_to_replace is None or records.empty:
+            return super()._append_to_target(data, dry_run)
+        with transaction.atomic():
+            self.target_timeseries.delete_data(record_to_replace)
+            return super()._append_to_target(data, dry_run)
 
     def _last_target_timeseries_record_needs_recalculation(self):
         # No recalculation needed if it didn't have the "MISSING" flag.
@@ -527,11 +1112,19 @@ class Aggregation(AutoProcess):
         except (RegularizeError, ValueError) as e:
             logging.getLogger("enhydris.autoprocess").error(str(e))
             return HTimeseries()
+        if getattr(self, "_can_be_incremental", False):
+            self._next_state = self._get_state(regularized.data, self.source_end_date)
         return aggregated
 
+    def _get_regularization_mode(self):
+        return self.method == "mean" and RM.INSTANTANEOUS or RM.INTERVAL
+
     def _regularize_time_series(self, source_htimeseries):
-        mode = self.method == "mean" and RM.INSTANTANEOUS or RM.INTERVAL
-        return regularize(source_htimeseries, new_date_flag="DATEINSERT", mode=mode)
+        mode = self._get_regularization_mode()
+        with stage("regularize", rows_in=source_htimeseries) as s:
+            return s.set_output(
+                regularize(source_htimeseries, new_date_flag="DATEINSERT", mode=mode)
+            )
 
     def _aggregate_time_series(self, source_htimeseries):
         source_step = self._get_source_step(source_htimeseries)
@@ -541,14 +1134,17 @@ class Aggregation(AutoProcess):
             - self.max_missing
         )
         min_count = max(min_count, 1)
-        return aggregate(
-            source_htimeseries,
-            target_step,
-            self.method,
-            min_count=min_count,
-            target_timestamp_offset=self.resulting_timestamp_offset or None,
-            missing_flag="MISSING{}",
-        )
+        with stage("aggregate", rows_in=source_htimeseries) as s:
+            return s.set_output(
+                aggregate(
+                    source_htimeseries,
+                    target_step,
+                    self.method,
+                    min_count=min_count,
+                    target_timestamp_offset=self.resulting_timestamp_offset or None,
+                    missing_flag="MISSING{}",
+                )
+            )
 
     def _get_source_step(self, source_htimeseries):
         return pd.infer_freq(source_htimeseries.data.index)
@@ -0,0 +1,177 @@
+"""Measurement of the stages of auto-process executions.
+
+The code of the auto-processes marks its stages (fetching the source, each check,
+regularization, aggregation, appending to the target) with stage(). While a Profile
+is active, each stage is recorded with its wall time, the number of rows it received
+and produced, and optionally the peak of the memory it allocated; otherwise stage()
+does practically nothing.
+
+dry_run() executes an auto-process without modifying the database and returns its
+Profile; it is used by the "profile_autoprocess" management command and by an admin
+action. If ENHYDRIS_AUTOPROCESS_PROFILE is set, the stages of every execution by the
+scheduler are logged (see record()).
+"""
+
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import transaction
+
+_current_profile = ContextVar("autoprocess_profile", default=None)
+
+
+def count_rows(data):
+    """Return the number of rows of a dataframe or HTimeseries (None for None)."""
+    if data is None:
+        return None
+    return len(getattr(data, "data", data))
+
+
+class Stage:
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = count_rows(rows_in)
+        self.rows_out = None
+        self.seconds = 0.0
+        self.memory_peak = None
+
+    def set_output(self, data):
+        """Record the number of rows of data as the output of the stage; return data."""
+        self.rows_out = count_rows(data)
+        return data
+
+
+class Profile:
+    """The stages recorded while the profile is active.
+
+    Use it as a context manager. If trace_memory is True, memory allocations are
+    traced with tracemalloc, which makes execution considerably slower.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = []
+
+    def __enter__(self):
+        self._token = _current_profile.set(self)
+        self._started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._started_tracing:
+            tracemalloc.stop()
+        _current_profile.reset(self._token)
+
+    @property
+    def total_seconds(self):
+        return sum(s.seconds for s in self.stages)
+
+    def get_summary(self):
+        """Return the stages, with stages that have the same name merged.
+
+        For example, the source of checks is fetched once for each window; this
+        returns a single "fetch source" stage with the total time and rows.
+        """
+        result = {}
+        for s in self.stages:
+            if s.name not in result:
+                result[s.name] = Stage(s.name)
+            merged = result[s.name]
+            merged.seconds += s.seconds
+            merged.rows_in = _add(merged.rows_in, s.rows_in)
+            merged.rows_out = _add(merged.rows_out, s.rows_out)
+            if s.memory_peak is not None:
+                merged.memory_peak = max(merged.memory_peak or 0, s.memory_peak)
+        return list(result.values())
+
+    def format_table(self):
+        lines = [
+            f"{'Stage':<20} {'Time (s)':>9} {'Rows in':>9} {'Rows out':>9} "
+            f"{'Memory (MB)':>11}"
+        ]
+        for s in self.get_summary():
+            memory = "-" if s.memory_peak is None else f"{s.memory_peak / 1e6:.1f}"
+            lines.append(
+                f"{s.name:<20} {s.seconds:>9.3f} {_format_rows(s.rows_in):>9} "
+                f"{_format_rows(s.rows_out):>9} {memory:>11}"
+            )
+        lines.append(f"{'Total':<20} {self.total_seconds:>9.3f}")
+        return "\n".join(lines)
+
+    def format_line(self):
+        stages = ", ".join(_format_stage(s) for s in self.get_summary())
+        return f"{self.total_seconds:.3f} s: {stages}"
+
+
+def _add(a, b):
+    if a is None or b is None:
+        return a if b is None else b
+    return a + b
+
+
+def _format_rows(rows):
+    return "-" if rows is None else str(rows)
+
+
+def _format_stage(s):
+    details = f"{_format_rows(s.rows_in)} -> {_format_rows(s.rows_out)} rows"
+    if s.memory_peak is not None:
+        details += f", {s.memory_peak / 1e6:.1f} MB"
+    return f"{s.name} {s.seconds:.3f} s ({details})"
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """Record the enclosed code as a stage of the active Profile, if any.
+
+    rows_in is the input of the stage (a dataframe or HTimeseries); the output can
+    be specified with the set_output() method of the yielded Stage.
+    """
+    result = Stage(name, rows_in)
+    profile = _current_profile.get()
+    if profile is None:
+        yield result
+        return
+    trace_memory = profile.trace_memory and tracemalloc.is_tracing()
+    if trace_memory:
+        memory_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start_time = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result.seconds = time.perf_counter() - start_time
+        if trace_memory:
+            result.memory_peak = tracemalloc.get_traced_memory()[1] - memory_start
+        profile.stages.append(result)
+
+
+def dry_run(auto_process, trace_memory=True):
+    """Execute auto_process without modifying the database and return its Profile.
+
+    The result is not appended to the target; anything else that the execution
+    writes to the database, such as the state of an aggregation, is rolled back.
+    """
+    with Profile(trace_memory=trace_memory) as profile, transaction.atomic():
+        auto_process.execute(dry_run=True)
+        transaction.set_rollback(True)
+    return profile
+
+
+@contextmanager
+def record(auto_process_id):
+    """Log the stages of the enclosed execution if ENHYDRIS_AUTOPROCESS_PROFILE."""
+    if not getattr(settings, "ENHYDRIS_AUTOPROCESS_PROFILE", False):
+        yield
+        return
+    with Profile() as profile:
+        yield
+    logging.getLogger("enhydris.autoprocess").info(
+        f"AutoProcess with id={auto_process_id} executed in {profile.format_line()}"
+    )
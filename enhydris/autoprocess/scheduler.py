@@ -0,0 +1,335 @@
+"""Scheduling of auto-processes according to their dependencies.
+
+Auto-processes form a directed acyclic graph: a curve interpolation writes to the
+initial time series of another time series group, that group may have checks, the
+checked time series may be aggregated, and so on. An auto-process is downstream of
+another if its source time series is the other's target time series.
+
+Auto-processes that have no upstream are scheduled when their source time series is
+saved (see apps.py). The rest are scheduled when an upstream auto-process appends
+data to its target. If an auto-process is scheduled while an upstream one is queued
+or running, it is deferred until the upstream one finishes. Queued auto-processes
+wait ENHYDRIS_AUTOPROCESS_DELAY seconds before being executed; if one is scheduled
+again while it is waiting, the two runs are merged into one. This way a burst of
+saves of a time series results in a single execution.
+
+An auto-process never runs twice concurrently; its "running" key is a lock, and if
+it is executed while it holds it, it is deferred until it finishes. A long
+back-fill of an auto-process that can be sharded (see AutoProcess.get_shards()) is
+split into shards, which are processed in parallel, possibly by different workers.
+Each shard stores its result, or the fact that it failed, in the database (see
+AutoProcessShard) and refreshes the lock; whichever finishes last appends them all to
+the target in order, in a single transaction (or discards them if any has failed),
+and releases the lock.
+
+Aggregations of the same time series group have the same source; they form a batch
+that is scheduled and executed as a single auto-process, the batch leader (the one
+with the smallest id), so that the source is read and regularized only once (see
+Aggregation.execute_batch()).
+"""
+
+import datetime as dt
+import pickle
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from enhydris.models import Timeseries
+
+from . import tasks
+from .profiling import record
+
+GRAPH_CACHE_KEY = "autoprocess-graph"
+GRAPH_TIMEOUT = 3600
+QUEUED_TIMEOUT = 3600
+RUNNING_TIMEOUT = 3600
+
+
+class AutoProcessGraph:
+    def __init__(self):
+        self.upstream = defaultdict(list)
+        self.downstream = defaultdict(list)
+        self.triggers = defaultdict(list)
+        self.batches = {}
+        self.batch_leaders = {}
+
+    @classmethod
+    def get(cls):
+        return cache.get_or_set(GRAPH_CACHE_KEY, cls._build, timeout=GRAPH_TIMEOUT)
+
+    @classmethod
+    def invalidate(cls):
+        """Remove the graph from the cache, now and when the transaction commits.
+
+        Until the transaction commits, other processes may rebuild the graph from
+        the old configuration and cache it, so we remove it again after the commit.
+        The timeout of the graph is a safety net in case this fails.
+        """
+        cache.delete(GRAPH_CACHE_KEY)
+        transaction.on_commit(lambda: cache.delete(GRAPH_CACHE_KEY))
+
+    @classmethod
+    def _build(cls):
+        """Create the graph from the auto-process configuration.
+
+        The source and target time series of each auto-process are identified by
+        (timeseries_group_id, type), which we can find without touching (and
+        possibly creating) the time series themselves.
+        """
+        result = cls()
+        consumers = defaultdict(list)
+        for auto_process_id, source in cls._get_sources():
+            consumers[source].append(auto_process_id)
+        for auto_process_id, target in cls._get_targets():
+            for consumer_id in consumers[target]:
+                result.downstream[auto_process_id].append(consumer_id)
+                result.upstream[consumer_id].append(auto_process_id)
+        for source, auto_process_ids in consumers.items():
+            for auto_process_id in auto_process_ids:
+                if not result.upstream[auto_process_id]:
+                    result.triggers[source].append(auto_process_id)
+        result._build_batches()
+        return result
+
+    def _build_batches(self):
+        from .models import Aggregation
+
+        aggregations = defaultdict(list)
+        for auto_process_id, group_id in self._get_ids(
+            Aggregation, "timeseries_group_id"
+        ):
+            aggregations[group_id].append(auto_process_id)
+        for auto_process_ids in aggregations.values():
+            if len(auto_process_ids) < 2:
+                continue
+            auto_process_ids.sort()
+            leader_id = auto_process_ids[0]
+            self.batches[leader_id] = auto_process_ids
+            for auto_process_id in auto_process_ids:
+                self.batch_leaders[auto_process_id] = leader_id
+
+    def get_triggered_auto_processes(self, timeseries):
+        """Return the ids of the auto-processes to schedule when timeseries is saved.
+
+        These are the auto-processes that have timeseries as their source and no
+        upstream.
+        """
+        return self.triggers.get((timeseries.timeseries_group_id, timeseries.type), [])
+
+    @classmethod
+    def _get_sources(cls):
+        from .models import Aggregation, AutoProcess, Checks, CurveInterpolation
+
+        checked_groups = AutoProcess.get_checked_timeseries_group_ids()
+        for auto_process_id, group_id in cls._get_ids(Checks, "timeseries_group_id"):
+            yield auto_process_id, (group_id, Timeseries.INITIAL)
+        for model in (CurveInterpolation, Aggregation):
+            for auto_process_id, group_id in cls._get_ids(model, "timeseries_group_id"):
+                timeseries_type = Timeseries.INITIAL
+                if group_id in checked_groups:
+                    timeseries_type = Timeseries.CHECKED
+                yield auto_process_id, (group_id, timeseries_type)
+
+    @classmethod
+    def _get_targets(cls):
+        from .models import Checks, CurveInterpolation
+
+        for auto_process_id, group_id in cls._get_ids(Checks, "timeseries_group_id"):
+            yield auto_process_id, (group_id, Timeseries.CHECKED)
+        for auto_process_id, group_id in cls._get_ids(
+            CurveInterpolation, "target_timeseries_group_id"
+        ):
+            yield auto_process_id, (group_id, Timeseries.INITIAL)
+
+    @classmethod
+    def _get_ids(cls, model, group_field):
+        return model.objects.values_list("id", group_field)
+
+
+def schedule_auto_process(auto_process_id):
+    """Queue the execution of an auto-process when the transaction commits."""
+    transaction.on_commit(lambda: _enqueue(auto_process_id))
+
+
+def _enqueue(auto_process_id):
+    graph = AutoProcessGraph.get()
+    auto_process_id = graph.batch_leaders.get(auto_process_id, auto_process_id)
+    if any(_is_busy(x) for x in graph.upstream[auto_process_id]):
+        cache.set(_get_deferred_key(auto_process_id), True, QUEUED_TIMEOUT)
+        return
+    if cache.add(_get_queued_key(auto_process_id), True, QUEUED_TIMEOUT):
+        tasks.execute_auto_process.apply_async(
+            args=[auto_process_id],
+            countdown=getattr(settings, "ENHYDRIS_AUTOPROCESS_DELAY", 10),
+        )
+
+
+def _is_busy(auto_process_id):
+    keys = [_get_queued_key(auto_process_id), _get_running_key(auto_process_id)]
+    return bool(cache.get_many(keys))
+
+
+def execute_scheduled_auto_process(auto_process_id):
+    """Execute an auto-process queued by schedule_auto_process().
+
+    Afterwards, schedule the downstream auto-processes if data has been appended or
+    if they have been deferred until this one finished. If the execution is
+    sharded, this is done after the last shard finishes.
+    """
+    from .models import AutoProcess
+
+    cache.delete(_get_queued_key(auto_process_id))
+    try:
+        auto_process = AutoProcess.objects.get(id=auto_process_id)
+    except AutoProcess.DoesNotExist:
+        return
+    if not cache.add(_get_running_key(auto_process_id), True, RUNNING_TIMEOUT):
+        cache.set(_get_deferred_key(auto_process_id), True, QUEUED_TIMEOUT)
+        return
+    auto_process = auto_process.as_specific_instance
+    appended = 0
+    sharded = False
+    try:
+        shards = auto_process.get_shards()
+        if len(shards) > 1:
+            _enqueue_shards(auto_process_id, shards)
+            sharded = True
+        else:
+            with record(auto_process_id):
+                appended = _execute(auto_process)
+    finally:
+        if not sharded:
+            _finish(auto_process_id, appended)
+
+
+def _execute(auto_process):
+    from .models import Aggregation
+
+    batch = AutoProcessGraph.get().batches.get(auto_process.id)
+    if not batch:
+        return auto_process.execute()
+    aggregations = Aggregation.objects.filter(id__in=batch).order_by("id")
+    return Aggregation.execute_batch(list(aggregations))
+
+
+def _enqueue_shards(auto_process_id, shards):
+    from .models import AutoProcessShard
+
+    # Remove any results left over by an execution whose worker died
+    AutoProcessShard.objects.filter(auto_process_id=auto_process_id).delete()
+    cache.set(
+        _get_running_key(auto_process_id),
+        True,
+        _get_sharded_running_timeout(len(shards)),
+    )
+    for index, (start_date, end_date) in enumerate(shards):
+        tasks.execute_auto_process_shard.delay(
+            auto_process_id,
+            index,
+            len(shards),
+            start_date.isoformat(),
+            end_date and end_date.isoformat(),
+        )
+
+
+def execute_scheduled_auto_process_shard(
+    auto_process_id, index, num_shards, start_date, end_date
+):
+    """Process a shard enqueued by execute_scheduled_auto_process().
+
+    If this is the last shard to finish, append all shards to the target, unless
+    any of them has failed, in which case nothing is appended.
+    """
+    from .models import AutoProcess, AutoProcessShard
+
+    try:
+        auto_process = AutoProcess.objects.get(id=auto_process_id).as_specific_instance
+    except AutoProcess.DoesNotExist:
+        return
+    try:
+        with record(auto_process_id):
+            result = auto_process.process_shard(
+                dt.datetime.fromisoformat(start_date),
+                end_date and dt.datetime.fromisoformat(end_date),
+            )
+        result = pickle.dumps(result)
+    except Exception:
+        AutoProcessShard.objects.create(
+            auto_process_id=auto_process_id, index=index, result=None
+        )
+        _finish_shard(auto_process_id, num_shards)
+        raise
+    AutoProcessShard.objects.create(
+        auto_process_id=auto_process_id, index=index, result=result
+    )
+    _finish_shard(auto_process_id, num_shards)
+
+
+def _finish_shard(auto_process_id, num_shards):
+    """Refresh the lock, or, if this is the last shard to finish, append all shards.
+
+    The shards that have finished are counted in the database; the AutoProcess row
+    is locked while counting, so that only the last shard sees them all.
+    """
+    from .models import AutoProcess, AutoProcessShard
+
+    with transaction.atomic():
+        auto_process = AutoProcess.objects.select_for_update().get(id=auto_process_id)
+        shards = AutoProcessShard.objects.filter(auto_process_id=auto_process_id)
+        results = list(shards.order_by("index").values_list("result", flat=True))
+        if len(results) < num_shards:
+            cache.touch(
+                _get_running_key(auto_process_id),
+                _get_sharded_running_timeout(num_shards),
+            )
+            return
+        shards.delete()
+    appended = 0
+    try:
+        if None not in results:
+            target_timeseries = auto_process.as_specific_instance.target_timeseries
+            with transaction.atomic():
+                for result in results:
+                    appended += target_timeseries.append_data(pickle.loads(result))
+    finally:
+        _finish(auto_process_id, appended)
+
+
+def _finish(auto_process_id, appended):
+    cache.delete(_get_running_key(auto_process_id))
+    if cache.get(_get_deferred_key(auto_process_id)):
+        cache.delete(_get_deferred_key(auto_process_id))
+        schedule_auto_process(auto_process_id)
+    _schedule_downstream(auto_process_id, appended)
+
+
+def _schedule_downstream(auto_process_id, appended):
+    graph = AutoProcessGraph.get()
+    downstream_ids = {
+        graph.batch_leaders.get(x, x) for x in graph.downstream[auto_process_id]
+    }
+    for downstream_id in sorted(downstream_ids):
+        deferred_key = _get_deferred_key(downstream_id)
+        if appended or cache.get(deferred_key):
+            cache.delete(deferred_key)
+            schedule_auto_process(downstream_id)
+
+
+def _get_queued_key(auto_process_id):
+    return f"autoprocess-queued-{auto_process_id}"
+
+
+def _get_running_key(auto_process_id):
+    return f"autoprocess-running-{auto_process_id}"
+
+
+def _get_deferred_key(auto_process_id):
+    return f"autoprocess-deferred-{auto_process_id}"
+
+
+def _get_sharded_running_timeout(num_shards):
+    # The shards may wait in the queue behind each other, so the lock must last
+    # longer than it would for a single execution.
+    return RUNNING_TIMEOUT * num_shards
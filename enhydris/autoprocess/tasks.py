@@ -3,6 +3,17 @@ from enhydris.celery import app
 
 @app.task
 def execute_auto_process(auto_process_id):
-    from .models import AutoProcess
+    from .scheduler import execute_scheduled_auto_process
 
-    AutoProcess.objects.get(id=auto_process_id).as_specific_instance.execute()
+    execute_scheduled_auto_process(auto_process_id)
+
+
+@app.task
+def execute_auto_process_shard(
+    auto_process_id, index, num_shards, start_date, end_date
+):
+    from .scheduler import execute_scheduled_auto_process_shard
+
+    execute_scheduled_auto_process_shard(
+        auto_process_id, index, num_shards, start_date, end_date
+    )
@@ -1,12 +1,15 @@
 from unittest import mock
 
 from django.contrib.gis.geos import Point
+from django.core.cache import cache
 from django.db import transaction
 from django.test import TransactionTestCase
 
 from model_bakery import baker
 
-from enhydris.autoprocess.models import Checks
+from enhydris.autoprocess.apps import enqueue_auto_process
+from enhydris.autoprocess.models import Aggregation, Checks, CurveInterpolation
+from enhydris.autoprocess.scheduler import AutoProcessGraph
 from enhydris.models import Station, Timeseries
 
 
@@ -19,9 +22,8 @@ class EnqueueAutoProcessTestCase(TransactionTestCase):
 
     # Creating autoprocesses triggers tasks, so we patch some things in order to not
     # pollute the celery queue while testing.
-    @mock.patch("enhydris.autoprocess.models.tasks.execute_auto_process")
-    @mock.patch("enhydris.autoprocess.apps.execute_auto_process")
-    def setUp(self, m1, m2):
+    @mock.patch("enhydris.autoprocess.scheduler.tasks.execute_auto_process")
+    def setUp(self, m):
         self.station = baker.make(Station, geom=Point(x=21.06, y=39.09, srid=4326))
         self.auto_process = baker.make(
             Checks,
@@ -34,14 +36,65 @@ class EnqueueAutoProcessTestCase(TransactionTestCase):
             type=Timeseries.INITIAL,
         )
 
-    @mock.patch("enhydris.autoprocess.apps.execute_auto_process")
+        # The above has queued the auto process; forget about it.
+        cache.clear()
+
+    def _get_enqueued_ids(self, m):
+        return [c.kwargs["args"][0] for c in m.apply_async.call_args_list]
+
+    @mock.patch("enhydris.autoprocess.scheduler.tasks.execute_auto_process")
     def test_enqueues_auto_process(self, m):
         with transaction.atomic():
             self.timeseries.save()
-        m.delay.assert_any_call(self.auto_process.id)
+        self.assertEqual(self._get_enqueued_ids(m), [self.auto_process.id])
 
-    @mock.patch("enhydris.autoprocess.apps.execute_auto_process")
+    @mock.patch("enhydris.autoprocess.scheduler.tasks.execute_auto_process")
     def test_auto_process_is_not_triggered_before_commit(self, m):
         with transaction.atomic():
             self.timeseries.save()
-            m.delay.assert_not_called()
+            m.apply_async.assert_not_called()
+
+    @mock.patch("enhydris.autoprocess.scheduler.tasks.execute_auto_process")
+    def test_enqueues_auto_process_once_for_many_saves(self, m):
+        for i in range(3):
+            with transaction.atomic():
+                self.timeseries.save()
+        self.assertEqual(self._get_enqueued_ids(m), [self.auto_process.id])
+
+    @mock.patch("enhydris.autoprocess.scheduler.tasks.execute_auto_process")
+    def test_does_not_enqueue_auto_process_for_other_timeseries(self, m):
+        with transaction.atomic():
+            baker.make(
+                Timeseries,
+                timeseries_group=self.auto_process.timeseries_group,
+                type=Timeseries.REGULARIZED,
+            )
+        m.apply_async.assert_not_called()
+
+    @mock.patch("enhydris.autoprocess.scheduler.tasks.execute_auto_process")
+    def test_enqueues_all_auto_processes_of_timeseries(self, m):
+        with transaction.atomic():
+            self.auto_process.delete()
+            aggregation = baker.make(
+                Aggregation,
+                timeseries_group=self.timeseries.timeseries_group,
+                target_time_step="1h",
+                method="sum",
+            )
+            curve_interpolation = baker.make(
+                CurveInterpolation,
+                timeseries_group=self.timeseries.timeseries_group,
+                target_timeseries_group__gentity=self.station,
+            )
+        cache.clear()
+        with transaction.atomic():
+            self.timeseries.save()
+        self.assertCountEqual(
+            self._get_enqueued_ids(m), [aggregation.id, curve_interpolation.id]
+        )
+
+    @mock.patch("enhydris.autoprocess.scheduler.tasks.execute_auto_process")
+    def test_no_queries_for_finding_auto_processes(self, m):
+        AutoProcessGraph.get()
+        with self.assertNumQueries(0):
+            enqueue_auto_process(Timeseries, instance=self.timeseries)
@@ -7,10 +7,11 @@ from django.test import TestCase, override_settings
 import numpy as np
 import pandas as pd
 from haggregate import RegularizationMode as RM
+from haggregate import regularize
 from htimeseries import HTimeseries
 from model_bakery import baker
 
-from enhydris.autoprocess.models import Aggregation, AutoProcess
+from enhydris.autoprocess.models import Aggregation, AutoProcess, Checks
 from enhydris.models import Station, Timeseries, TimeseriesGroup, Variable
 from enhydris.tests.test_models.test_timeseries import get_tzinfo
 
@@ -109,6 +110,14 @@ class AggregationTestCase(TestCase):
         )
         self.assertEqual(aggregation.source_timeseries.id, 42)
 
+    def test_source_timeseries_when_checks_have_not_run(self):
+        self._make_timeseries(id=42, type=Timeseries.INITIAL)
+        baker.make(Checks, timeseries_group=self.timeseries_group)
+        aggregation = baker.make(
+            Aggregation, timeseries_group=self.timeseries_group, target_time_step="1h"
+        )
+        self.assertEqual(aggregation.source_timeseries.type, Timeseries.CHECKED)
+
     def _make_timeseries(self, id, type, name=""):
         return baker.make(
             Timeseries,
@@ -359,12 +368,10 @@ class AggregationRegularizationModeTestCase(TestCase):
         self.assertEqual(mock_regularize.call_args.kwargs["mode"], RM.INTERVAL)
 
 
-@override_settings(
-    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
-)
-class AggregationRecalculatesLastValueIfNeededTestCase(TestCase):
-    """
-    This test case uses this source time series:
+class AggregationSourceMixin:
+    """Create an hourly sum aggregation of a ten-minute source time series.
+
+    The source time series is this:
         2019-05-21 17:00:00+02:00    0.0
         2019-05-21 17:10:00+02:00    1.0
         2019-05-21 17:20:00+02:00    2.0
@@ -377,14 +384,9 @@ class AggregationRecalculatesLastValueIfNeededTestCase(TestCase):
         2019-05-21 18:30:00+02:00    9.0
         2019-05-21 18:40:00+02:00   10.0
 
-    It makes aggregation to hourly, and the last aggregated record (19:00) has two
-    missing values in the source time series, and therefore the MISSING2 flag.
-    Subsequently these two records are added:
+    _extend_source_timeseries() adds these records:
         2019-05-21 18:50:00+02:00   11.0
         2019-05-21 19:00:00+02:00   12.0
-
-    Then aggregation is repeated, and it is verified that the aggregated record at
-    19:00 is recalculated as needed.
     """
 
     def setUp(self):
@@ -422,6 +424,36 @@ class AggregationRecalculatesLastValueIfNeededTestCase(TestCase):
         super(AutoProcess, aggregation).save()  # Avoid triggering a celery task
         self.aggregation_id = aggregation.id
 
+    def _extend_source_timeseries(self):
+        aggregation = Aggregation.objects.get(id=self.aggregation_id)
+        source_timeseries = aggregation.source_timeseries
+        new_values = [11.0, 12.0]
+        new_flags = ["", ""]
+        end_date = source_timeseries.end_date
+        delta = dt.timedelta
+        new_dates = [end_date + delta(minutes=10), end_date + delta(minutes=20)]
+        new_data = pd.DataFrame(
+            data={"value": new_values, "flags": new_flags},
+            columns=["value", "flags"],
+            index=new_dates,
+        )
+        source_timeseries.append_data(new_data)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class AggregationRecalculatesLastValueIfNeededTestCase(
+    AggregationSourceMixin, TestCase
+):
+    """
+    It makes aggregation to hourly, and the last aggregated record (19:00) has two
+    missing values in the source time series of AggregationSourceMixin, and
+    therefore the MISSING2 flag. Subsequently the two missing records are added.
+    Then aggregation is repeated, and it is verified that the aggregated record at
+    19:00 is recalculated as needed.
+    """
+
     def test_initial_target_timeseries(self):
         aggregation = Aggregation.objects.get(id=self.aggregation_id)
         aggregation.execute()
@@ -456,20 +488,202 @@ class AggregationRecalculatesLastValueIfNeededTestCase(TestCase):
         expected_data.index.name = "date"
         pd.testing.assert_frame_equal(ahtimeseries.data, expected_data)
 
-    def _extend_source_timeseries(self):
+    def test_get_shards_does_not_delete_last_record(self):
+        Aggregation.objects.get(id=self.aggregation_id).execute()
         aggregation = Aggregation.objects.get(id=self.aggregation_id)
-        source_timeseries = aggregation.source_timeseries
-        new_values = [11.0, 12.0]
-        new_flags = ["", ""]
-        end_date = source_timeseries.end_date
-        delta = dt.timedelta
-        new_dates = [end_date + delta(minutes=10), end_date + delta(minutes=20)]
-        new_data = pd.DataFrame(
-            data={"value": new_values, "flags": new_flags},
+        aggregation.get_shards()
+        self.assertEqual(len(aggregation.target_timeseries.get_data().data), 2)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class AggregationStateTestCase(AggregationSourceMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        Aggregation.objects.get(id=self.aggregation_id).execute()
+
+    def _get_expected_data(self, values, flags):
+        result = pd.DataFrame(
+            data={"value": values, "flags": flags},
             columns=["value", "flags"],
-            index=new_dates,
+            index=[
+                dt.datetime(2019, 5, 21, 18, 0, tzinfo=get_tzinfo("Etc/GMT-2")),
+                dt.datetime(2019, 5, 21, 19, 0, tzinfo=get_tzinfo("Etc/GMT-2")),
+            ],
+        )
+        result.index.name = "date"
+        return result
+
+    def test_state(self):
+        # The record at 18:40 is not included; it is regularized again next time.
+        state = Aggregation.objects.get(id=self.aggregation_id).state
+        self.assertEqual(state["label"], "2019-05-21T19:00:00+02:00")
+        self.assertEqual(state["grid_end"], "2019-05-21T18:40:00+02:00")
+        self.assertEqual(
+            (state["count"], state["sum"], state["min"], state["max"]),
+            (3, 24.0, 7.0, 9.0),
+        )
+
+    def test_reads_only_new_source_records(self):
+        self._extend_source_timeseries()
+        aggregation = Aggregation.objects.get(id=self.aggregation_id)
+        with mock.patch.object(
+            Timeseries, "get_data", autospec=True, side_effect=Timeseries.get_data
+        ) as m:
+            aggregation.execute()
+        self.assertEqual(
+            m.call_args.kwargs["start_date"],
+            dt.datetime(2019, 5, 21, 18, 35, tzinfo=get_tzinfo("Etc/GMT-2")),
+        )
+
+    def test_updated_target_timeseries(self):
+        self._extend_source_timeseries()
+        aggregation = Aggregation.objects.get(id=self.aggregation_id)
+        aggregation.execute()
+        pd.testing.assert_frame_equal(
+            aggregation.target_timeseries.get_data().data,
+            self._get_expected_data([21.0, 57.0], ["", ""]),
+        )
+
+    def test_target_timeseries_modified_by_something_else(self):
+        aggregation = Aggregation.objects.get(id=self.aggregation_id)
+        aggregation.target_timeseries.timeseriesrecord_set.latest().delete()
+        aggregation.target_timeseries.save()
+        self._extend_source_timeseries()
+        aggregation.execute()
+        pd.testing.assert_frame_equal(
+            aggregation.target_timeseries.get_data().data,
+            self._get_expected_data([21.0, 57.0], ["", ""]),
+        )
+
+    def _modify_source_timeseries(self):
+        # Delete the record at 18:40, which the state expects to regularize again,
+        # and add two more records.
+        source_timeseries = Aggregation.objects.get(
+            id=self.aggregation_id
+        ).source_timeseries
+        source_timeseries.timeseriesrecord_set.latest().delete()
+        source_timeseries.save()
+        tzinfo = get_tzinfo("Etc/GMT-2")
+        source_timeseries.append_data(
+            pd.DataFrame(
+                data={"value": [11.0, 12.0], "flags": ["", ""]},
+                columns=["value", "flags"],
+                index=[
+                    dt.datetime(2019, 5, 21, 18, 50, tzinfo=tzinfo),
+                    dt.datetime(2019, 5, 21, 19, 0, tzinfo=tzinfo),
+                ],
+            )
+        )
+
+    def _get_target_values(self):
+        aggregation = Aggregation.objects.get(id=self.aggregation_id)
+        return list(aggregation.target_timeseries.get_data().data["value"])
+
+    def test_source_modified(self):
+        self._modify_source_timeseries()
+        Aggregation.objects.get(id=self.aggregation_id).execute()
+        self.assertEqual(self._get_target_values(), [21.0, 47.0])
+
+    def test_source_modified_dry_run(self):
+        self._modify_source_timeseries()
+        Aggregation.objects.get(id=self.aggregation_id).execute(dry_run=True)
+        self.assertEqual(self._get_target_values(), [21.0, 34.0])
+
+    def test_state_invalidated_dry_run(self):
+        Aggregation.objects.filter(id=self.aggregation_id).update(state=None)
+        self._extend_source_timeseries()
+        Aggregation.objects.get(id=self.aggregation_id).execute(dry_run=True)
+        self.assertEqual(self._get_target_values(), [21.0, 34.0])
+
+    def test_dry_run(self):
+        self._extend_source_timeseries()
+        Aggregation.objects.get(id=self.aggregation_id).execute(dry_run=True)
+        self.assertEqual(self._get_target_values(), [21.0, 34.0])
+
+    def test_last_record_is_kept_if_append_fails(self):
+        self._extend_source_timeseries()
+        aggregation = Aggregation.objects.get(id=self.aggregation_id)
+        with mock.patch.object(Timeseries, "append_data", side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                aggregation.execute()
+        self.assertEqual(self._get_target_values(), [21.0, 34.0])
+
+    def test_last_record_is_kept_if_append_fails_without_state(self):
+        Aggregation.objects.filter(id=self.aggregation_id).update(state=None)
+        self._extend_source_timeseries()
+        aggregation = Aggregation.objects.get(id=self.aggregation_id)
+        with mock.patch.object(Timeseries, "append_data", side_effect=IntegrityError):
+            with self.assertRaises(RuntimeError):
+                aggregation.execute()
+        self.assertEqual(self._get_target_values(), [21.0, 34.0])
+
+    def test_state_is_reset_when_aggregation_is_saved(self):
+        aggregation = Aggregation.objects.get(id=self.aggregation_id)
+        aggregation.max_missing = 3
+        aggregation.save()
+        self.assertIsNone(Aggregation.objects.get(id=self.aggregation_id).state)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class AggregationBatchTestCase(AggregationSourceMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        max_aggregation = Aggregation(
+            timeseries_group=Aggregation.objects.get().timeseries_group,
+            target_time_step="1h",
+            method="max",
+            max_missing=2,
+            resulting_timestamp_offset="",
+        )
+        super(AutoProcess, max_aggregation).save()  # Avoid triggering a celery task
+        for aggregation in Aggregation.objects.all():
+            aggregation.execute()
+        self._extend_source_timeseries()
+        self.aggregations = list(Aggregation.objects.order_by("id"))
+
+    def _get_target_data(self, aggregation):
+        return aggregation.target_timeseries.get_data().data
+
+    def test_reads_source_once(self):
+        with mock.patch.object(
+            Timeseries, "get_data", autospec=True, side_effect=Timeseries.get_data
+        ) as m:
+            Aggregation.execute_batch(self.aggregations)
+        self.assertEqual(
+            [c.args[0].type for c in m.call_args_list], [Timeseries.CHECKED]
+        )
+
+    @mock.patch(
+        "enhydris.autoprocess.models.regularize",
+        side_effect=regularize,
+    )
+    def test_regularizes_source_once(self, m):
+        Aggregation.execute_batch(self.aggregations)
+        self.assertEqual(m.call_count, 1)
+
+    def test_sum(self):
+        Aggregation.execute_batch(self.aggregations)
+        self.assertEqual(
+            list(self._get_target_data(self.aggregations[0])["value"]), [21.0, 57.0]
+        )
+
+    def test_max(self):
+        Aggregation.execute_batch(self.aggregations)
+        self.assertEqual(
+            list(self._get_target_data(self.aggregations[1])["value"]), [6.0, 12.0]
+        )
+
+    def test_aggregation_without_state(self):
+        Aggregation.objects.filter(id=self.aggregations[1].id).update(state=None)
+        self.aggregations[1].state = None
+        Aggregation.execute_batch(self.aggregations)
+        self.assertEqual(
+            list(self._get_target_data(self.aggregations[1])["value"]), [6.0, 12.0]
         )
-        source_timeseries.append_data(new_data)
 
 
 @mock.patch("enhydris.autoprocess.models.logging")
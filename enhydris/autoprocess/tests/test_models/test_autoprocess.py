@@ -62,13 +62,15 @@ class AutoProcessSaveTestCase(TransactionTestCase):
         with transaction.atomic():
             auto_process = baker.make(Checks, timeseries_group=self.timeseries_group)
             auto_process.save()
-        tasks.execute_auto_process.delay.assert_any_call(auto_process.id)
+        tasks.execute_auto_process.apply_async.assert_any_call(
+            args=[auto_process.id], countdown=10
+        )
 
     def test_auto_process_is_not_triggered_before_commit(self):
         with transaction.atomic():
             auto_process = baker.make(Checks, timeseries_group=self.timeseries_group)
             auto_process.save()
-            tasks.execute_auto_process.delay.assert_not_called()
+            tasks.execute_auto_process.apply_async.assert_not_called()
 
 
 @mock.patch(
@@ -2,7 +2,7 @@ import datetime as dt
 from unittest import mock
 
 from django.db import DataError
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 import numpy as np
 import pandas as pd
@@ -16,7 +16,9 @@ from enhydris.autoprocess.models import (
     RateOfChangeCheck,
     RateOfChangeThreshold,
 )
+from enhydris.flags import compact_flags
 from enhydris.models import Station, Timeseries, TimeseriesGroup
+from enhydris.tests import ClearCacheMixin
 
 
 class ChecksTestCase(TestCase):
@@ -253,6 +255,29 @@ class RangeCheckProcessTimeseriesTestCase(TestCase):
         )
         pd.testing.assert_frame_equal(result, expected_result)
 
+    @override_settings(ENHYDRIS_COMPACT_FLAGS=True)
+    def test_execute_with_compact_flags(self):
+        self.range_check = baker.make(
+            RangeCheck,
+            lower_bound=2,
+            upper_bound=5,
+            soft_lower_bound=3,
+            soft_upper_bound=4,
+        )
+        source_timeseries = compact_flags(
+            self._get_dataframe(
+                [1.5, 2.9, 3.1, np.nan, 3.8, 4.9, 7.2],
+                ["", "", "", "", "FLAG1", "FLAG2", "FLAG3"],
+            )
+        )
+        self.range_check.checks._htimeseries = HTimeseries(source_timeseries)
+        result = self.range_check.checks.process_timeseries()
+        self.assertIsInstance(result["flags"].dtype, pd.CategoricalDtype)
+        self.assertEqual(
+            list(result["flags"]),
+            ["RANGE", "SUSPECT", "", "", "FLAG1", "FLAG2 SUSPECT", "FLAG3 RANGE"],
+        )
+
 
 class RateOfChangeCheckTestCase(TestCase):
     def _baker_make_rate_of_change_check(self):
@@ -413,3 +438,93 @@ class RateOfChangeCheckProcessTimeseriesTestCase(TestCase):
         pd.testing.assert_frame_equal(
             result, self.expected_result_without_remove_failing_values
         )
+
+
+class RateOfChangeCheckWithoutFailuresTestCase(TestCase):
+    def setUp(self):
+        self.roc_check = baker.make(RateOfChangeCheck, remove_failing_values=True)
+        self.roc_check.set_thresholds("10min\t20.0\n")
+        source_timeseries = (
+            RateOfChangeCheckProcessTimeseriesTestCase.source_timeseries.copy()
+        )
+        source_timeseries.loc[:, "flags"] = "TEMPORAL"
+        self.roc_check.checks._htimeseries = HTimeseries(source_timeseries)
+        self.source_timeseries = source_timeseries.copy()
+
+    @mock.patch("enhydris.autoprocess.models.rocc")
+    def test_does_not_run_rocc(self, m):
+        self.roc_check.checks.process_timeseries()
+        m.assert_not_called()
+
+    def test_leaves_records_with_existing_flags_alone(self):
+        result = self.roc_check.checks.process_timeseries()
+        pd.testing.assert_frame_equal(result, self.source_timeseries)
+
+
+class ChecksProcessTimeseriesQueriesTestCase(TestCase):
+    def setUp(self):
+        self.checks = baker.make(Checks)
+        baker.make(RangeCheck, checks=self.checks, upper_bound=5, lower_bound=2)
+        roc_check = baker.make(RateOfChangeCheck, checks=self.checks)
+        roc_check.set_thresholds("10min\t7.0\n")
+        self.checks = Checks.objects.get(id=self.checks.id)
+        self.checks._htimeseries = HTimeseries(
+            RateOfChangeCheckProcessTimeseriesTestCase.source_timeseries.copy()
+        )
+
+    def test_checks_and_thresholds_are_loaded_once(self):
+        with self.assertNumQueries(3):
+            self.checks.process_timeseries()
+        with self.assertNumQueries(0):
+            self.checks.process_timeseries()
+
+
+class ChecksLookBackTestCase(TestCase):
+    def setUp(self):
+        self.checks = baker.make(Checks)
+        baker.make(RangeCheck, checks=self.checks)
+
+    def test_look_back_without_rate_of_change_check(self):
+        self.assertEqual(self.checks.look_back, dt.timedelta(0))
+
+    def test_look_back_with_rate_of_change_check(self):
+        roc_check = baker.make(RateOfChangeCheck, checks=self.checks)
+        roc_check.set_thresholds("10min\t25.0\n1h\t35.0\n")
+        self.assertEqual(self.checks.look_back, dt.timedelta(hours=1))
+
+
+class ChecksExecuteInWindowsTestCase(ClearCacheMixin, TestCase):
+    roc_test_case = RateOfChangeCheckProcessTimeseriesTestCase
+
+    def setUp(self):
+        station = baker.make(Station, display_timezone="UTC")
+        self.roc_check = baker.make(
+            RateOfChangeCheck,
+            checks__timeseries_group__gentity=station,
+            checks__timeseries_group__variable__descr="Temperature",
+            remove_failing_values=True,
+        )
+        self.roc_check.set_thresholds("10min\t7.0\n")
+        self.checks = self.roc_check.checks
+        source_timeseries = baker.make(
+            Timeseries,
+            timeseries_group=self.checks.timeseries_group,
+            type=Timeseries.INITIAL,
+        )
+        source_timeseries.set_data(
+            self.roc_test_case.source_timeseries.copy(), default_timezone="UTC"
+        )
+
+    @mock.patch.object(Checks, "WINDOW_SIZE", dt.timedelta(minutes=20))
+    @mock.patch("enhydris.models.Timeseries.append_data")
+    def test_appends_each_window(self, m):
+        self.checks.execute()
+        self.assertEqual(m.call_count, 3)
+
+    @mock.patch.object(Checks, "WINDOW_SIZE", dt.timedelta(minutes=20))
+    def test_result_is_same_as_when_checking_all_at_once(self):
+        self.checks.execute()
+        result = self.checks.target_timeseries.get_data().data
+        expected_result = self.roc_test_case.expected_result_with_remove_failing_values
+        np.testing.assert_array_equal(result["value"], expected_result["value"])
+        self.assertEqual(list(result["flags"]), list(expected_result["flags"]))
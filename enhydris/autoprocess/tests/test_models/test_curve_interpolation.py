@@ -1,6 +1,7 @@
 import datetime as dt
 import textwrap
 
+from django.core.cache import cache
 from django.test import TestCase
 
 import numpy as np
@@ -10,6 +11,7 @@ from model_bakery import baker
 
 from enhydris.autoprocess.models import CurveInterpolation, CurvePeriod, CurvePoint
 from enhydris.models import Station, Timeseries, TimeseriesGroup
+from enhydris.tests import ClearCacheMixin
 from enhydris.tests.test_models.test_timeseries import get_tzinfo
 
 
@@ -292,3 +294,63 @@ class CurveInterpolationProcessTimeseriesTestCase(TestCase):
             start_date=start_date,
             end_date=end_date,
         )
+
+
+class CurveInterpolationCurvesCacheTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        station = baker.make(Station)
+        self.curve_interpolation = baker.make(
+            CurveInterpolation,
+            timeseries_group__gentity=station,
+            target_timeseries_group__gentity=station,
+        )
+        self.period = baker.make(
+            CurvePeriod,
+            curve_interpolation=self.curve_interpolation,
+            start_date=dt.date(2019, 5, 1),
+            end_date=dt.date(2019, 5, 31),
+        )
+        self.period.set_curve("3,100\n5,200")
+        self.curve_interpolation._htimeseries = HTimeseries(
+            pd.DataFrame(
+                data={"value": [4.0], "flags": [""]},
+                columns=["value", "flags"],
+                index=[dt.datetime(2019, 5, 21, 10, 20, tzinfo=dt.timezone.utc)],
+            )
+        )
+
+    def _process(self):
+        return list(self.curve_interpolation.process_timeseries()["value"])
+
+    def test_result(self):
+        self.assertEqual(self._process(), [150])
+
+    def test_loads_curves_with_one_query(self):
+        with self.assertNumQueries(1):
+            self._process()
+
+    def test_does_not_load_curves_again(self):
+        self._process()
+        with self.assertNumQueries(0):
+            self._process()
+
+    def test_reloads_curves_when_points_change(self):
+        self._process()
+        self.period.set_curve("3,200\n5,300")
+        self.assertEqual(self._process(), [250])
+
+    def test_reloads_curves_when_period_changes(self):
+        self._process()
+        self.period.start_date = dt.date(2019, 5, 22)
+        self.period.save()
+        self.assertTrue(np.isnan(self._process()[0]))
+
+    def test_reloads_curves_cached_before_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.period.set_curve("3,200\n5,300")
+            # Another process might load and cache the old curves at this point
+            cache.set(
+                CurveInterpolation.get_curves_cache_key(self.curve_interpolation.id),
+                "stale curves",
+            )
+        self.assertEqual(self._process(), [250])
@@ -0,0 +1,172 @@
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+
+import pandas as pd
+from model_bakery import baker
+
+from enhydris.autoprocess.models import AutoProcess, Checks, RangeCheck
+from enhydris.autoprocess.profiling import Profile, dry_run, record, stage
+from enhydris.models import Station, Timeseries
+from enhydris.tests import ClearCacheMixin
+
+User = get_user_model()
+
+
+class StageTestCase(SimpleTestCase):
+    def setUp(self):
+        self.data = pd.DataFrame({"value": [1.0, 2.0, 3.0]})
+
+    def test_stage_is_not_recorded_without_profile(self):
+        with Profile() as profile:
+            pass
+        with stage("regularize", rows_in=self.data):
+            pass
+        self.assertEqual(profile.stages, [])
+
+    def test_rows(self):
+        with Profile() as profile:
+            with stage("regularize", rows_in=self.data) as s:
+                s.set_output(self.data.iloc[:2])
+        self.assertEqual(
+            (profile.stages[0].rows_in, profile.stages[0].rows_out), (3, 2)
+        )
+
+    def test_memory_is_not_traced_by_default(self):
+        with Profile() as profile:
+            with stage("regularize"):
+                pass
+        self.assertIsNone(profile.stages[0].memory_peak)
+
+    def test_memory_peak(self):
+        with Profile(trace_memory=True) as profile:
+            with stage("regularize"):
+                data = list(range(100000))  # NOQA
+        self.assertGreater(profile.stages[0].memory_peak, 1000000)
+
+    def test_stages_with_the_same_name_are_merged(self):
+        with Profile() as profile:
+            for i in range(2):
+                with stage("fetch source") as s:
+                    s.set_output(self.data)
+        summary = profile.get_summary()
+        self.assertEqual([(s.name, s.rows_out) for s in summary], [("fetch source", 6)])
+
+
+@mock.patch("enhydris.autoprocess.profiling.logging")
+class RecordTestCase(SimpleTestCase):
+    def _execute(self):
+        with record(42):
+            with stage("regularize"):
+                pass
+
+    def test_not_recorded_by_default(self, m):
+        self._execute()
+        m.getLogger.return_value.info.assert_not_called()
+
+    @override_settings(ENHYDRIS_AUTOPROCESS_PROFILE=True)
+    def test_recorded(self, m):
+        self._execute()
+        message = m.getLogger.return_value.info.call_args.args[0]
+        self.assertTrue(message.startswith("AutoProcess with id=42 executed in "))
+        self.assertIn("regularize", message)
+
+
+class DryRunMixin(ClearCacheMixin):
+    def _create_checks(self):
+        self.station = baker.make(Station, name="Hobbiton")
+        self.checks = baker.make(
+            Checks, timeseries_group__gentity=self.station, timeseries_group__name="h"
+        )
+        baker.make(RangeCheck, checks=self.checks, lower_bound=0, upper_bound=5)
+        self.checks.source_timeseries.append_data(
+            StringIO("2019-05-21 10:00,1,\n2019-05-21 10:10,7,\n"),
+            default_timezone="Etc/GMT-2",
+        )
+
+    def _get_checked_timeseries(self):
+        return Timeseries.objects.filter(
+            timeseries_group=self.checks.timeseries_group, type=Timeseries.CHECKED
+        )
+
+
+class DryRunTestCase(DryRunMixin, TestCase):
+    def setUp(self):
+        self._create_checks()
+        self.profile = dry_run(Checks.objects.get(id=self.checks.id))
+
+    def test_stages(self):
+        self.assertEqual(
+            [(s.name, s.rows_in, s.rows_out) for s in self.profile.get_summary()],
+            [("fetch source", None, 2), ("RangeCheck", 2, 2)],
+        )
+
+    def test_nothing_is_appended(self):
+        self.assertFalse(self._get_checked_timeseries().exists())
+
+
+class ProfileAutoProcessCommandTestCase(DryRunMixin, TestCase):
+    def setUp(self):
+        self._create_checks()
+        self.stdout = StringIO()
+        call_command("profile_autoprocess", str(self.checks.id), stdout=self.stdout)
+
+    def test_output(self):
+        lines = self.stdout.getvalue().splitlines()
+        self.assertEqual(lines[0], f"Checks for h (id={self.checks.id})")
+        self.assertTrue(lines[3].startswith("RangeCheck "))
+
+    def test_nothing_is_appended(self):
+        self.assertFalse(self._get_checked_timeseries().exists())
+
+
+class ProfileAutoProcessAdminActionMixin(DryRunMixin):
+    def setUp(self):
+        self._create_checks()
+        User.objects.create_superuser("alice", password="topsecret")
+        self.client.login(username="alice", password="topsecret")
+
+    def _post(self):
+        return self.client.post(
+            "/admin/enhydris/station/",
+            {"action": "profile_auto_process", "_selected_action": [self.station.id]},
+            follow=True,
+        )
+
+
+class ProfileAutoProcessAdminActionTestCase(
+    ProfileAutoProcessAdminActionMixin, TestCase
+):
+    def setUp(self):
+        super().setUp()
+        self.response = self._post()
+
+    def test_message(self):
+        messages = [str(m) for m in self.response.context["messages"]]
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0].startswith("Checks for h: "))
+        self.assertIn("RangeCheck", messages[0])
+
+    def test_nothing_is_appended(self):
+        self.assertFalse(self._get_checked_timeseries().exists())
+
+
+class ProfileAutoProcessAdminActionManyTestCase(
+    ProfileAutoProcessAdminActionMixin, TestCase
+):
+    def setUp(self):
+        super().setUp()
+        baker.make(AutoProcess, timeseries_group=self.checks.timeseries_group)
+        with mock.patch("enhydris.autoprocess.admin.dry_run") as self.mock_dry_run:
+            self.response = self._post()
+
+    def test_message(self):
+        messages = [str(m) for m in self.response.context["messages"]]
+        self.assertEqual(len(messages), 1)
+        self.assertIn("exactly one auto-process", messages[0])
+
+    def test_nothing_is_executed(self):
+        self.mock_dry_run.assert_not_called()
@@ -0,0 +1,326 @@
+import datetime as dt
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from model_bakery import baker
+
+from enhydris.autoprocess import scheduler
+from enhydris.autoprocess.models import (
+    Aggregation,
+    AutoProcessShard,
+    Checks,
+    CurveInterpolation,
+    CurvePeriod,
+)
+from enhydris.autoprocess.scheduler import AutoProcessGraph
+from enhydris.models import Station, Timeseries, TimeseriesGroup
+from enhydris.tests import ClearCacheMixin
+
+
+class AutoProcessPipelineMixin(ClearCacheMixin):
+    """Create checks => aggregation and checks => curve interpolation => checks."""
+
+    def _create_auto_processes(self):
+        self.group1 = baker.make(TimeseriesGroup)
+        self.group2 = baker.make(TimeseriesGroup)
+        self.checks1 = baker.make(Checks, timeseries_group=self.group1)
+        self.aggregation = baker.make(
+            Aggregation,
+            timeseries_group=self.group1,
+            target_time_step="1h",
+            method="sum",
+        )
+        self.curve_interpolation = baker.make(
+            CurveInterpolation,
+            timeseries_group=self.group1,
+            target_timeseries_group=self.group2,
+        )
+        self.checks2 = baker.make(Checks, timeseries_group=self.group2)
+
+    def _get_enqueued_ids(self, m):
+        return [c.kwargs["args"][0] for c in m.apply_async.call_args_list]
+
+
+class AutoProcessGraphTestCase(AutoProcessPipelineMixin, TestCase):
+    def setUp(self):
+        self._create_auto_processes()
+        self.graph = AutoProcessGraph.get()
+
+    def test_downstream_of_checks(self):
+        self.assertCountEqual(
+            self.graph.downstream[self.checks1.id],
+            [self.aggregation.id, self.curve_interpolation.id],
+        )
+
+    def test_downstream_of_curve_interpolation(self):
+        self.assertEqual(
+            self.graph.downstream[self.curve_interpolation.id], [self.checks2.id]
+        )
+
+    def test_downstream_of_aggregation(self):
+        self.assertEqual(self.graph.downstream[self.aggregation.id], [])
+
+    def test_upstream_of_checks(self):
+        self.assertEqual(self.graph.upstream[self.checks1.id], [])
+
+    def test_upstream_of_curve_interpolation(self):
+        self.assertEqual(
+            self.graph.upstream[self.curve_interpolation.id], [self.checks1.id]
+        )
+
+    def test_triggered_auto_processes(self):
+        timeseries = baker.prepare(
+            Timeseries, timeseries_group=self.group1, type=Timeseries.INITIAL
+        )
+        self.assertEqual(
+            self.graph.get_triggered_auto_processes(timeseries), [self.checks1.id]
+        )
+
+    def test_auto_processes_with_upstream_are_not_triggered(self):
+        timeseries = baker.prepare(
+            Timeseries, timeseries_group=self.group2, type=Timeseries.INITIAL
+        )
+        self.assertEqual(self.graph.get_triggered_auto_processes(timeseries), [])
+
+    def test_source_is_initial_if_there_are_no_checks(self):
+        self.checks1.delete()
+        graph = AutoProcessGraph.get()
+        self.assertEqual(graph.upstream[self.aggregation.id], [])
+
+    def test_source_is_checked_if_there_is_a_checked_timeseries(self):
+        group = baker.make(TimeseriesGroup)
+        baker.make(Timeseries, timeseries_group=group, type=Timeseries.CHECKED)
+        aggregation = baker.make(
+            Aggregation, timeseries_group=group, target_time_step="1h", method="sum"
+        )
+        timeseries = baker.prepare(
+            Timeseries, timeseries_group=group, type=Timeseries.CHECKED
+        )
+        graph = AutoProcessGraph.get()
+        self.assertEqual(
+            graph.get_triggered_auto_processes(timeseries), [aggregation.id]
+        )
+        self.assertEqual(aggregation.source_timeseries.type, Timeseries.CHECKED)
+
+    def test_graph_is_updated_when_auto_process_is_added(self):
+        checks3 = baker.make(Checks, timeseries_group=baker.make(TimeseriesGroup))
+        self.curve_interpolation.target_timeseries_group = checks3.timeseries_group
+        self.curve_interpolation.save()
+        graph = AutoProcessGraph.get()
+        self.assertEqual(graph.downstream[self.curve_interpolation.id], [checks3.id])
+
+    @mock.patch("enhydris.autoprocess.scheduler.tasks")
+    def test_graph_cached_before_commit_is_invalidated(self, m):
+        with self.captureOnCommitCallbacks(execute=True):
+            checks3 = baker.make(Checks, timeseries_group=baker.make(TimeseriesGroup))
+            self.curve_interpolation.target_timeseries_group = checks3.timeseries_group
+            self.curve_interpolation.save()
+            # Another process might rebuild and cache the old graph at this point
+            cache.set(scheduler.GRAPH_CACHE_KEY, self.graph)
+        graph = AutoProcessGraph.get()
+        self.assertEqual(graph.downstream[self.curve_interpolation.id], [checks3.id])
+
+
+@mock.patch("enhydris.autoprocess.scheduler.tasks.execute_auto_process")
+class ScheduleAutoProcessTestCase(AutoProcessPipelineMixin, TestCase):
+    def setUp(self):
+        self._create_auto_processes()
+
+    def test_enqueues_auto_process(self, m):
+        with self.captureOnCommitCallbacks(execute=True):
+            scheduler.schedule_auto_process(self.checks1.id)
+        self.assertEqual(self._get_enqueued_ids(m), [self.checks1.id])
+
+    def test_merges_runs_of_queued_auto_process(self, m):
+        with self.captureOnCommitCallbacks(execute=True):
+            scheduler.schedule_auto_process(self.checks1.id)
+            scheduler.schedule_auto_process(self.checks1.id)
+        self.assertEqual(self._get_enqueued_ids(m), [self.checks1.id])
+
+    def test_defers_auto_process_while_upstream_is_queued(self, m):
+        with self.captureOnCommitCallbacks(execute=True):
+            scheduler.schedule_auto_process(self.checks1.id)
+            scheduler.schedule_auto_process(self.aggregation.id)
+        self.assertEqual(self._get_enqueued_ids(m), [self.checks1.id])
+
+
+@mock.patch("enhydris.autoprocess.scheduler.tasks.execute_auto_process")
+class ExecuteScheduledAutoProcessTestCase(AutoProcessPipelineMixin, TestCase):
+    def setUp(self):
+        self._create_auto_processes()
+
+    def _execute(self, appended):
+        with mock.patch.object(Checks, "execute", return_value=appended):
+            with self.captureOnCommitCallbacks(execute=True):
+                scheduler.execute_scheduled_auto_process(self.checks1.id)
+
+    def test_schedules_downstream_if_data_was_appended(self, m):
+        self._execute(appended=3)
+        self.assertCountEqual(
+            self._get_enqueued_ids(m),
+            [self.aggregation.id, self.curve_interpolation.id],
+        )
+
+    def test_does_not_schedule_downstream_if_no_data_was_appended(self, m):
+        self._execute(appended=0)
+        m.apply_async.assert_not_called()
+
+    def test_schedules_deferred_downstream(self, m):
+        with self.captureOnCommitCallbacks(execute=True):
+            scheduler.schedule_auto_process(self.checks1.id)
+            scheduler.schedule_auto_process(self.aggregation.id)
+        m.reset_mock()
+        self._execute(appended=0)
+        self.assertEqual(self._get_enqueued_ids(m), [self.aggregation.id])
+
+    def test_does_not_execute_while_already_running(self, m):
+        cache.set(scheduler._get_running_key(self.checks1.id), True)
+        with mock.patch.object(Checks, "execute") as execute:
+            scheduler.execute_scheduled_auto_process(self.checks1.id)
+        execute.assert_not_called()
+
+    def test_executes_again_if_executed_while_running(self, m):
+        def execute_again():
+            scheduler.execute_scheduled_auto_process(self.checks1.id)
+            return 0
+
+        with mock.patch.object(Checks, "execute", side_effect=execute_again):
+            with self.captureOnCommitCallbacks(execute=True):
+                scheduler.execute_scheduled_auto_process(self.checks1.id)
+        self.assertEqual(self._get_enqueued_ids(m), [self.checks1.id])
+
+
+@mock.patch("enhydris.autoprocess.scheduler.tasks.execute_auto_process")
+class AggregationBatchTestCase(AutoProcessPipelineMixin, TestCase):
+    def setUp(self):
+        self._create_auto_processes()
+        self.aggregation2 = baker.make(
+            Aggregation,
+            timeseries_group=self.group1,
+            target_time_step="1D",
+            method="max",
+        )
+
+    def test_batch(self, m):
+        self.assertEqual(
+            AutoProcessGraph.get().batches[self.aggregation.id],
+            [self.aggregation.id, self.aggregation2.id],
+        )
+
+    def test_schedules_batch_leader(self, m):
+        with self.captureOnCommitCallbacks(execute=True):
+            scheduler.schedule_auto_process(self.aggregation2.id)
+        self.assertEqual(self._get_enqueued_ids(m), [self.aggregation.id])
+
+    def test_schedules_batch_once_when_upstream_appends_data(self, m):
+        with mock.patch.object(Checks, "execute", return_value=3):
+            with self.captureOnCommitCallbacks(execute=True):
+                scheduler.execute_scheduled_auto_process(self.checks1.id)
+        self.assertCountEqual(
+            self._get_enqueued_ids(m),
+            [self.aggregation.id, self.curve_interpolation.id],
+        )
+
+    def test_executes_batch(self, m):
+        with mock.patch.object(Aggregation, "execute_batch", return_value=0) as e:
+            scheduler.execute_scheduled_auto_process(self.aggregation.id)
+        self.assertEqual(
+            [x.id for x in e.call_args.args[0]],
+            [self.aggregation.id, self.aggregation2.id],
+        )
+
+
+@mock.patch.object(CurveInterpolation, "SHARD_SIZE", dt.timedelta(minutes=20))
+@mock.patch("enhydris.autoprocess.scheduler.tasks")
+class ShardedExecutionTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        station = baker.make(Station, display_timezone="Etc/GMT-2")
+        self.curve_interpolation = baker.make(
+            CurveInterpolation,
+            timeseries_group__gentity=station,
+            target_timeseries_group__gentity=station,
+        )
+        period = baker.make(
+            CurvePeriod,
+            curve_interpolation=self.curve_interpolation,
+            start_date=dt.date(2019, 5, 1),
+            end_date=dt.date(2019, 5, 31),
+        )
+        period.set_curve("0,0\n10,100")
+        self.curve_interpolation.source_timeseries.append_data(
+            StringIO(
+                "2019-05-21 10:00,1,\n"
+                "2019-05-21 10:10,2,\n"
+                "2019-05-21 10:20,3,\n"
+                "2019-05-21 10:30,4,\n"
+                "2019-05-21 10:40,5,\n"
+            ),
+            default_timezone="Etc/GMT-2",
+        )
+        self.running_key = scheduler._get_running_key(self.curve_interpolation.id)
+
+    def _execute(self, m):
+        scheduler.execute_scheduled_auto_process(self.curve_interpolation.id)
+        return [c.args for c in m.execute_auto_process_shard.delay.call_args_list]
+
+    def _get_target_values(self):
+        target_timeseries = self.curve_interpolation.target_timeseries
+        return list(target_timeseries.get_data().data["value"])
+
+    def test_enqueues_shards(self, m):
+        self.assertEqual(len(self._execute(m)), 3)
+
+    def test_holds_lock_while_shards_are_processed(self, m):
+        self._execute(m)
+        self.assertTrue(cache.get(self.running_key))
+
+    def test_does_not_append_before_all_shards_are_processed(self, m):
+        for args in self._execute(m)[1:]:
+            scheduler.execute_scheduled_auto_process_shard(*args)
+        self.assertEqual(self._get_target_values(), [])
+
+    def test_appends_shards_in_order(self, m):
+        for args in reversed(self._execute(m)):
+            scheduler.execute_scheduled_auto_process_shard(*args)
+        self.assertEqual(self._get_target_values(), [10, 20, 30, 40, 50])
+
+    def test_removes_shard_results_after_appending(self, m):
+        for args in self._execute(m):
+            scheduler.execute_scheduled_auto_process_shard(*args)
+        self.assertFalse(AutoProcessShard.objects.exists())
+
+    def test_refreshes_lock_after_each_shard(self, m):
+        shards = self._execute(m)
+        with mock.patch.object(scheduler.cache, "touch") as touch:
+            scheduler.execute_scheduled_auto_process_shard(*shards[0])
+        touch.assert_called_once_with(self.running_key, 3 * scheduler.RUNNING_TIMEOUT)
+
+    def test_appends_shards_if_cache_entries_have_expired(self, m):
+        shards = self._execute(m)
+        scheduler.execute_scheduled_auto_process_shard(*shards[0])
+        cache.clear()
+        for args in shards[1:]:
+            scheduler.execute_scheduled_auto_process_shard(*args)
+        self.assertEqual(self._get_target_values(), [10, 20, 30, 40, 50])
+
+    def test_releases_lock_after_last_shard(self, m):
+        for args in self._execute(m):
+            scheduler.execute_scheduled_auto_process_shard(*args)
+        self.assertIsNone(cache.get(self.running_key))
+
+    def test_releases_lock_if_shard_fails(self, m):
+        shards = self._execute(m)
+        with mock.patch.object(
+            CurveInterpolation, "process_timeseries", side_effect=ValueError
+        ):
+            with self.assertRaises(ValueError):
+                scheduler.execute_scheduled_auto_process_shard(*shards[0])
+        self.assertTrue(cache.get(self.running_key))
+        for args in shards[1:]:
+            scheduler.execute_scheduled_auto_process_shard(*args)
+        self.assertIsNone(cache.get(self.running_key))
+        self.assertEqual(self._get_target_values(), [])
+        self.assertFalse(AutoProcessShard.objects.exists())
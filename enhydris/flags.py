@@ -0,0 +1,73 @@
+"""Handling of the flags column of time series data.
+
+The flags of a record are a string of space-separated words. In a dataframe the
+"flags" column normally has object dtype, i.e. each record has its own Python string.
+If ENHYDRIS_COMPACT_FLAGS is set, the column is categorical instead: each distinct
+flags string is stored once and each record only has a small integer code. Since
+most records have no flags, or one of very few combinations of them, this takes a
+fraction of the memory. The categories always start with KNOWN_FLAGS, so that these
+have the same codes in all dataframes.
+
+The functions here work with both kinds of column. The text form is only needed
+when the data is exported; use get_text_flags() for that.
+"""
+
+from django.conf import settings
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+KNOWN_FLAGS = ("", "RANGE", "SUSPECT", "TEMPORAL", "DATEINSERT")
+
+
+def compact_flags_enabled():
+    return getattr(settings, "ENHYDRIS_COMPACT_FLAGS", False)
+
+
+def compact_flags(data):
+    """Make the flags column of the dataframe categorical, if so configured.
+
+    The dataframe is modified in place and returned.
+    """
+    if compact_flags_enabled() and not isinstance(
+        data["flags"].dtype, pd.CategoricalDtype
+    ):
+        flags = data["flags"].fillna("")
+        other_flags = sorted(set(flags.unique()) - set(KNOWN_FLAGS))
+        data["flags"] = pd.Categorical(flags, categories=[*KNOWN_FLAGS, *other_flags])
+    return data
+
+
+def get_text_flags(data):
+    """Return the flags of the dataframe as an array of strings."""
+    return data["flags"].astype(object).fillna("").to_numpy()
+
+
+def add_flag(data, mask, flag):
+    """Add flag to the flags of the records of the dataframe selected by mask."""
+    flags = data.loc[mask, "flags"].astype(object)
+    new_flags = flags.where(flags == "", flags + " ") + flag
+    if isinstance(data["flags"].dtype, pd.CategoricalDtype):
+        categories = data["flags"].cat.categories
+        data["flags"] = data["flags"].cat.add_categories(
+            sorted(set(new_flags.unique()) - set(categories))
+        )
+    data.loc[mask, "flags"] = new_flags
+
+
+def concat_data(frames):
+    """Concatenate dataframes, keeping their flags categorical if they are.
+
+    pd.concat() results in an object column unless the categories of all
+    dataframes are the same, so we make them the same first.
+    """
+    if len(frames) > 1 and all(
+        isinstance(x["flags"].dtype, pd.CategoricalDtype) for x in frames
+    ):
+        categories = union_categoricals(
+            [x["flags"] for x in frames], ignore_order=True
+        ).categories
+        frames = [
+            x.assign(flags=x["flags"].cat.set_categories(categories)) for x in frames
+        ]
+    return pd.concat(frames)
@@ -7,6 +7,8 @@ DOWNLOAD_FORMATS = [
     ("csv", "CSV"),
     ("hts2", "Hydrognomon 4"),
     ("hts", _("Latest HTS")),
+    ("parquet", "Parquet"),
+    ("arrow", "Arrow"),
 ]
 
 
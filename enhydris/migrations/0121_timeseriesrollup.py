@@ -0,0 +1,98 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+backfill_sql = """
+    INSERT INTO enhydris_timeseriesrollup
+        (timeseries_id, level, timestamp, count, min, max, sum)
+    SELECT
+        timeseries_id,
+        'hour',
+        DATE_TRUNC('hour', timestamp AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS period,
+        COUNT(*),
+        MIN(value),
+        MAX(value),
+        SUM(value)
+    FROM enhydris_timeseriesrecord
+    WHERE value IS NOT NULL
+    GROUP BY timeseries_id, period;
+
+    INSERT INTO enhydris_timeseriesrollup
+        (timeseries_id, level, timestamp, count, min, max, sum)
+    SELECT
+        timeseries_id,
+        'day',
+        DATE_TRUNC('day', timestamp AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS period,
+        SUM(count),
+        MIN(min),
+        MAX(max),
+        SUM(sum)
+    FROM enhydris_timeseriesrollup
+    WHERE level = 'hour'
+    GROUP BY timeseries_id, period;
+
+    INSERT INTO enhydris_timeseriesrollup
+        (timeseries_id, level, timestamp, count, min, max, sum)
+    SELECT
+        timeseries_id,
+        'month',
+        DATE_TRUNC('month', timestamp AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS period,
+        SUM(count),
+        MIN(min),
+        MAX(max),
+        SUM(sum)
+    FROM enhydris_timeseriesrollup
+    WHERE level = 'day'
+    GROUP BY timeseries_id, period;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("enhydris", "0120_remove_gpoint_original_srid"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TimeseriesRollup",
+            fields=[
+                (
+                    "pk",
+                    models.CompositePrimaryKey(
+                        "timeseries_id",
+                        "level",
+                        "timestamp",
+                        blank=True,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                (
+                    "level",
+                    models.CharField(
+                        choices=[("hour", "hour"), ("day", "day"), ("month", "month")],
+                        max_length=5,
+                        verbose_name="Level",
+                    ),
+                ),
+                ("timestamp", models.DateTimeField(verbose_name="Timestamp")),
+                ("count", models.IntegerField()),
+                ("min", models.FloatField()),
+                ("max", models.FloatField()),
+                ("sum", models.FloatField()),
+                (
+                    "timeseries",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="enhydris.timeseries",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Time series rollup",
+                "verbose_name_plural": "Time series rollups",
+            },
+        ),
+        migrations.RunSQL(backfill_sql, reverse_sql=""),
+    ]
@@ -12,7 +12,13 @@ from .gentity import (
     Station,
 )
 from .lentity import Lentity, Organization, Person
-from .timeseries import Timeseries, TimeseriesRecord, TimeseriesStorage, check_time_step
+from .timeseries import (
+    Timeseries,
+    TimeseriesRecord,
+    TimeseriesRollup,
+    TimeseriesStorage,
+    check_time_step,
+)
 from .timeseries_group import TimeseriesGroup, UnitOfMeasurement, Variable
 
 __all__ = (
@@ -31,6 +37,7 @@ __all__ = (
     "Person",
     "Timeseries",
     "TimeseriesRecord",
+    "TimeseriesRollup",
     "TimeseriesStorage",
     "check_time_step",
     "TimeseriesGroup",
@@ -1,4 +1,5 @@
 import datetime as dt
+from collections import defaultdict
 from io import StringIO
 from itertools import islice
 from os.path import abspath
@@ -8,14 +9,18 @@ from django.conf import settings
 from django.contrib.gis.db import models
 from django.core.cache import cache
 from django.core.files.storage import FileSystemStorage
-from django.db import IntegrityError, connection
-from django.utils.timezone import now
+from django.db import IntegrityError, connection, transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils.timezone import get_current_timezone, now
 from django.utils.translation import gettext_lazy as _
 from django.utils.translation import pgettext_lazy
 
 import numpy as np
+import pandas as pd
 from htimeseries import HTimeseries
 
+from enhydris.flags import compact_flags, concat_data, get_text_flags
+
 from .gentity import Station
 from .timeseries_group import TimeseriesGroup
 
@@ -60,8 +65,144 @@ class TimeseriesStorage(FileSystemStorage):
         return super().path(name)
 
 
-class DataNotInCache(Exception):
-    pass
+class TimeseriesDataCache:
+    """Caches the data of a time series in blocks of one year.
+
+    Each block is a dataframe with the records of one (UTC) year, stored under
+    "timeseries_data_{id}_{year}", so that blocks are retrieved from the database and
+    evicted from the cache independently. The key "timeseries_data_{id}" contains the
+    index, a dictionary that maps each year whose data is known to whether it has a
+    block (years without records don't have one). A block is only used if it is listed
+    in the index; so, to invalidate the cache, it is enough to delete the index. The
+    index is only written back if it hasn't changed since it was read; otherwise
+    another process may have invalidated the cache, so it is deleted instead.
+    """
+
+    def __init__(self, timeseries):
+        self.timeseries = timeseries
+        self.index_key = f"timeseries_data_{timeseries.id}"
+
+    def get_data(self, start_date, end_date):
+        start_date = start_date.astimezone(dt.timezone.utc)
+        end_date = end_date.astimezone(dt.timezone.utc)
+        years = range(start_date.year, end_date.year + 1)
+        self._read_index()
+        self.index_has_changed = False
+        blocks = self._get_cached_blocks(years)
+        missing_years = [year for year in years if year not in self.index]
+        for first_year, last_year in self._get_runs(missing_years):
+            blocks.update(self._retrieve_and_cache_blocks(first_year, last_year))
+        if self.index_has_changed:
+            self._write_index()
+        return self._join_blocks(blocks).loc[start_date:end_date]
+
+    def get_cached_data(self, start_date, end_date):
+        """Like get_data(), but return None if not all data is in the cache."""
+        start_date = start_date.astimezone(dt.timezone.utc)
+        end_date = end_date.astimezone(dt.timezone.utc)
+        years = range(start_date.year, end_date.year + 1)
+        self._read_index()
+        if any(year not in self.index for year in years):
+            return None
+        blocks = self._get_cached_blocks(years)
+        if any(year not in self.index for year in years):
+            self._write_index()
+            return None
+        return self._join_blocks(blocks).loc[start_date:end_date]
+
+    def _read_index(self):
+        self.original_index = cache.get(self.index_key)
+        self.index = dict(self.original_index or {})
+
+    def _write_index(self):
+        # There is a small window between the get() and the set(), but the cache
+        # doesn't offer compare-and-set, and this is enough to not undo an
+        # invalidation that happened while we were working with the index.
+        if cache.get(self.index_key) == self.original_index:
+            cache.set(self.index_key, self.index)
+        else:
+            cache.delete(self.index_key)
+
+    def _get_block_key(self, year):
+        return f"{self.index_key}_{year}"
+
+    def _get_cached_blocks(self, years):
+        keys = {
+            self._get_block_key(year): year for year in years if self.index.get(year)
+        }
+        result = {keys[key]: block for key, block in cache.get_many(keys).items()}
+        for year in keys.values():
+            if year not in result:
+                # The block has been evicted; it needs to be retrieved again.
+                del self.index[year]
+        return result
+
+    def _get_runs(self, years):
+        """Group a sorted list of years into (first_year, last_year) runs."""
+        runs = []
+        for year in years:
+            if runs and runs[-1][1] == year - 1:
+                runs[-1][1] = year
+            else:
+                runs.append([year, year])
+        return runs
+
+    def _retrieve_and_cache_blocks(self, first_year, last_year):
+        data = self.timeseries._retrieve_data(
+            dt.datetime(first_year, 1, 1, tzinfo=dt.timezone.utc),
+            dt.datetime(last_year, 12, 31, 23, 59, 59, 999999, tzinfo=dt.timezone.utc),
+        )
+        blocks = {int(year): block for year, block in data.groupby(data.index.year)}
+        cache.set_many({self._get_block_key(y): block for y, block in blocks.items()})
+        for year in range(first_year, last_year + 1):
+            self.index[year] = year in blocks
+        self.index_has_changed = True
+        return blocks
+
+    def append(self, data):
+        """Add records that have just been appended to the time series.
+
+        The records must be later than all records already in the time series. Only
+        the years already in the index are updated; other years are left to be
+        retrieved by get_data() when needed. A block may already contain the records,
+        if another process retrieved it after they were committed; so records that
+        are not later than the block's last record are skipped.
+        """
+        self._read_index()
+        if not self.index:
+            return
+        data = self._get_normalized_dataframe(data)
+        years = [int(year) for year in data.index.year.unique()]
+        keys = {self._get_block_key(y): y for y in years if self.index.get(y)}
+        old_blocks = {keys[key]: block for key, block in cache.get_many(keys).items()}
+        new_blocks = {}
+        for year, records in data.groupby(data.index.year):
+            year = int(year)
+            if year not in self.index:
+                continue
+            elif self.index[year] and year not in old_blocks:
+                del self.index[year]  # Evicted
+                continue
+            elif self.index[year]:
+                old_block = old_blocks[year]
+                if len(old_block):
+                    records = records.loc[records.index > old_block.index[-1]]
+                records = concat_data([old_block, records])
+            new_blocks[self._get_block_key(year)] = records
+            self.index[year] = True
+        cache.set_many(new_blocks)
+        self._write_index()
+
+    def _get_normalized_dataframe(self, data):
+        result = data[["value", "flags"]].astype({"value": np.float64})
+        result.index = result.index.tz_convert(dt.timezone.utc)
+        result.index.name = "date"
+        return compact_flags(result.sort_index())
+
+    def _join_blocks(self, blocks):
+        if not blocks:
+            return compact_flags(HTimeseries().data)
+        return concat_data([blocks[year] for year in sorted(blocks)])
 
 
 def get_default_publicly_available():
@@ -206,13 +347,14 @@ class Timeseries(models.Model):
         else:
             return f"{sign}{timezone[8:]}00"
 
-    def get_data(self, start_date=None, end_date=None, timezone=None):
+    def _get_date_bounds(self, start_date, end_date):
         start_date = start_date or dt.datetime(1678, 1, 1, 0, 0, tzinfo=dt.timezone.utc)
         end_date = end_date or dt.datetime(2261, 12, 31, 23, 59, tzinfo=dt.timezone.utc)
-        try:
-            data = self._get_data_from_cache(start_date, end_date)
-        except DataNotInCache:
-            data = self._retrieve_and_cache_data(start_date, end_date)
+        return start_date, end_date
+
+    def get_data(self, start_date=None, end_date=None, timezone=None):
+        start_date, end_date = self._get_date_bounds(start_date, end_date)
+        data = TimeseriesDataCache(self).get_data(start_date, end_date)
         timezone = timezone or self.timeseries_group.gentity.display_timezone
         if not data.empty:
             data.index = data.index.tz_convert(timezone)
@@ -220,62 +362,367 @@ class Timeseries(models.Model):
         self._set_extra_timeseries_properties(result, timezone)
         return result
 
-    def _get_data_from_cache(self, start_date, end_date):
-        data = cache.get(f"timeseries_data_{self.id}")
-        if data is None or data.empty:
-            raise DataNotInCache()
-        if self.start_date is None:
-            return data  # Data should be empty in that case; just return it
-        try:
-            start_date = max(start_date, self.start_date).astimezone(data.index.tzinfo)
-            end_date = min(end_date, self.end_date).astimezone(data.index.tzinfo)
-        except TypeError:
-            # A TypeError will occur if self.start_date or self.end_date above is none.
-            # This should normally not happen, because self.start_date had already
-            # been checked immediately before, and self.end_date is not none whenever
-            # self.start_date is not none. However there's a race condition where
-            # another thread or process could have updated the time series (and
-            # invalidated the cache) in between these statements.
-            raise DataNotInCache()
-        if data.index.min() > start_date or data.index.max() < end_date:
-            raise DataNotInCache()
-        return data.loc[start_date:end_date]
-
-    def _retrieve_and_cache_data(self, start_date, end_date):
+    @classmethod
+    def get_end_dates(cls, timeseries_list):
+        """Return a dictionary that maps the id of each time series to its end_date.
+
+        The result is the same as getting the end_date of each time series, but
+        those that are not cached are retrieved with a single query.
+        """
+        keys = {f"timeseries_end_date_{t.id}": t for t in timeseries_list}
+        cached = cache.get_many(keys)
+        result = {keys[key]: end_date for key, end_date in cached.items()}
+        missing = [t for key, t in keys.items() if key not in cached]
+        if missing:
+            last_timestamps = dict(
+                cls.objects.filter(id__in=[t.id for t in missing])
+                .annotate(
+                    last_timestamp=Subquery(
+                        TimeseriesRecord.objects.filter(timeseries_id=OuterRef("id"))
+                        .order_by("-timestamp")
+                        .values("timestamp")[:1]
+                    )
+                )
+                .values_list("id", "last_timestamp")
+            )
+            for t in missing:
+                end_date = last_timestamps.get(t.id)
+                if end_date is not None:
+                    end_date = end_date.astimezone(
+                        ZoneInfo(t.timeseries_group.gentity.display_timezone)
+                    )
+                result[t] = end_date
+            cache.set_many({f"timeseries_end_date_{t.id}": result[t] for t in missing})
+        return {t.id: end_date for t, end_date in result.items()}
+
+    @classmethod
+    def get_data_of_many(cls, windows):
+        """Return the data of many time series, each between its own dates.
+
+        windows is a list of (timeseries, start_date, end_date); each time series
+        may appear only once. The result is a dictionary that maps the id of each
+        time series to the same dataframe as get_data(start_date, end_date).data.
+        The data is taken from the cache if it is there; otherwise it is retrieved,
+        for all time series, with a single query. The retrieved data is not cached,
+        as it's usually a small part of a year.
+        """
+        timeseries_ids = [timeseries.id for timeseries, start, end in windows]
+        if len(set(timeseries_ids)) < len(timeseries_ids):
+            raise ValueError("A time series appears in more than one window")
+        result = {}
+        missing = defaultdict(list)
+        for timeseries, start_date, end_date in windows:
+            start_date, end_date = timeseries._get_date_bounds(start_date, end_date)
+            data = TimeseriesDataCache(timeseries).get_cached_data(start_date, end_date)
+            if data is None:
+                missing[start_date, end_date].append(timeseries)
+            else:
+                result[timeseries.id] = data
+        if missing:
+            result.update(cls._retrieve_data_of_many(missing))
+        for timeseries, start_date, end_date in windows:
+            data = result[timeseries.id]
+            if not data.empty:
+                data.index = data.index.tz_convert(
+                    timeseries.timeseries_group.gentity.display_timezone
+                )
+        return result
+
+    @classmethod
+    def _retrieve_data_of_many(cls, timeseries_by_dates):
+        condition = Q()
+        for (start_date, end_date), timeseries_list in timeseries_by_dates.items():
+            condition |= Q(
+                timeseries_id__in=[t.id for t in timeseries_list],
+                timestamp__gte=start_date,
+                timestamp__lte=end_date,
+            )
+        rows = defaultdict(list)
+        records = (
+            TimeseriesRecord.objects.filter(condition)
+            .order_by("timeseries_id", "timestamp")
+            .values_list("timeseries_id", "timestamp", "value", "flags")
+        )
+        for timeseries_id, *row in records:
+            rows[timeseries_id].append(row)
+        return {
+            t.id: compact_flags(
+                t._make_dataframe_from_rows(rows[t.id], dt.timezone.utc)
+            )
+            for timeseries_list in timeseries_by_dates.values()
+            for t in timeseries_list
+        }
+
+    def iter_formatted_data(
+        self,
+        start_date=None,
+        end_date=None,
+        timezone=None,
+        format=HTimeseries.TEXT,
+        version=5,
+        chunk_size=10000,
+    ):
+        """Yield the data formatted as text, in chunks.
+
+        The result is the same as what get_data().write() writes, but the records are
+        read from the database with a server-side cursor and formatted chunk by chunk,
+        so memory usage does not depend on the length of the time series.
+        """
+        start_date, end_date = self._get_date_bounds(start_date, end_date)
+        timezone = timezone or self.timeseries_group.gentity.display_timezone
+        records = self.timeseriesrecord_set.filter(
+            timestamp__gte=start_date, timestamp__lte=end_date
+        ).order_by("timestamp")
+        if format == HTimeseries.FILE:
+            yield self._get_formatted_header(records.count(), timezone, version)
+        rows = records.values_list("timestamp", "value", "flags").iterator(
+            chunk_size=chunk_size
+        )
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            ahtimeseries = HTimeseries(self._make_dataframe_from_rows(chunk, timezone))
+            ahtimeseries.precision = self.timeseries_group.precision
+            f = StringIO()
+            ahtimeseries.write(f, format=HTimeseries.TEXT)
+            yield f.getvalue()
+
+    def _get_formatted_header(self, count, timezone, version):
+        ahtimeseries = HTimeseries(self._make_dataframe_from_rows([], timezone))
+        self._set_extra_timeseries_properties(ahtimeseries, timezone)
+        f = StringIO()
+        ahtimeseries.write(f, format=HTimeseries.FILE, version=version)
+
+        # The header has been written for an empty time series, so we fix the count
+        lines = f.getvalue().split("\r\n")
+        lines = [f"Count={count}" if x == "Count=0" else x for x in lines]
+        return "\r\n".join(lines)
+
+    def _make_dataframe_from_rows(self, rows, timezone):
+        timestamps = [row[0] for row in rows]
+        index = pd.DatetimeIndex(timestamps, tz=dt.timezone.utc, name="date")
+        return pd.DataFrame(
+            {
+                "value": np.array([row[1] for row in rows], dtype=np.float64),
+                "flags": np.array([row[2] for row in rows], dtype=object),
+            },
+            index=index.tz_convert(timezone),
+        )
+
+    def _retrieve_data(self, start_date, end_date):
+        # Timestamps (in microseconds since the epoch) and values are aggregated into
+        # byte strings of big-endian int8/float8, which is PostgreSQL's binary
+        # representation; these are loaded straight into numpy arrays, without
+        # formatting and parsing each record as text.
         with connection.cursor() as cursor:
             cursor.execute(
                 """
-                SELECT STRING_AGG(
-                    TO_CHAR(timestamp AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')
-                        || ','
-                        || CASE WHEN value is NULL THEN DOUBLE PRECISION 'NaN'
-                           ELSE value END
-                        || ','
-                        || flags,
-                    E'\n'
-                    ORDER BY timestamp
-                ) || E'\n'
+                SELECT
+                    STRING_AGG(
+                        INT8SEND((EXTRACT(EPOCH FROM timestamp) * 1000000)::BIGINT),
+                        ''::BYTEA
+                        ORDER BY timestamp
+                    ),
+                    STRING_AGG(
+                        FLOAT8SEND(COALESCE(value, DOUBLE PRECISION 'NaN')),
+                        ''::BYTEA
+                        ORDER BY timestamp
+                    ),
+                    ARRAY_AGG(flags ORDER BY timestamp)
                 FROM enhydris_timeseriesrecord
                 WHERE timeseries_id=%s AND timestamp >= %s AND timestamp <= %s
                 """,
                 [self.id, start_date, end_date],
             )
-            result_string = StringIO(cursor.fetchone()[0])
-        data = HTimeseries(result_string, default_tzinfo=dt.timezone.utc).data
-        cache.set(f"timeseries_data_{self.id}", data)
-        return data
+            timestamps, values, flags = cursor.fetchone()
+        return self._make_dataframe(timestamps, values, flags)
+
+    def _make_dataframe(self, timestamps, values, flags):
+        if timestamps is None:
+            return compact_flags(HTimeseries(default_tzinfo=dt.timezone.utc).data)
+        microseconds = np.frombuffer(timestamps, dtype=">i8").astype(np.int64)
+        index = pd.to_datetime(microseconds, unit="us", utc=True)
+        index.name = "date"
+        result = pd.DataFrame(
+            {
+                "value": np.frombuffer(values, dtype=">f8").astype(np.float64),
+                "flags": np.array(flags, dtype=object),
+            },
+            index=index,
+        )
+        return compact_flags(result)
+
+    def get_chart_stats(self, start_date=None, end_date=None, max_intervals=200):
+        """Return statistics of the values for plotting a chart.
+
+        The time between the first and last non-null value is divided into as many
+        equal intervals as the number of such values, but no more than max_intervals.
+        The result is a list with one dictionary per interval, with the interval's
+        midpoint ("timestamp", in seconds since the epoch) and the "min", "max" and
+        "mean" of the values in it (None if there are no values in the interval).
+
+        If the range is long enough, the calculation is done on the coarsest rollups
+        (see TimeseriesRollup) that have at least max_intervals rows in the range;
+        otherwise it is done on the cached data if available, otherwise on the
+        records in the database.
+        """
+        start_date, end_date = self._get_date_bounds(start_date, end_date)
+        level = TimeseriesRollup.get_level(self, start_date, end_date, max_intervals)
+        if level:
+            return self._get_chart_stats_from_rollups(
+                level, start_date, end_date, max_intervals
+            )
+        data = TimeseriesDataCache(self).get_cached_data(start_date, end_date)
+        if data is None:
+            return self._get_chart_stats_from_database(
+                start_date, end_date, max_intervals
+            )
+        else:
+            return self._get_chart_stats_from_dataframe(data, max_intervals)
+
+    def _get_chart_stats_from_database(self, start_date, end_date, max_intervals):
+        points_query = """
+            SELECT
+                EXTRACT(EPOCH FROM timestamp) AS epoch,
+                1 AS count,
+                value AS min,
+                value AS max,
+                value AS sum
+            FROM enhydris_timeseriesrecord
+            WHERE
+                timeseries_id = %(timeseries_id)s
+                AND value IS NOT NULL
+                AND timestamp >= %(start_date)s
+                AND timestamp <= %(end_date)s
+        """
+        return self._get_chart_stats_from_points(
+            points_query, start_date, end_date, max_intervals
+        )
+
+    def _get_chart_stats_from_rollups(self, level, start_date, end_date, max_intervals):
+        # The first rollup may start before start_date; it's included anyway.
+        points_query = f"""
+            SELECT EXTRACT(EPOCH FROM timestamp) AS epoch, count, min, max, sum
+            FROM enhydris_timeseriesrollup
+            WHERE
+                timeseries_id = %(timeseries_id)s
+                AND level = '{level}'
+                AND timestamp >= {TimeseriesRollup.truncate_sql(level, "%(start_date)s")}
+                AND timestamp <= %(end_date)s
+        """
+        return self._get_chart_stats_from_points(
+            points_query, start_date, end_date, max_intervals
+        )
+
+    def _get_chart_stats_from_points(
+        self, points_query, start_date, end_date, max_intervals
+    ):
+        # Each point has a timestamp (as "epoch") and the count, min, max and sum of
+        # the values it represents; a point is either a record or a rollup.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH
+                    points AS NOT MATERIALIZED ({points_query}),
+                    bounds AS (
+                        SELECT
+                            MIN(epoch) AS min_epoch,
+                            MAX(epoch) AS max_epoch,
+                            LEAST(COUNT(*), %(max_intervals)s) AS n
+                        FROM points
+                    )
+                SELECT
+                    b.min_epoch,
+                    b.max_epoch,
+                    b.n,
+                    LEAST(
+                        FLOOR(
+                            (p.epoch - b.min_epoch) * b.n / (b.max_epoch - b.min_epoch)
+                        ),
+                        b.n - 1
+                    ) AS bucket,
+                    MIN(p.min),
+                    MAX(p.max),
+                    SUM(p.sum) / SUM(p.count)
+                FROM points p CROSS JOIN bounds b
+                WHERE b.n >= 2
+                GROUP BY b.min_epoch, b.max_epoch, b.n, bucket
+                ORDER BY bucket
+                """,
+                {
+                    "timeseries_id": self.id,
+                    "start_date": start_date,
+                    "end_date": end_date,
+                    "max_intervals": max_intervals,
+                },
+            )
+            rows = cursor.fetchall()
+        if not rows:
+            return []
+        min_epoch, max_epoch, n = rows[0][:3]
+        stats = {int(row[3]): row[4:] for row in rows}
+        return self._make_chart_stats(float(min_epoch), float(max_epoch), n, stats)
+
+    def _get_chart_stats_from_dataframe(self, data, max_intervals):
+        values = data["value"].dropna()
+        n = min(max_intervals, len(values))
+        if n < 2:
+            return []
+        min_epoch = values.index[0].timestamp()
+        offsets = (values.index - values.index[0]).total_seconds().to_numpy()
+        max_epoch = min_epoch + offsets[-1]
+        buckets = np.floor(offsets * n / offsets[-1]).astype(np.int64)
+        buckets = np.minimum(buckets, n - 1)
+        grouped = values.groupby(buckets).agg(["min", "max", "mean"])
+        stats = dict(zip(grouped.index, grouped.itertuples(index=False, name=None)))
+        return self._make_chart_stats(min_epoch, max_epoch, n, stats)
+
+    def _make_chart_stats(self, min_epoch, max_epoch, n, stats):
+        interval = (max_epoch - min_epoch) / n
+        result = []
+        for i in range(n):
+            min_value, max_value, mean_value = stats.get(i, (None, None, None))
+            result.append(
+                {
+                    "timestamp": min_epoch + (i + 0.5) * interval,
+                    "min": min_value,
+                    "max": max_value,
+                    "mean": mean_value,
+                }
+            )
+        return result
 
     def set_data(self, data, default_timezone=None):
         self.timeseriesrecord_set.all().delete()
+        self.timeseriesrollup_set.all().delete()
+        self._invalidate_cached_data()
         return self.append_data(data, default_timezone)
 
     def append_data(self, data, default_timezone=None):
         ahtimeseries = self._get_htimeseries_from_data(data, default_timezone)
         self._check_new_data_is_newer(ahtimeseries)
-        result = TimeseriesRecord.bulk_insert(self, ahtimeseries)
-        self.save()
+        with transaction.atomic():
+            result = TimeseriesRecord.bulk_insert(self, ahtimeseries)
+            if result:
+                start_date = ahtimeseries.data.index[0].to_pydatetime()
+                TimeseriesRollup.update(self, start_date)
+        # Saving outside the transaction lets the cached data be extended rather
+        # than invalidated (see _update_cached_data()).
+        self.save(appended_data=ahtimeseries.data)
         return result
 
+    def delete_data(self, start_date):
+        """Delete the records from start_date onwards.
+
+        Records should be deleted with this rather than directly, so that the
+        rollups are recalculated and the cached data is invalidated.
+        """
+        with transaction.atomic():
+            self.timeseriesrecord_set.filter(timestamp__gte=start_date).delete()
+            TimeseriesRollup.update(self, start_date)
+            self.save()
+
     def _check_new_data_is_newer(self, ahtimeseries):
         if not len(ahtimeseries.data):
             return 0
@@ -309,18 +756,40 @@ class Timeseries(models.Model):
         except Station.DoesNotExist:
             return None
 
-    def _invalidate_cached_data(self):
+    def _update_cached_data(self, appended_data):
+        # If we are in a transaction, the appended records might be rolled back, so we
+        # can't add them to the cache; in that case we just invalidate it.
+        if appended_data is None or connection.in_atomic_block:
+            self._invalidate_cached_data()
+        else:
+            self._extend_cached_data(appended_data)
+
+    def _extend_cached_data(self, appended_data):
+        """Update the cache after appending records, without invalidating it.
+
+        The cached data (see TimeseriesDataCache) is extended with the appended records
+        and the cached end_date is replaced with the new one, so that readers keep
+        using the cache. The rest of the cached values are invalidated.
+        """
+        self._invalidate_cached_data(keep_data=True)
+        if appended_data.empty:
+            return
+        TimeseriesDataCache(self).append(appended_data)
+        tzinfo = ZoneInfo(self.timeseries_group.gentity.display_timezone)
+        end_date = appended_data.index[-1].to_pydatetime().astimezone(tzinfo)
+        cache.set(f"timeseries_end_date_{self.id}", end_date)
+
+    def _invalidate_cached_data(self, keep_data=False):
         """
         Invalidate cached data for related model instances.
 
         Invalidate cached values of:
-         - timeseries_data from `get_data` method
+         - timeseries_data from `get_data` method (unless keep_data is True)
          - last_update of related `Station` model instance.
          - start_date, end_date, of the related `TimeSeriesGroup` model instance.
          - start_date`, end_date of the current `Timeseries` model instance.
         """
         cached_property_names = [
-            f"timeseries_data_{self.id}",
             f"timeseries_start_date_{self.id}",
             f"timeseries_end_date_{self.id}",
             f"timeseries_group_start_date_{self.timeseries_group.id}",
@@ -330,6 +799,8 @@ class Timeseries(models.Model):
             cached_property_names += [
                 f"station_last_update_{self.related_station.id}",
             ]
+        if not keep_data:
+            cached_property_names.append(f"timeseries_data_{self.id}")
         cache.delete_many(cached_property_names)
 
     def __str__(self):
@@ -341,10 +812,18 @@ class Timeseries(models.Model):
             explanation = f" ({self.name})"
         return f"{type}{explanation}"
 
-    def save(self, force_insert=False, force_update=False, *args, **kwargs):
+    def save(
+        self,
+        force_insert=False,
+        force_update=False,
+        *args,
+        appended_data=None,
+        **kwargs,
+    ):
         check_time_step(self.time_step)
+        self.last_modified = now()
         super(Timeseries, self).save(force_insert, force_update, *args, **kwargs)
-        self._invalidate_cached_data()
+        self._update_cached_data(appended_data)
 
 
 class TimeseriesRecord(models.Model):
@@ -362,8 +841,71 @@ class TimeseriesRecord(models.Model):
             models.Index(fields=["timestamp", "timeseries_id"]),
         ]
 
+    COPY_CHUNK_SIZE = 100000
+
     @classmethod
     def bulk_insert(cls, timeseries, htimeseries):
+        if connection.vendor == "postgresql":
+            return cls._bulk_insert_with_copy(timeseries, htimeseries.data)
+        else:
+            return cls._bulk_insert_with_orm(timeseries, htimeseries.data)
+
+    @classmethod
+    def _bulk_insert_with_copy(cls, timeseries, data):
+        """Insert records with PostgreSQL's COPY, in chunks of CSV.
+
+        No model instances are created; the dataframe is converted to CSV by pandas.
+        NaN values become empty (unquoted) fields, which COPY treats as NULL. Empty
+        flags would also be NULL, so FORCE_NOT_NULL is specified for them. The chunks
+        are copied in a single transaction, so that either all records are inserted
+        or none.
+        """
+        records = cls._get_dataframe_for_copy(timeseries, data)
+        quote = connection.ops.quote_name
+        sql = (
+            f"COPY {quote(cls._meta.db_table)} "
+            "(timestamp, timeseries_id, value, flags) "
+            "FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (flags))"
+        )
+        chunk_size = cls.COPY_CHUNK_SIZE
+        with transaction.atomic(savepoint=False), connection.cursor() as cursor:
+            for start in range(0, len(records), chunk_size):
+                end = start + chunk_size
+                chunk = records.iloc[start:end].to_csv(
+                    header=False, na_rep="", date_format="%Y-%m-%d %H:%M:%S.%f+00"
+                )
+                cls._copy(cursor, sql, chunk)
+        return len(records)
+
+    @classmethod
+    def _get_dataframe_for_copy(cls, timeseries, data):
+        index = data.index
+        if index.tz is None:
+            index = index.tz_localize(get_current_timezone())
+        return pd.DataFrame(
+            {
+                "timeseries_id": timeseries.id,
+                "value": data["value"].to_numpy(dtype=np.float64),
+                "flags": get_text_flags(data),
+            },
+            index=index.tz_convert(dt.timezone.utc),
+        )
+
+    @classmethod
+    def _copy(cls, cursor, sql, csv_string):
+        from django.db.backends.postgresql.psycopg_any import is_psycopg3
+
+        # Unlike execute(), these are not wrapped by Django, so we need to convert
+        # database errors (e.g. duplicate timestamps) to django.db exceptions.
+        with connection.wrap_database_errors:
+            if is_psycopg3:
+                with cursor.copy(sql) as copy:
+                    copy.write(csv_string)
+            else:
+                cursor.copy_expert(sql, StringIO(csv_string))
+
+    @classmethod
+    def _bulk_insert_with_orm(cls, timeseries, data):
         record_generator = (
             TimeseriesRecord(
                 timeseries_id=timeseries.id,
@@ -371,7 +913,7 @@ class TimeseriesRecord(models.Model):
                 value=None if np.isnan(t.value) else t.value,
                 flags=t.flags,
             )
-            for t in htimeseries.data.itertuples()
+            for t in data.itertuples()
         )
         batch_size = 1000
         count = 0
@@ -391,3 +933,121 @@ class TimeseriesRecord(models.Model):
         datestr = self.timestamp.astimezone(tzinfo).strftime("%Y-%m-%d %H:%M")
         value = "" if self.value is None else f"{self.value:.{precision}f}"
         return f"{datestr},{value},{self.flags}"
+
+
+class TimeseriesRollup(models.Model):
+    """Summary of the records of a time series in an hour, day or month.
+
+    Rollups are kept up to date by Timeseries.append_data(), set_data() and
+    delete_data(), and are
+    used for plotting charts of long time ranges without reading all the records.
+    Only non-null values are summarized. The timestamp is the (UTC) start of the
+    hour, day or month.
+    """
+
+    LEVELS = ("hour", "day", "month")
+
+    pk = models.CompositePrimaryKey("timeseries_id", "level", "timestamp")
+    timeseries = models.ForeignKey(Timeseries, on_delete=models.CASCADE)
+    level = models.CharField(
+        max_length=5, choices=[(x, x) for x in LEVELS], verbose_name=_("Level")
+    )
+    timestamp = models.DateTimeField(verbose_name=_("Timestamp"))
+    count = models.IntegerField()
+    min = models.FloatField()
+    max = models.FloatField()
+    sum = models.FloatField()
+
+    class Meta:
+        verbose_name = _("Time series rollup")
+        verbose_name_plural = _("Time series rollups")
+
+    @staticmethod
+    def truncate_sql(level, timestamp_sql):
+        """Return SQL that truncates a timestamp to the start of its UTC hour/day/month."""
+        return f"DATE_TRUNC('{level}', {timestamp_sql} AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'"
+
+    @classmethod
+    def update(cls, timeseries, start_date):
+        """Recalculate the rollups of the time series from start_date onwards.
+
+        Hourly rollups are calculated from the records, daily from hourly, and monthly
+        from daily.
+        """
+        source = """
+            SELECT timestamp, 1 AS count, value AS min, value AS max, value AS sum
+            FROM enhydris_timeseriesrecord
+            WHERE timeseries_id = %(timeseries_id)s AND value IS NOT NULL
+        """
+        with connection.cursor() as cursor:
+            for level in cls.LEVELS:
+                cls._update_level(cursor, timeseries, start_date, level, source)
+                source = f"""
+                    SELECT timestamp, count, min, max, sum
+                    FROM enhydris_timeseriesrollup
+                    WHERE timeseries_id = %(timeseries_id)s AND level = '{level}'
+                """
+
+    @classmethod
+    def _update_level(cls, cursor, timeseries, start_date, level, source):
+        period_start = cls.truncate_sql(level, "%(start_date)s")
+        params = {"timeseries_id": timeseries.id, "start_date": start_date}
+        cursor.execute(
+            f"""
+            DELETE FROM enhydris_timeseriesrollup
+            WHERE
+                timeseries_id = %(timeseries_id)s
+                AND level = '{level}'
+                AND timestamp >= {period_start}
+            """,
+            params,
+        )
+        cursor.execute(
+            f"""
+            INSERT INTO enhydris_timeseriesrollup
+                (timeseries_id, level, timestamp, count, min, max, sum)
+            SELECT
+                %(timeseries_id)s,
+                '{level}',
+                {cls.truncate_sql(level, "s.timestamp")} AS period,
+                SUM(s.count),
+                MIN(s.min),
+                MAX(s.max),
+                SUM(s.sum)
+            FROM ({source}) s
+            WHERE s.timestamp >= {period_start}
+            GROUP BY period
+            """,
+            params,
+        )
+
+    @classmethod
+    def get_level(cls, timeseries, start_date, end_date, min_count):
+        """Return the coarsest level with at least min_count rollups in the range.
+
+        Return None if there is no such level.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT level, COUNT(*)
+                FROM enhydris_timeseriesrollup
+                WHERE
+                    timeseries_id = %(timeseries_id)s
+                    AND timestamp >= DATE_TRUNC(
+                        level, %(start_date)s AT TIME ZONE 'UTC'
+                    ) AT TIME ZONE 'UTC'
+                    AND timestamp <= %(end_date)s
+                GROUP BY level
+                """,
+                {
+                    "timeseries_id": timeseries.id,
+                    "start_date": start_date,
+                    "end_date": end_date,
+                },
+            )
+            counts = dict(cursor.fetchall())
+        for level in reversed(cls.LEVELS):
+            if counts.get(level, 0) >= min_count:
+                return level
+        return None
@@ -5,12 +5,19 @@ from zoneinfo import ZoneInfo
 from django.conf import settings
 from django.core.mail import send_mail
 from django.db import DataError, IntegrityError, models
+from django.db.models import Prefetch, prefetch_related_objects
 from django.utils.translation import gettext as _
 
 import iso8601
+from htimeseries import HTimeseries
 from rocc import Threshold, rocc
 
-from enhydris.models import DISPLAY_TIMEZONE_CHOICES, Station, TimeseriesGroup
+from enhydris.models import (
+    DISPLAY_TIMEZONE_CHOICES,
+    Station,
+    Timeseries,
+    TimeseriesGroup,
+)
 
 # NOTE: Confusingly, there are three distinct uses of "group" here. They refer to
 # different things:
@@ -54,6 +61,22 @@ class SynopticGroup(models.Model):
     def __str__(self):
         return self.name
 
+    def load_data(self):
+        """Load the data of all stations of the group at once.
+
+        This prefetches the synoptic group stations, so that
+        synopticgroupstation_set.all() returns them, and then loads their data with
+        SynopticGroupStation.load_data_of_many().
+        """
+        prefetch_related_objects(
+            [self],
+            Prefetch(
+                "synopticgroupstation_set",
+                queryset=SynopticGroupStation.objects.select_related("station"),
+            ),
+        )
+        SynopticGroupStation.load_data_of_many(self.synopticgroupstation_set.all())
+
     def queue_warning(self, asyntsg, warning_text):
         if not hasattr(self, "early_warnings"):
             self.early_warnings = {}
@@ -147,6 +170,54 @@ class SynopticGroupStation(models.Model):
 
         super(SynopticGroupStation, self).save(*args, **kwargs)
 
+    @classmethod
+    def load_data_of_many(cls, synoptic_group_stations):
+        """Load the data of many synoptic group stations at once.
+
+        Otherwise each synoptic group station loads the end dates and the data of
+        its time series when they are first needed, with a few queries for each
+        time series. This prefetches the synoptic time series groups of the
+        stations; then it retrieves the end dates of all time series with one query
+        and the data needed for the report with another.
+        """
+        prefetch_related_objects(
+            synoptic_group_stations,
+            Prefetch(
+                "synoptictimeseriesgroup_set",
+                queryset=SynopticTimeseriesGroup.objects.select_related(
+                    "timeseries_group__gentity",
+                    "timeseries_group__unit_of_measurement",
+                    "timeseries_group__variable",
+                    "group_with",
+                ).prefetch_related(
+                    "timeseries_group__timeseries_set", "rateofchangethreshold_set"
+                ),
+            ),
+        )
+        all_timeseries = [
+            asyntsg.timeseries_group.default_timeseries
+            for synoptic_group_station in synoptic_group_stations
+            for asyntsg in synoptic_group_station.synoptictimeseriesgroup_set.all()
+        ]
+        end_dates = Timeseries.get_end_dates(all_timeseries)
+        windows = {}
+        for synoptic_group_station in synoptic_group_stations:
+            synoptic_group_station._determine_last_common_date(end_dates)
+            for window in synoptic_group_station._get_data_windows():
+                cls._add_data_window(windows, *window)
+        data = Timeseries.get_data_of_many(list(windows.values()))
+        for synoptic_group_station in synoptic_group_stations:
+            synoptic_group_station._loaded_data = data
+
+    @staticmethod
+    def _add_data_window(windows, timeseries, start_date, end_date):
+        # A time series may be used by more than one synoptic time series group; its
+        # window then covers all of them, and each one slices its own part.
+        if timeseries.id in windows:
+            start_date = min(start_date, windows[timeseries.id][1])
+            end_date = max(end_date, windows[timeseries.id][2])
+        windows[timeseries.id] = (timeseries, start_date, end_date)
+
     @property
     def synoptic_timeseries_groups(self):
         """List of synoptic timeseries group objects with data.
@@ -169,12 +240,44 @@ class SynopticGroupStation(models.Model):
         self._synoptic_timeseries_groups = list(self.synoptictimeseriesgroup_set.all())
         self.error = False  # This may be changed by _set_ts_value()
         for asyntsg in self._synoptic_timeseries_groups:
-            asyntsg.data = asyntsg.timeseries_group.default_timeseries.get_data(
-                start_date=start_date, end_date=self.last_common_date
-            ).data
+            asyntsg.data = self._get_data(asyntsg, start_date)
             self._set_tsg_value(asyntsg)
             self._set_tsg_value_status(asyntsg)
 
+    def _get_data(self, asyntsg, start_date):
+        """Return the data of asyntsg from start_date to the last common date.
+
+        If it has been loaded by SynopticGroup.load_data(), it is taken from there.
+        """
+        timeseries = asyntsg.timeseries_group.default_timeseries
+        end_date = self.last_common_date
+        loaded_data = getattr(self, "_loaded_data", {}).get(timeseries.id)
+        if loaded_data is not None:
+            return loaded_data.loc[start_date:end_date].copy()
+        return timeseries.get_data(start_date=start_date, end_date=end_date).data
+
+    def _get_data_windows(self):
+        """Return the (timeseries, start_date, end_date) that the report needs.
+
+        These are the last 24 hours preceding the last common date, or more if the
+        rate-of-change check needs more.
+        """
+        if self.last_common_date is None:
+            return []
+        result = []
+        for asyntsg in self.synoptictimeseriesgroup_set.all():
+            look_back = max(
+                dt.timedelta(minutes=1439), self._get_roc_timedelta(asyntsg)
+            )
+            result.append(
+                (
+                    asyntsg.timeseries_group.default_timeseries,
+                    self.last_common_date - look_back,
+                    self.last_common_date,
+                )
+            )
+        return result
+
     def _set_tsg_value(self, asyntsg):
         try:
             asyntsg.value = asyntsg.data.loc[self.last_common_date]["value"]
@@ -214,9 +317,7 @@ class SynopticGroupStation(models.Model):
         if not asyntsg.roc_thresholds:
             return None
         start_date = self.last_common_date - self._get_roc_timedelta(asyntsg)
-        timeseries = asyntsg.timeseries_group.default_timeseries.get_data(
-            start_date=start_date, end_date=self.last_common_date
-        )
+        timeseries = HTimeseries(self._get_data(asyntsg, start_date))
         messages = rocc(
             timeseries=timeseries,
             thresholds=asyntsg.roc_thresholds,
@@ -254,13 +355,19 @@ class SynopticGroupStation(models.Model):
             self._determine_last_common_date()
         return self._last_common_date
 
-    def _determine_last_common_date(self):
+    def _determine_last_common_date(self, end_dates=None):
         # We don't actually get the last common date, which would be difficult; instead,
         # we get the minimum of the last dates of the timeseries, which will usually be
         # the last common date. station is an enhydris.synoptic.models.Station object.
+        # end_dates, if specified, maps time series ids to their end dates (see
+        # SynopticGroup.load_data()).
         last_common_date = None
         for asyntsg in self.synoptictimeseriesgroup_set.all():
-            end_date = asyntsg.timeseries_group.default_timeseries.end_date
+            timeseries = asyntsg.timeseries_group.default_timeseries
+            if end_dates is None:
+                end_date = timeseries.end_date
+            else:
+                end_date = end_dates[timeseries.id]
             if end_date and ((not last_common_date) or (end_date < last_common_date)):
                 last_common_date = end_date
         self._last_common_date = last_common_date
@@ -411,9 +518,10 @@ class SynopticTimeseriesGroup(models.Model):
     @property
     def roc_thresholds(self):
         if self.pk:
-            thresholds = RateOfChangeThreshold.objects.filter(
-                synoptic_timeseries_group=self
-            ).order_by("delta_t")
+            # Not order_by(), so that prefetched thresholds are used
+            thresholds = sorted(
+                self.rateofchangethreshold_set.all(), key=lambda x: x.delta_t
+            )
         else:
             thresholds = []
         result = []
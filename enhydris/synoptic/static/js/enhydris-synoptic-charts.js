@@ -0,0 +1,42 @@
+/* Draw the charts of a synoptic station page when ENHYDRIS_SYNOPTIC_CHART_FORMAT
+is "json". Each chart is a div with class "synoptic-chart" whose "data-url" is a
+JSON file written by enhydris.synoptic.views.Chart. The timestamps are the local
+times of the data as if they were UTC, so they are shown as UTC. */
+
+const getChartOptions = (chart) => ({
+  chart: {
+    type: 'area',
+    width: 320,
+    height: 200,
+    animations: { enabled: false },
+    toolbar: { show: false },
+    zoom: { enabled: false },
+  },
+  series: chart.series.map((s) => ({ name: s.name, data: s.data })),
+  colors: chart.series.map((s) => s.color),
+  fill: {
+    type: 'solid',
+    colors: ['#ffff00'],
+    opacity: chart.series.map((s, i) => (i === 0 ? 1 : 0)),
+  },
+  stroke: { width: 1.5, curve: 'straight' },
+  dataLabels: { enabled: false },
+  legend: { show: chart.series.length > 1 },
+  tooltip: { x: { format: 'yyyy-MM-dd HH:mm' } },
+  xaxis: { type: 'datetime', labels: { datetimeUTC: true } },
+  yaxis: {
+    min: (min) => (chart.min === null ? min : Math.min(min, chart.min)),
+    max: (max) => (chart.max === null ? max : Math.max(max, chart.max)),
+  },
+});
+
+const renderChart = async (element) => {
+  const response = await fetch(element.dataset.url);
+  const chart = await response.json();
+  if (chart.series.length === 0) {
+    return;
+  }
+  new ApexCharts(element, getChartOptions(chart)).render();
+};
+
+document.querySelectorAll('.synoptic-chart').forEach(renderChart);
@@ -1,11 +1,96 @@
+"""Rendering of the synoptic groups by the celery workers.
+
+create_static_files() enqueues a task for each synoptic group, which enqueues a task
+for each station of the group; these render the station pages and charts, and may
+run in parallel on different workers. Whichever station task finishes last enqueues
+the final task of the group, which renders the group page and sends the early
+warnings. The stations of a group that remain to be rendered are counted in the
+cache, which must therefore be shared by the workers; each run of a group has its
+own counter, so that runs that overlap don't interfere with each other.
+
+Each task loads the data it needs itself, so the data of the group is read twice:
+once, station by station, by the station tasks, and once, all together, by the
+final task. Passing the data between the tasks would instead mean storing it in the
+cache, whose items may have a limited size, and it would not save much: loading the
+data of a station takes a few queries, whereas rendering its charts takes most of
+the time.
+"""
+
+import uuid
+
+from django.core.cache import cache
+
 from enhydris.celery import app
 
-from .models import SynopticGroup
-from .views import render_synoptic_group
+from .models import SynopticGroup, SynopticGroupStation
+from .views import render_synoptic_group_index, render_synoptic_station
+
+REMAINING_STATIONS_TIMEOUT = 3600
 
 
 @app.task
 def create_static_files():
     """Create static html files for all synoptic groups."""
-    for sgroup in SynopticGroup.objects.all():
-        render_synoptic_group(sgroup)
+    for synoptic_group_id in SynopticGroup.objects.values_list("id", flat=True):
+        render_group.delay(synoptic_group_id)
+
+
+@app.task
+def render_group(synoptic_group_id):
+    synoptic_group_station_ids = list(
+        SynopticGroupStation.objects.filter(
+            synoptic_group_id=synoptic_group_id
+        ).values_list("id", flat=True)
+    )
+    if not synoptic_group_station_ids:
+        render_group_index.delay(synoptic_group_id)
+        return
+    run_id = uuid.uuid4().hex
+    cache.set(
+        _get_remaining_stations_key(synoptic_group_id, run_id),
+        len(synoptic_group_station_ids),
+        REMAINING_STATIONS_TIMEOUT,
+    )
+    for synoptic_group_station_id in synoptic_group_station_ids:
+        render_station.delay(synoptic_group_id, synoptic_group_station_id, run_id)
+
+
+@app.task
+def render_station(synoptic_group_id, synoptic_group_station_id, run_id):
+    try:
+        synstation = SynopticGroupStation.objects.select_related(
+            "synoptic_group", "station"
+        ).get(id=synoptic_group_station_id)
+        SynopticGroupStation.load_data_of_many([synstation])
+        render_synoptic_station(synstation)
+    except SynopticGroupStation.DoesNotExist:
+        pass
+    finally:
+        _finish_station(synoptic_group_id, run_id)
+
+
+def _finish_station(synoptic_group_id, run_id):
+    key = _get_remaining_stations_key(synoptic_group_id, run_id)
+    try:
+        remaining_stations = cache.decr(key)
+    except ValueError:
+        # The counter has expired or has been evicted; the group page will be
+        # rendered in the next run.
+        return
+    if remaining_stations == 0:
+        cache.delete(key)
+        render_group_index.delay(synoptic_group_id)
+
+
+@app.task
+def render_group_index(synoptic_group_id):
+    try:
+        synoptic_group = SynopticGroup.objects.get(id=synoptic_group_id)
+    except SynopticGroup.DoesNotExist:
+        return
+    synoptic_group.load_data()
+    render_synoptic_group_index(synoptic_group)
+
+
+def _get_remaining_stations_key(synoptic_group_id, run_id):
+    return f"synoptic-remaining-stations-{synoptic_group_id}-{run_id}"
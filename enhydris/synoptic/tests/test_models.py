@@ -176,6 +176,35 @@ class SynopticGroupStationSynopticTimeseriesGroupTestCase(ClearCacheMixin, TestC
         self.assertEqual(len(self.data.sgs_agios.synoptic_timeseries_groups[0].data), 2)
 
 
+class LoadDataTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        self.synoptic_group = SynopticGroup.objects.get(id=self.data.sg1.id)
+        self.synoptic_group.load_data()
+        self.sgs_agios = next(
+            sgs
+            for sgs in self.synoptic_group.synopticgroupstation_set.all()
+            if sgs.id == self.data.sgs_agios.id
+        )
+
+    def test_last_common_date(self):
+        self.assertEqual(
+            self.sgs_agios.last_common_date,
+            dt.datetime(2015, 10, 23, 15, 20, tzinfo=ZoneInfo("Etc/GMT-2")),
+        )
+
+    def test_value(self):
+        self.assertAlmostEqual(self.sgs_agios.synoptic_timeseries_groups[0].value, 0.2)
+
+    def test_data(self):
+        self.assertEqual(len(self.sgs_agios.synoptic_timeseries_groups[0].data), 2)
+
+    def test_no_more_queries_are_needed(self):
+        with self.assertNumQueries(0):
+            for sgs in self.synoptic_group.synopticgroupstation_set.all():
+                sgs.synoptic_timeseries_groups
+
+
 class FreshnessTestCase(ClearCacheMixin, TestCase):
     def setUp(self):
         self.stg = baker.make(
@@ -1,10 +1,11 @@
 import datetime as dt
+import json
 import locale
 import os
 import shutil
 import tempfile
 from io import StringIO
-from unittest import skipUnless
+from unittest import mock, skipUnless
 from urllib.parse import urlparse
 
 from django.conf import settings
@@ -19,13 +20,23 @@ from django_selenium_clean import PageElement
 from freezegun import freeze_time
 from selenium.webdriver.common.by import By
 
-from enhydris.synoptic import models
-from enhydris.synoptic.tasks import create_static_files
+from enhydris.celery import app
+from enhydris.synoptic import models, tasks
+from enhydris.synoptic.views import File
 from enhydris.tests import ClearCacheMixin, SeleniumTestCase
 
 from .data import TestData
 
 
+def create_static_files():
+    """Execute tasks.create_static_files() and all the tasks it enqueues."""
+    app.conf.update(task_always_eager=True, task_eager_propagates=True)
+    try:
+        tasks.create_static_files()
+    finally:
+        app.conf.update(task_always_eager=False, task_eager_propagates=False)
+
+
 class RandomSynopticRoot(override_settings):
     """
     Override ENHYDRIS_SYNOPTIC_ROOT to a temporary directory.
@@ -533,3 +544,208 @@ class RoccEmailContentTestCase(ClearCacheMixin, TestCase):
             message.get_payload(),
             "Komboti Air temperature 2015-10-22T15:20  +1.0 in 10min (> 0.5)\n",
         )
+
+
+@RandomSynopticRoot()
+@mock.patch("enhydris.synoptic.tasks.render_group_index")
+class RenderStationsTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        with mock.patch("enhydris.synoptic.tasks.render_station") as m:
+            tasks.render_group(self.data.sg1.id)
+        self.station_tasks = [c.args for c in m.delay.call_args_list]
+
+    def test_enqueues_stations(self, m):
+        self.assertEqual(len(self.station_tasks), 3)
+
+    def test_renders_station_page(self, m):
+        for args in self.station_tasks:
+            tasks.render_station(*args)
+        filename = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT,
+            "mygroup",
+            "station",
+            str(self.data.station_agios.id),
+            "index.html",
+        )
+        self.assertTrue(os.path.exists(filename))
+
+    def test_does_not_render_group_before_all_stations(self, m):
+        for args in self.station_tasks[1:]:
+            tasks.render_station(*args)
+        m.delay.assert_not_called()
+
+    def test_renders_group_after_last_station(self, m):
+        for args in reversed(self.station_tasks):
+            tasks.render_station(*args)
+        m.delay.assert_called_once_with(self.data.sg1.id)
+
+    def test_overlapping_run_does_not_affect_counter(self, m):
+        for args in self.station_tasks[:-1]:
+            tasks.render_station(*args)
+        with mock.patch("enhydris.synoptic.tasks.render_station"):
+            tasks.render_group(self.data.sg1.id)
+        tasks.render_station(*self.station_tasks[-1])
+        m.delay.assert_called_once_with(self.data.sg1.id)
+
+    def test_renders_group_even_if_a_station_fails(self, m):
+        with mock.patch(
+            "enhydris.synoptic.tasks.render_synoptic_station", side_effect=ValueError
+        ):
+            with self.assertRaises(ValueError):
+                tasks.render_station(*self.station_tasks[0])
+        for args in self.station_tasks[1:]:
+            tasks.render_station(*args)
+        m.delay.assert_called_once_with(self.data.sg1.id)
+
+
+@RandomSynopticRoot()
+class UnchangedFilesTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        create_static_files()
+
+    def _get_written_files(self):
+        with mock.patch.object(File, "write", autospec=True) as m:
+            create_static_files()
+        return {c.args[0].relative_filename for c in m.call_args_list}
+
+    def test_only_group_page_is_written_if_nothing_changed(self):
+        self.assertEqual(self._get_written_files(), {"mygroup/index.html"})
+
+    def test_changed_chart_is_written(self):
+        self.data.stsg2_2.default_chart_max = 100
+        self.data.stsg2_2.save()
+        self.assertEqual(
+            self._get_written_files(),
+            {"mygroup/index.html", f"chart/{self.data.stsg2_2.id}.png"},
+        )
+
+    def test_changed_station_page_is_written(self):
+        self.data.stsg2_2.title = "Air temperature"
+        self.data.stsg2_2.save()
+        self.assertIn(
+            f"mygroup/station/{self.data.station_agios.id}/index.html",
+            self._get_written_files(),
+        )
+
+    def test_missing_file_is_written(self):
+        chart = f"chart/{self.data.stsg2_2.id}.png"
+        os.remove(os.path.join(settings.ENHYDRIS_SYNOPTIC_ROOT, chart))
+        self.assertEqual(self._get_written_files(), {"mygroup/index.html", chart})
+
+
+@RandomSynopticRoot()
+@override_settings(ENHYDRIS_SYNOPTIC_CHART_FORMAT="svg")
+class SvgChartTestCase(ClearCacheMixin, AssertHtmlContainsMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        create_static_files()
+
+    def test_chart(self):
+        filename = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT, "chart", f"{self.data.stsg2_2.id}.svg"
+        )
+        with open(filename) as f:
+            self.assertIn("<svg", f.read())
+
+    def test_station_page(self):
+        filename = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT,
+            "mygroup",
+            "station",
+            str(self.data.station_agios.id),
+            "index.html",
+        )
+        self.assertHtmlContains(
+            filename,
+            f'<img src="../../../chart/{self.data.stsg2_2.id}.svg" alt="Chart">',
+        )
+
+
+@RandomSynopticRoot()
+@override_settings(ENHYDRIS_SYNOPTIC_CHART_FORMAT="json")
+class JsonChartTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        create_static_files()
+
+    def _get_chart(self, synoptic_timeseries_group):
+        filename = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT,
+            "chart",
+            f"{synoptic_timeseries_group.id}.json",
+        )
+        with open(filename) as f:
+            return json.load(f)
+
+    def _get_timestamp(self, hour, minute):
+        local_time_as_utc = dt.datetime(
+            2015, 10, 23, hour, minute, tzinfo=dt.timezone.utc
+        )
+        return int(local_time_as_utc.timestamp() * 1000)
+
+    def test_chart(self):
+        self.assertEqual(
+            self._get_chart(self.data.stsg2_2)["series"][0]["data"],
+            [
+                [self._get_timestamp(15, 0), 40],
+                [self._get_timestamp(15, 10), 39],
+                [self._get_timestamp(15, 20), 38.5],
+            ],
+        )
+
+    def test_grouped_chart(self):
+        series = self._get_chart(self.data.stsg1_3)["series"]
+        self.assertEqual([s["name"] for s in series], ["gust", "speed"])
+
+    def test_no_png(self):
+        filename = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT, "chart", f"{self.data.stsg2_2.id}.png"
+        )
+        self.assertFalse(os.path.exists(filename))
+
+
+@RandomSynopticRoot()
+class GroupSnapshotTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.data = TestData()
+        create_static_files()
+        filename = os.path.join(
+            settings.ENHYDRIS_SYNOPTIC_ROOT, "mygroup", "index.json"
+        )
+        with open(filename) as f:
+            self.snapshot = json.load(f)
+
+    def _get_station(self, station):
+        return next(s for s in self.snapshot["stations"] if s["id"] == station.id)
+
+    def test_stations(self):
+        self.assertEqual(len(self.snapshot["stations"]), 3)
+
+    def test_last_common_date(self):
+        self.assertEqual(
+            self._get_station(self.data.station_agios)["last_common_date"],
+            "2015-10-23T15:20:00+02:00",
+        )
+
+    def test_freshness(self):
+        self.assertEqual(self._get_station(self.data.station_agios)["freshness"], "old")
+
+    def test_value(self):
+        timeseries_group = self._get_station(self.data.station_agios)[
+            "timeseries_groups"
+        ][0]
+        self.assertAlmostEqual(timeseries_group["value"], 0.2)
+        self.assertEqual(timeseries_group["status"], "ok")
+
+    def test_data(self):
+        timeseries_group = self._get_station(self.data.station_agios)[
+            "timeseries_groups"
+        ][0]
+        self.assertEqual(len(timeseries_group["data"]), 2)
+
+    def test_station_without_data(self):
+        station = self._get_station(self.data.station_arta)
+        self.assertIsNone(station["last_common_date"])
+        self.assertEqual(station["timeseries_groups"], [])
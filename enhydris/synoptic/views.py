@@ -6,14 +6,19 @@ to do such offline rendering. It doesn't know about requests and responses, and
 doesn't know about HTTP. But logically it's the "views" part of a Django app.
 """
 
+import hashlib
+import json
 import math
 import os
+import threading
 from io import BytesIO
 
 from django.conf import settings
 from django.contrib.gis.db.models import Extent
+from django.core.cache import cache
 from django.http import HttpRequest
-from django.template.loader import render_to_string
+from django.template.loader import get_template, render_to_string
+from django.utils.translation import get_language
 
 import matplotlib
 
@@ -24,13 +29,32 @@ import matplotlib
 matplotlib.use("AGG")  # NOQA
 
 import enhydris.context_processors  # NOQA
-import matplotlib.pyplot as plt  # NOQA
 import pandas.plotting  # NOQA
 from enhydris.views_common import ensure_extent_is_large_enough  # NOQA
+from matplotlib.backends.backend_agg import FigureCanvasAgg  # NOQA
 from matplotlib.dates import DateFormatter, DayLocator, HourLocator  # NOQA
+from matplotlib.figure import Figure  # NOQA
+from matplotlib.ticker import (  # NOQA
+    AutoLocator,
+    NullFormatter,
+    NullLocator,
+    ScalarFormatter,
+)
 
 pandas.plotting.register_matplotlib_converters()
 
+# Increase this whenever the way station pages or charts are rendered changes, so
+# that they are rendered again even if their data hasn't changed (see Fingerprint).
+RENDERING_VERSION = 1
+
+STATION_PAGE_TEMPLATES = (
+    "enhydris/synoptic/groupstation.html",
+    "enhydris/synoptic/groupstation-default.html",
+    "enhydris/synoptic/groupstation-report.html",
+    "enhydris/synoptic/base.html",
+    "enhydris/synoptic/base-default.html",
+)
+
 
 class File:
     """Write string (or bytes) to a file.
@@ -69,6 +93,44 @@ class File:
         os.replace(self.temporary_full_pathname, self.full_pathname)
 
 
+class Fingerprint:
+    """Identify the inputs from which a file is rendered.
+
+    Fingerprint(relative_filename, components) is a hash of components, which is a
+    list of things with a deterministic repr(), such as numbers, strings and dates;
+    dataframes are hashed by their contents. If the file exists and has last been
+    rendered from the same components, is_unchanged() returns True and the file
+    doesn't need to be rendered again. save() records that the file has been
+    rendered. The fingerprints are stored in the cache; if a fingerprint is missing,
+    the file is rendered again.
+    """
+
+    def __init__(self, relative_filename, components):
+        self.full_pathname = File(relative_filename).full_pathname
+        pathname_hash = hashlib.md5(self.full_pathname.encode()).hexdigest()
+        self.cache_key = f"synoptic-fingerprint-{pathname_hash}"
+        self.value = self._get_hash(components)
+
+    def _get_hash(self, components):
+        result = hashlib.sha256()
+        for component in components:
+            if isinstance(component, pandas.DataFrame):
+                hashes = pandas.util.hash_pandas_object(component)
+                result.update(hashes.values.tobytes())
+            else:
+                result.update(repr(component).encode())
+            result.update(b"\0")
+        return result.hexdigest()
+
+    def is_unchanged(self):
+        return cache.get(self.cache_key) == self.value and os.path.exists(
+            self.full_pathname
+        )
+
+    def save(self):
+        cache.set(self.cache_key, self.value, timeout=None)
+
+
 def render_synoptic_station(synstation):
     _check_for_null_values(synstation)
     _render_station_page(synstation)
@@ -81,16 +143,55 @@ def _check_for_null_values(synstation):
 
 
 def _render_station_page(synstation):
-    output = render_to_string(
-        "enhydris/synoptic/groupstation.html", context={"object": synstation}
-    )
     filename = os.path.join(
         synstation.synoptic_group.slug,
         "station",
         str(synstation.station.id),
         "index.html",
     )
+    fingerprint = Fingerprint(filename, _get_station_page_fingerprint(synstation))
+    if fingerprint.is_unchanged():
+        return
+    output = render_to_string(
+        "enhydris/synoptic/groupstation.html",
+        context={"object": synstation, "chart_format": get_chart_format()},
+    )
     File(filename).write(output)
+    fingerprint.save()
+
+
+def _get_station_page_fingerprint(synstation):
+    result = [
+        RENDERING_VERSION,
+        _get_templates_version(STATION_PAGE_TEMPLATES),
+        get_language(),
+        get_chart_format(),
+        synstation.synoptic_group.name,
+        synstation.station.name,
+        getattr(synstation, "error", False),
+        synstation.last_common_date_pretty,
+    ]
+    for syntsg in synstation.synoptic_timeseries_groups:
+        result.extend(
+            [
+                syntsg.id,
+                syntsg.group_with_id,
+                syntsg.get_title(),
+                syntsg.subtitle,
+                syntsg.low_limit,
+                syntsg.high_limit,
+                syntsg.timeseries_group.precision,
+                syntsg.timeseries_group.unit_of_measurement.symbol,
+                getattr(syntsg, "value", None),
+                syntsg.value_is_null,
+            ]
+        )
+    return result
+
+
+def _get_templates_version(template_names):
+    """Return the modification times of the files of the specified templates."""
+    return [os.path.getmtime(get_template(name).origin.name) for name in template_names]
 
 
 def _render_station_charts(synstation):
@@ -99,8 +200,20 @@ def _render_station_charts(synstation):
 
 
 def render_synoptic_group(synoptic_group):
-    _render_only_group(synoptic_group)
+    synoptic_group.load_data()
     _render_group_stations(synoptic_group)
+    render_synoptic_group_index(synoptic_group)
+
+
+def render_synoptic_group_index(synoptic_group):
+    """Render the group page and snapshot and send the early warnings of the group.
+
+    This is the last step of rendering a group; when the stations are rendered by
+    separate tasks (see tasks.py), it is executed after all of them have finished.
+    """
+    _render_only_group(synoptic_group)
+    _queue_early_warnings(synoptic_group)
+    _render_group_snapshot(synoptic_group)
     synoptic_group.send_early_warning_emails()
 
 
@@ -111,6 +224,67 @@ def _render_only_group(synoptic_group):
     File(filename).write(output)
 
 
+def _queue_early_warnings(synoptic_group):
+    # Early warnings are queued as a side effect of calculating the values of the
+    # stations; the group page usually does that, but a custom template might not.
+    for synstation in synoptic_group.synopticgroupstation_set.all():
+        synstation.synoptic_timeseries_groups
+
+
+def _render_group_snapshot(synoptic_group):
+    snapshot = {
+        "name": synoptic_group.name,
+        "timezone": synoptic_group.timezone,
+        "fresh_time_limit": synoptic_group.fresh_time_limit.total_seconds(),
+        "stations": [
+            _get_station_snapshot(synstation)
+            for synstation in synoptic_group.synopticgroupstation_set.all()
+        ],
+    }
+    filename = os.path.join(synoptic_group.slug, "index.json")
+    File(filename).write(json.dumps(snapshot))
+
+
+def _get_station_snapshot(synstation):
+    last_common_date = synstation.last_common_date
+    return {
+        "id": synstation.station.id,
+        "name": synstation.station.name,
+        "latitude": synstation.station.geom.y,
+        "longitude": synstation.station.geom.x,
+        "last_common_date": last_common_date and last_common_date.isoformat(),
+        "freshness": synstation.freshness,
+        "error": getattr(synstation, "error", False),
+        "timeseries_groups": [
+            _get_synoptic_timeseries_group_snapshot(syntsg)
+            for syntsg in synstation.synoptic_timeseries_groups
+        ],
+    }
+
+
+def _get_synoptic_timeseries_group_snapshot(syntsg):
+    return {
+        "id": syntsg.id,
+        "name": syntsg.full_name,
+        "unit": syntsg.timeseries_group.unit_of_measurement.symbol,
+        "precision": syntsg.timeseries_group.precision,
+        "value": _get_json_value(getattr(syntsg, "value", None)),
+        "status": syntsg.value_status,
+        "low_limit": syntsg.low_limit,
+        "high_limit": syntsg.high_limit,
+        "data": [
+            [timestamp.isoformat(), _get_json_value(value)]
+            for timestamp, value in syntsg.data["value"].items()
+        ],
+    }
+
+
+def _get_json_value(value):
+    if value is None or math.isnan(value):
+        return None
+    return float(value)
+
+
 def _get_map_context(sgroup):
     dummy_request = HttpRequest()
     dummy_request.map_viewport = _get_bounding_box(sgroup)
@@ -131,23 +305,81 @@ def _render_group_stations(synoptic_group):
         render_synoptic_station(synstation)
 
 
+class ChartTemplate:
+    """A figure and axes that are reused for all charts drawn by a thread.
+
+    Creating a matplotlib figure and axes takes much longer than drawing a few lines
+    on them, so each thread creates them once (see get()); before each chart is
+    drawn, reset() removes the lines, filling and legend of the previous one. The
+    figure is not created with pyplot, so it's not registered in pyplot's global
+    state and it doesn't need to be closed, and the font size is specified on the
+    artists rather than in matplotlib.rcParams.
+    """
+
+    FONT_SIZE = 7
+    _local = threading.local()
+
+    def __init__(self):
+        self.fig = Figure(figsize=(3.2, 2), dpi=100)
+        FigureCanvasAgg(self.fig)
+        self.fig.subplots_adjust(left=0.10, right=0.99, bottom=0.15, top=0.97)
+        self.ax = self.fig.add_subplot(1, 1, 1)
+        self.ax.tick_params(which="both", labelsize=self.FONT_SIZE)
+
+    @classmethod
+    def get(cls):
+        if not hasattr(cls._local, "chart_template"):
+            cls._local.chart_template = cls()
+        return cls._local.chart_template
+
+    def reset(self):
+        for artist in [*self.ax.lines, *self.ax.collections]:
+            artist.remove()
+        legend = self.ax.get_legend()
+        if legend:
+            legend.remove()
+        self.ax.grid(visible=False, which="both")
+        self.ax.set_autoscale_on(True)
+        self.ax.xaxis.set_major_locator(AutoLocator())
+        self.ax.xaxis.set_minor_locator(NullLocator())
+        self.ax.xaxis.set_major_formatter(ScalarFormatter())
+        self.ax.xaxis.set_minor_formatter(NullFormatter())
+
+
 class Chart:
+    """Render the chart of a synoptic time series group.
+
+    The chart format is specified by ENHYDRIS_SYNOPTIC_CHART_FORMAT. "png" and "svg"
+    are drawn with matplotlib on the ChartTemplate of the thread. "json" is not
+    drawn at all; the data and settings of the chart are written to a file, and the
+    station page draws the chart in the browser.
+    """
+
     def __init__(self, current_syn_timeseries_group, all_synoptic_timeseries_groups):
         self.current_synoptic_timeseries_group = current_syn_timeseries_group
         self.all_synoptic_timeseries_groups = all_synoptic_timeseries_groups
+        self.format = get_chart_format()
 
     def render(self):
         self._get_all_groupped_timeseries_groups()
         self._reorder_groupped_timeseries_groups()
-        self._setup_plot()
-        self._draw_lines()
-        if len(self.xdata):
-            self._change_plot_limits()
-            self._fill()
-            self._set_x_ticks_and_labels()
-            self._set_gridlines_and_legend()
-        self._create_and_save_plot()
-        self._write_data_to_file_for_unit_testing()
+        fingerprint = Fingerprint(
+            self._get_filename(self.format), self._get_fingerprint()
+        )
+        if fingerprint.is_unchanged():
+            return
+        if self.format == "json":
+            self._save_json()
+        else:
+            self._draw()
+            self._save_plot()
+            self._write_data_to_file_for_unit_testing()
+        fingerprint.save()
+
+    def _get_filename(self, extension):
+        return os.path.join(
+            "chart", f"{self.current_synoptic_timeseries_group.id}.{extension}"
+        )
 
     def _get_all_groupped_timeseries_groups(self):
         self._synoptic_timeseries_groups = [
@@ -165,13 +397,30 @@ class Chart:
             key=lambda x: float(x.data.value.sum()), reverse=True
         )
 
-    def _setup_plot(self):
-        self.fig = plt.figure()
-        self.fig.set_dpi(100)
-        self.fig.set_size_inches(3.2, 2)
-        self.fig.subplots_adjust(left=0.10, right=0.99, bottom=0.15, top=0.97)
-        matplotlib.rcParams.update({"font.size": 7})
-        self.ax = self.fig.add_subplot(1, 1, 1)
+    def _get_fingerprint(self):
+        current = self.current_synoptic_timeseries_group
+        result = [
+            RENDERING_VERSION,
+            getattr(settings, "TEST_MATPLOTLIB", False),
+            current.default_chart_min,
+            current.default_chart_max,
+        ]
+        for s in self._synoptic_timeseries_groups:
+            result.extend([s.id, s.get_subtitle(), s.data])
+        return result
+
+    def _draw(self):
+        self.template = ChartTemplate.get()
+        self.template.reset()
+        self.ax = self.template.ax
+        self._draw_lines()
+        if len(self.xdata):
+            self._change_plot_limits()
+            self._fill()
+            self._set_x_ticks_and_labels()
+            self._set_gridlines_and_legend()
+        else:
+            self._set_empty_plot_limits()
 
     def _draw_lines(self):
         for i, s in enumerate(self._synoptic_timeseries_groups):
@@ -198,17 +447,24 @@ class Chart:
         )
 
     def _change_plot_limits(self):
+        # The data limits may include the lines of the previous chart drawn on the
+        # same axes, so we recalculate them before autoscaling.
+        self.ax.relim()
         self.ax.set_xlim(self.xdata[0], self.xdata[-1])
         self.xmin, self.xmax, self.ymin, self.ymax = self.ax.axis()
+        self.ymin, self.ymax = self._get_y_limits(self.ymin, self.ymax)
+        self.ax.set_ylim([self.ymin, self.ymax])
+
+    def _get_y_limits(self, ymin, ymax):
         if self.current_synoptic_timeseries_group.default_chart_min:
-            self.ymin = min(
-                self.current_synoptic_timeseries_group.default_chart_min, self.ymin
-            )
+            ymin = min(self.current_synoptic_timeseries_group.default_chart_min, ymin)
         if self.current_synoptic_timeseries_group.default_chart_max:
-            self.ymax = max(
-                self.current_synoptic_timeseries_group.default_chart_max, self.ymax
-            )
-        self.ax.set_ylim([self.ymin, self.ymax])
+            ymax = max(self.current_synoptic_timeseries_group.default_chart_max, ymax)
+        return ymin, ymax
+
+    def _set_empty_plot_limits(self):
+        self.ax.set_xlim(0, 1)
+        self.ax.set_ylim(0, 1)
 
     def _fill(self):
         self.ax.fill_between(self.xdata, self.gydata, self.ymin, color="#ffff00")
@@ -222,30 +478,56 @@ class Chart:
         )
 
     def _set_gridlines_and_legend(self):
-        self.ax.grid(b=True, which="both", color="b", linestyle=":")
+        self.ax.grid(visible=True, which="both", color="b", linestyle=":")
         if len(self._synoptic_timeseries_groups) > 1:
-            self.ax.legend()
+            self.ax.legend(fontsize=ChartTemplate.FONT_SIZE)
 
-    def _create_and_save_plot(self):
+    def _save_plot(self):
         f = BytesIO()
-        self.fig.savefig(f)
-        plt.close(self.fig)  # Release some memory
-        filename = os.path.join(
-            "chart", str(self.current_synoptic_timeseries_group.id) + ".png"
-        )
-        File(filename).write(f.getvalue())
+        self.template.fig.savefig(f, format=self.format)
+        File(self._get_filename(self.format)).write(f.getvalue())
         f.close()
 
     def _write_data_to_file_for_unit_testing(self):
         if hasattr(settings, "TEST_MATPLOTLIB") and settings.TEST_MATPLOTLIB:
-            filename = os.path.join(
-                "chart", str(self.current_synoptic_timeseries_group.id) + ".dat"
-            )
+            filename = self._get_filename("dat")
             data = [
                 repr(line.get_xydata()).replace("\n", " ") for line in self.ax.lines
             ]
             File(filename).write("(" + ", ".join(data) + ")")
 
+    def _save_json(self):
+        File(self._get_filename("json")).write(json.dumps(self._get_json_data()))
+
+    def _get_json_data(self):
+        """Return the chart as a dictionary, to be drawn in the browser.
+
+        "series" contains the lines in the order in which they should be drawn, each
+        with its name, color and data points as [timestamp, value] (null for missing
+        values); the timestamp is the local time of the data in milliseconds since
+        the epoch, as if it were UTC. Only the first one is filled. "min" and "max"
+        are the default chart limits; the browser extends them to fit the data.
+        """
+        series = []
+        for i, s in enumerate(self._synoptic_timeseries_groups):
+            if len(s.data) <= 1:
+                series = []
+                break
+            timestamps = s.data.index.tz_localize(None).asi8 // 1000000
+            values = [_get_json_value(v) for v in s.data["value"]]
+            series.append(
+                {
+                    "name": s.get_subtitle(),
+                    "color": self._get_color(i),
+                    "data": [list(x) for x in zip(timestamps.tolist(), values)],
+                }
+            )
+        return {
+            "series": series,
+            "min": self.current_synoptic_timeseries_group.default_chart_min,
+            "max": self.current_synoptic_timeseries_group.default_chart_max,
+        }
+
     def _get_color(self, i):
         """Return the color to be used for line with sequence i.
 
@@ -258,3 +540,7 @@ class Chart:
         """
         colors = ["red", "green", "blue", "magenta"]
         return colors[i % len(colors)]
+
+
+def get_chart_format():
+    return getattr(settings, "ENHYDRIS_SYNOPTIC_CHART_FORMAT", "png")
@@ -0,0 +1,61 @@
+from django.test import SimpleTestCase, override_settings
+
+import numpy as np
+import pandas as pd
+
+from enhydris.flags import add_flag, compact_flags, concat_data, get_text_flags
+
+
+def make_dataframe(flags, start="2020-01-01"):
+    index = pd.date_range(start, periods=len(flags), freq="10min", tz="UTC")
+    return pd.DataFrame(
+        {"value": np.arange(len(flags), dtype=float), "flags": flags}, index=index
+    )
+
+
+class CompactFlagsTestCase(SimpleTestCase):
+    def test_flags_remain_text_by_default(self):
+        data = compact_flags(make_dataframe(["", "RANGE"]))
+        self.assertEqual(data["flags"].dtype, object)
+
+    @override_settings(ENHYDRIS_COMPACT_FLAGS=True)
+    def test_flags_become_categorical(self):
+        data = compact_flags(make_dataframe(["", "RANGE", "FLAG1", "RANGE"]))
+        self.assertEqual(list(data["flags"].cat.codes), [0, 1, 5, 1])
+
+    @override_settings(ENHYDRIS_COMPACT_FLAGS=True)
+    def test_null_flags_become_empty(self):
+        data = compact_flags(make_dataframe([None, "RANGE"]))
+        self.assertEqual(list(get_text_flags(data)), ["", "RANGE"])
+
+
+class AddFlagTestCase(SimpleTestCase):
+    def _add_flag(self, data):
+        add_flag(data, data["value"] > 0, "SUSPECT")
+        return list(data["flags"])
+
+    def test_text_flags(self):
+        data = make_dataframe(["", "", "RANGE"])
+        self.assertEqual(self._add_flag(data), ["", "SUSPECT", "RANGE SUSPECT"])
+
+    @override_settings(ENHYDRIS_COMPACT_FLAGS=True)
+    def test_compact_flags(self):
+        data = compact_flags(make_dataframe(["", "", "FLAG1"]))
+        self.assertEqual(self._add_flag(data), ["", "SUSPECT", "FLAG1 SUSPECT"])
+
+
+@override_settings(ENHYDRIS_COMPACT_FLAGS=True)
+class ConcatDataTestCase(SimpleTestCase):
+    def setUp(self):
+        self.result = concat_data(
+            [
+                compact_flags(make_dataframe(["FLAG1", ""])),
+                compact_flags(make_dataframe(["FLAG2", "RANGE"], start="2021-01-01")),
+            ]
+        )
+
+    def test_flags_remain_categorical(self):
+        self.assertIsInstance(self.result["flags"].dtype, pd.CategoricalDtype)
+
+    def test_flags(self):
+        self.assertEqual(list(self.result["flags"]), ["FLAG1", "", "FLAG2", "RANGE"])
@@ -4,9 +4,9 @@ from unittest import mock
 from zoneinfo import ZoneInfo
 
 from django.core.cache import cache
-from django.db import IntegrityError
+from django.db import IntegrityError, connections, transaction
 from django.db.models.signals import post_save
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 
 import pandas as pd
 import pytz
@@ -207,6 +207,37 @@ class TimeseriesDatesTestCase(ClearCacheMixin, TestCase):
             timeseries.end_date
 
 
+class TimeseriesGetEndDatesTestCase(ClearCacheMixin, TestCase):
+    def setUp(self):
+        self.timeseries = make_timeseries(
+            start_date=dt.datetime(2018, 11, 15, 16, 0, tzinfo=dt.timezone.utc),
+            end_date=dt.datetime(2018, 11, 17, 23, 0, tzinfo=dt.timezone.utc),
+            timeseries_group__gentity__display_timezone="Etc/GMT-2",
+        )
+        self.empty_timeseries = baker.make(models.Timeseries)
+
+    def test_end_dates(self):
+        self.assertEqual(
+            models.Timeseries.get_end_dates([self.timeseries, self.empty_timeseries]),
+            {
+                self.timeseries.id: dt.datetime(
+                    2018, 11, 18, 1, 0, tzinfo=ZoneInfo("Etc/GMT-2")
+                ),
+                self.empty_timeseries.id: None,
+            },
+        )
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            models.Timeseries.get_end_dates([self.timeseries, self.empty_timeseries])
+
+    def test_cache(self):
+        models.Timeseries.get_end_dates([self.timeseries, self.empty_timeseries])
+        with self.assertNumQueries(0):
+            self.timeseries.end_date
+            models.Timeseries.get_end_dates([self.timeseries, self.empty_timeseries])
+
+
 class DataTestCase(TestTimeseriesMixin, TestCase):
     @classmethod
     def setUpClass(cls):
@@ -291,6 +322,41 @@ class TimeseriesGetDataTestCase(DataTestCase):
         pd.testing.assert_frame_equal(self.data.data, self.expected_result)
 
 
+class TimeseriesIterFormattedDataTestCase(DataTestCase):
+    def _get_written_data(self, **kwargs):
+        f = StringIO()
+        self.timeseries.get_data().write(f, **kwargs)
+        return f.getvalue()
+
+    def test_text(self):
+        result = "".join(self.timeseries.iter_formatted_data(chunk_size=1))
+        self.assertEqual(result, self._get_written_data())
+
+    def test_file(self):
+        result = "".join(
+            self.timeseries.iter_formatted_data(
+                format=HTimeseries.FILE, version=5, chunk_size=1
+            )
+        )
+        self.assertEqual(result, self._get_written_data(format=HTimeseries.FILE))
+
+    def test_file_version_2(self):
+        result = "".join(
+            self.timeseries.iter_formatted_data(format=HTimeseries.FILE, version=2)
+        )
+        self.assertEqual(
+            result, self._get_written_data(format=HTimeseries.FILE, version=2)
+        )
+
+    def test_start_date(self):
+        result = "".join(
+            self.timeseries.iter_formatted_data(
+                start_date=dt.datetime(2018, 1, 1, tzinfo=dt.timezone.utc)
+            )
+        )
+        self.assertEqual(result, "2018-11-25 01:00,2.0,\r\n")
+
+
 class TimeseriesGetDataWithCloseTimestampsTestCase(DataTestCase):
     """Test get_data when two timestamps are within the same minute.
 
@@ -362,6 +428,59 @@ class TimeseriesGetDataWithNullTestCase(TestTimeseriesMixin, TestCase):
         pd.testing.assert_frame_equal(self.data.data, self.expected_result)
 
 
+class TimeseriesGetDataWithFlagsTestCase(TestTimeseriesMixin, TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._create_test_timeseries(
+            "2017-11-23 17:23,1,RANGE SUSPECT\n2018-11-25 01:00,,DATEINSERT\n"
+        )
+        tzinfo = get_tzinfo("Etc/GMT-2")
+        cls.expected_result = pd.DataFrame(
+            data={
+                "value": [1.0, float("NaN")],
+                "flags": ["RANGE SUSPECT", "DATEINSERT"],
+            },
+            columns=["value", "flags"],
+            index=[
+                dt.datetime(2017, 11, 23, 17, 23, tzinfo=tzinfo),
+                dt.datetime(2018, 11, 25, 1, 0, tzinfo=tzinfo),
+            ],
+        )
+        cls.expected_result.index.name = "date"
+        cls.data = cls.timeseries.get_data()
+
+    def test_data(self):
+        pd.testing.assert_frame_equal(self.data.data, self.expected_result)
+
+
+@override_settings(ENHYDRIS_COMPACT_FLAGS=True)
+class TimeseriesGetDataWithCompactFlagsTestCase(TestTimeseriesMixin, TestCase):
+    def setUp(self):
+        self._create_test_timeseries(
+            "2017-11-23 17:23,1,RANGE SUSPECT\n"
+            "2018-11-25 01:00,,DATEINSERT\n"
+            "2018-11-25 01:10,2,\n"
+        )
+        self.data = self.timeseries.get_data().data
+
+    def test_flags_are_categorical(self):
+        self.assertIsInstance(self.data["flags"].dtype, pd.CategoricalDtype)
+
+    def test_flags(self):
+        self.assertEqual(list(self.data["flags"]), ["RANGE SUSPECT", "DATEINSERT", ""])
+
+    def test_known_flags_come_first(self):
+        self.assertEqual(
+            list(self.data["flags"].cat.categories),
+            ["", "RANGE", "SUSPECT", "TEMPORAL", "DATEINSERT", "RANGE SUSPECT"],
+        )
+
+    def test_flags_are_categorical_when_read_from_the_cache(self):
+        data = self.timeseries.get_data().data
+        self.assertIsInstance(data["flags"].dtype, pd.CategoricalDtype)
+
+
 class TimeseriesGetDataEmptyTestCase(TestTimeseriesMixin, TestCase):
     @classmethod
     def setUpClass(cls):
@@ -422,6 +541,32 @@ class TimeseriesGetDataWithStartAndEndDateTestCase(DataTestCase):
         self._check(end_index=1)
 
 
+class TimeseriesGetDataOfManyTestCase(DataTestCase):
+    def setUp(self):
+        cache.clear()
+        self.start_date = dt.datetime(2018, 1, 1, tzinfo=dt.timezone.utc)
+        self.windows = [(self.timeseries, self.start_date, None)]
+
+    def test_data(self):
+        result = models.Timeseries.get_data_of_many(self.windows)
+        pd.testing.assert_frame_equal(
+            result[self.timeseries.id], self.expected_result.iloc[1:]
+        )
+
+    def test_rejects_time_series_in_many_windows(self):
+        windows = self.windows + [(self.timeseries, None, self.start_date)]
+        with self.assertRaises(ValueError):
+            models.Timeseries.get_data_of_many(windows)
+
+    def test_data_from_cache(self):
+        self.timeseries.get_data()
+        with self.assertNumQueries(0):
+            result = models.Timeseries.get_data_of_many(self.windows)
+        pd.testing.assert_frame_equal(
+            result[self.timeseries.id], self.expected_result.iloc[1:]
+        )
+
+
 class TimeseriesGetDataCacheTestCase(DataTestCase):
     @classmethod
     def setUpClass(cls):
@@ -450,7 +595,7 @@ class TimeseriesGetDataCacheTestCase(DataTestCase):
         self._get_data_and_check_num_queries(1, start_date=None, end_date=None)
 
     def test_refetches_if_does_not_include_everything_from_start_date(self):
-        start_date_1 = dt.datetime(2017, 12, 1, 1, 0, 0, tzinfo=dt.timezone.utc)
+        start_date_1 = dt.datetime(2018, 1, 1, 1, 0, 0, tzinfo=dt.timezone.utc)
         self.expected_result = self.original_expected_result.iloc[1:]
         self._get_data_and_check_num_queries(1, start_date=start_date_1, end_date=None)
 
@@ -463,7 +608,7 @@ class TimeseriesGetDataCacheTestCase(DataTestCase):
         self._get_data_and_check_num_queries(0, start_date=start_date_1, end_date=None)
 
     def test_refetches_if_does_not_include_everything_to_end_date(self):
-        end_date_1 = dt.datetime(2018, 10, 1, 1, 0, 0, tzinfo=dt.timezone.utc)
+        end_date_1 = dt.datetime(2017, 12, 1, 1, 0, 0, tzinfo=dt.timezone.utc)
         self.expected_result = self.original_expected_result.iloc[:-1]
         self._get_data_and_check_num_queries(1, start_date=None, end_date=end_date_1)
 
@@ -475,6 +620,15 @@ class TimeseriesGetDataCacheTestCase(DataTestCase):
         self.expected_result = self.original_expected_result.iloc[:-1]
         self._get_data_and_check_num_queries(0, start_date=None, end_date=end_date_1)
 
+    def test_uses_cached_year_for_range_within_it(self):
+        start_date = dt.datetime(2017, 11, 1, 1, 0, 0, tzinfo=dt.timezone.utc)
+        end_date = dt.datetime(2017, 12, 1, 1, 0, 0, tzinfo=dt.timezone.utc)
+        self.expected_result = self.original_expected_result.iloc[:-1]
+        self._get_data_and_check_num_queries(1, start_date=None, end_date=end_date)
+        self._get_data_and_check_num_queries(
+            0, start_date=start_date, end_date=end_date
+        )
+
     def test_with_empty_data(self):
         empty = HTimeseries().data
         self.timeseries.set_data(empty)
@@ -509,22 +663,27 @@ class TimeseriesGetDataCacheTestCase(DataTestCase):
         data = self.timeseries.get_data(start_date=self.timeseries.end_date)
         self.assertEqual(len(data.data), 1)
 
-    @mock.patch("enhydris.models.timeseries.Timeseries._invalidate_cached_data")
-    def test_race_condition(self, m):
+    def test_refetches_evicted_block(self):
+        self.expected_result = self.original_expected_result
+        self._get_data_and_check_num_queries(1, start_date=None, end_date=None)
+        cache.delete(f"timeseries_data_{self.timeseries.id}_2018")
+        self._get_data_and_check_num_queries(1, start_date=None, end_date=None)
+        self._get_data_and_check_num_queries(0, start_date=None, end_date=None)
+
+    def test_ignores_blocks_not_in_index(self):
         # Populate cache
+        self.expected_result = self.original_expected_result
         self._get_data_and_check_num_queries(1, start_date=None, end_date=None)
 
-        # Pretend there's a race condition. We delete the time series data, but
-        # because we've mocked _invalidate_cached_data, the cache will not be deleted.
-        # However, we manually delete the cached end date. This simulates the case
-        # where another thread or process deletes the data (and invalidates the
-        # cache) between examining the start date and end date.
-        self.timeseries.set_data(HTimeseries())
-        cache.delete(f"timeseries_end_date_{self.timeseries.id}")
+        # Delete the index but leave the blocks in the cache, like when another
+        # process invalidates the cache. The blocks are stale and must not be used.
+        with mock.patch(
+            "enhydris.models.timeseries.Timeseries._invalidate_cached_data"
+        ):
+            self.timeseries.set_data(HTimeseries())
+        cache.delete(f"timeseries_data_{self.timeseries.id}")
 
-        # Try getting the data again and see that it works. There are two queries now;
-        # one is for the end date.
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             data = self.timeseries.get_data(start_date=None, end_date=None)
         self.assertEqual(len(data.data), 0)
 
@@ -611,6 +770,16 @@ class TimeseriesAppendDataTestCase(TestTimeseriesMixin, TestCase):
         self.assertEqual(returned_length, 2)
         self._assert_wrote_data()
 
+    def test_updates_last_modified(self):
+        old_date = dt.datetime(2000, 1, 1, tzinfo=dt.timezone.utc)
+        models.Timeseries.objects.filter(id=self.timeseries.id).update(
+            last_modified=old_date
+        )
+        self.timeseries.refresh_from_db()
+        self.timeseries.append_data(self._get_dataframe(), default_timezone="UTC")
+        self.timeseries.refresh_from_db()
+        self.assertGreater(self.timeseries.last_modified, old_date)
+
     def _get_dataframe(self):
         tzinfo = ZoneInfo("Etc/GMT-2")
         result = pd.DataFrame(
@@ -679,6 +848,88 @@ class TimeseriesAppendErrorTestCase(TestTimeseriesMixin, TestCase):
             )
 
 
+class TimeseriesAppendDataCacheTestCase(TestTimeseriesMixin, TransactionTestCase):
+    # Appending within a transaction invalidates the cache instead of updating it, so
+    # we need TransactionTestCase. Setting available_apps activates TRUNCATE ...
+    # CASCADE (see enhydris.autoprocess.tests.test_apps for why this is needed).
+    available_apps = ["django.contrib.sites", "enhydris"]
+
+    def setUp(self):
+        self._create_test_timeseries("2017-11-23 17:23,1,\n2018-11-25 01:00,2,\n")
+        self.timeseries.timeseries_group.gentity.gpoint.altitude
+        self.timeseries.get_data()
+
+    def test_updates_cached_data(self):
+        self._append()
+        with self.assertNumQueries(0):
+            data = self.timeseries.get_data().data
+        self.assertEqual(len(data), 3)
+        self.assertEqual(
+            data.index[-1], dt.datetime(2019, 1, 1, 1, 0, tzinfo=dt.timezone.utc)
+        )
+        self.assertEqual(data["value"].iloc[-1], 3)
+
+    def test_updates_cached_end_date(self):
+        self._append()
+        with self.assertNumQueries(0):
+            end_date = self.timeseries.end_date
+        self.assertEqual(
+            end_date, dt.datetime(2019, 1, 1, 1, 0, tzinfo=dt.timezone.utc)
+        )
+
+    def test_does_not_duplicate_records_cached_after_commit(self):
+        # Simulate another process that caches the data after the records have been
+        # committed and before the cache is updated.
+        with mock.patch("enhydris.models.timeseries.TimeseriesDataCache.append"):
+            self._append()
+        cache.clear()
+        appended_data = self.timeseries.get_data().data.iloc[-1:]
+        models.timeseries.TimeseriesDataCache(self.timeseries).append(appended_data)
+        with self.assertNumQueries(0):
+            data = self.timeseries.get_data().data
+        self.assertEqual(len(data), 3)
+
+    def test_does_not_undo_concurrent_invalidation(self):
+        # Simulate another process that invalidates the cache after the index has been
+        # read and before it is written back.
+        original_get_many = cache.get_many
+
+        def get_many(keys):
+            self.timeseries._invalidate_cached_data()
+            return original_get_many(keys)
+
+        data_cache = models.timeseries.TimeseriesDataCache(self.timeseries)
+        with mock.patch("enhydris.models.timeseries.cache.get_many", new=get_many):
+            data_cache.append(self._get_appended_data(["2018-12-01 01:00"], [3.0]))
+        self.assertIsNone(cache.get(f"timeseries_data_{self.timeseries.id}"))
+
+    def test_appends_unsorted_records(self):
+        data_cache = models.timeseries.TimeseriesDataCache(self.timeseries)
+        data_cache.append(
+            self._get_appended_data(["2018-12-01 02:00", "2018-12-01 01:00"], [4, 3])
+        )
+        block = cache.get(f"timeseries_data_{self.timeseries.id}_2018")
+        self.assertEqual(list(block["value"]), [2, 3, 4])
+
+    def _get_appended_data(self, dates, values):
+        return pd.DataFrame(
+            {"value": values, "flags": [""] * len(values)},
+            index=pd.DatetimeIndex(dates, tz=dt.timezone.utc),
+        )
+
+    def test_invalidates_cache_when_in_transaction(self):
+        with transaction.atomic():
+            self._append()
+        with self.assertNumQueries(1):
+            data = self.timeseries.get_data().data
+        self.assertEqual(len(data), 3)
+
+    def _append(self):
+        self.timeseries.append_data(
+            StringIO("2019-01-01 03:00,3,\n"), default_timezone="Etc/GMT-2"
+        )
+
+
 class TimeseriesGetLastRecordAsStringTestCase(TestTimeseriesMixin, TestCase):
     def test_when_record_exists(self):
         self._create_test_timeseries("2017-11-23 17:23,1,\n2018-11-25 01:00,2,\n")
@@ -744,18 +995,154 @@ class TimeseriesRecordBulkInsertTestCase(TestTimeseriesMixin, TestCase):
     def setUpTestData(cls):
         cls._create_test_timeseries()
         ahtimeseries = HTimeseries(
-            StringIO("2020-09-08 20:00,15.7,,\n2020-09-08 21:00,,\n"),
+            StringIO(
+                "2020-09-08 20:00,15.7,,\n"
+                "2020-09-08 21:00,,\n"
+                "2020-09-08 22:00,0.1,A B\n"
+            ),
             default_tzinfo=ZoneInfo("Etc/GMT-2"),
         )
-        models.TimeseriesRecord.bulk_insert(cls.timeseries, ahtimeseries)
+        cls.returned_length = cls._bulk_insert(ahtimeseries)
         cls.timeseries_records = models.TimeseriesRecord.objects.all()
 
+    @classmethod
+    def _bulk_insert(cls, ahtimeseries):
+        return models.TimeseriesRecord.bulk_insert(cls.timeseries, ahtimeseries)
+
+    def test_returned_length(self):
+        self.assertEqual(self.returned_length, 3)
+
     def test_first_value(self):
         self.assertAlmostEqual(self.timeseries_records[0].value, 15.7)
 
     def test_empty_value(self):
         self.assertIsNone(self.timeseries_records[1].value)
 
+    def test_timestamp(self):
+        self.assertEqual(
+            self.timeseries_records[0].timestamp,
+            dt.datetime(2020, 9, 8, 18, 0, tzinfo=dt.timezone.utc),
+        )
+
+    def test_empty_flags(self):
+        self.assertEqual(self.timeseries_records[0].flags, "")
+
+    def test_flags(self):
+        self.assertEqual(self.timeseries_records[2].flags, "A B")
+
+
+class TimeseriesRecordBulkInsertWithoutCopyTestCase(TimeseriesRecordBulkInsertTestCase):
+    @classmethod
+    def _bulk_insert(cls, ahtimeseries):
+        with mock.patch.object(connections["default"], "vendor", "sqlite"):
+            return super()._bulk_insert(ahtimeseries)
+
+
+class TimeseriesRollupTestCase(TestTimeseriesMixin, TestCase):
+    def setUp(self):
+        self._create_test_timeseries(
+            "2017-11-23 17:23,1,\n"
+            "2017-11-23 17:50,3,\n"
+            "2017-11-24 01:00,,\n"
+            "2017-12-01 00:00,5,\n"
+        )
+
+    def _get_rollups(self, level):
+        return [
+            (r.timestamp, r.count, r.min, r.max, r.sum)
+            for r in self.timeseries.timeseriesrollup_set.filter(level=level).order_by(
+                "timestamp"
+            )
+        ]
+
+    def _utc(self, *args):
+        return dt.datetime(*args, tzinfo=dt.timezone.utc)
+
+    def test_hourly(self):
+        self.assertEqual(
+            self._get_rollups("hour"),
+            [
+                (self._utc(2017, 11, 23, 15, 0), 2, 1, 3, 4),
+                (self._utc(2017, 11, 30, 22, 0), 1, 5, 5, 5),
+            ],
+        )
+
+    def test_daily(self):
+        self.assertEqual(
+            self._get_rollups("day"),
+            [
+                (self._utc(2017, 11, 23), 2, 1, 3, 4),
+                (self._utc(2017, 11, 30), 1, 5, 5, 5),
+            ],
+        )
+
+    def test_monthly(self):
+        self.assertEqual(
+            self._get_rollups("month"), [(self._utc(2017, 11, 1), 3, 1, 5, 9)]
+        )
+
+    def test_append_to_existing_rollup(self):
+        self.timeseries.append_data(
+            StringIO("2017-12-01 00:30,7,\n"), default_timezone="Etc/GMT-2"
+        )
+        self.assertEqual(
+            self._get_rollups("hour")[-1], (self._utc(2017, 11, 30, 22, 0), 2, 5, 7, 12)
+        )
+        self.assertEqual(
+            self._get_rollups("month"), [(self._utc(2017, 11, 1), 4, 1, 7, 16)]
+        )
+
+    def test_append_new_rollup(self):
+        self.timeseries.append_data(
+            StringIO("2017-12-01 03:00,7,\n"), default_timezone="Etc/GMT-2"
+        )
+        self.assertEqual(
+            self._get_rollups("month"),
+            [
+                (self._utc(2017, 11, 1), 3, 1, 5, 9),
+                (self._utc(2017, 12, 1), 1, 7, 7, 7),
+            ],
+        )
+
+    def test_set_data_replaces_rollups(self):
+        self.timeseries.set_data(
+            StringIO("2018-01-01 02:00,7,\n"), default_timezone="Etc/GMT-2"
+        )
+        self.assertEqual(
+            self._get_rollups("month"), [(self._utc(2018, 1, 1), 1, 7, 7, 7)]
+        )
+
+    def test_delete_data_updates_rollups(self):
+        self.timeseries.delete_data(self._utc(2017, 11, 30, 22, 0))
+        self.assertEqual(
+            self._get_rollups("month"), [(self._utc(2017, 11, 1), 2, 1, 3, 4)]
+        )
+
+    def test_chart_stats_after_deleting_latest_record(self):
+        self.timeseries.delete_data(self._utc(2017, 11, 30, 22, 0))
+        # The stale daily rollups would have been used, giving a second interval
+        # with the deleted value 5.
+        stats = self.timeseries.get_chart_stats(max_intervals=2)
+        self.assertEqual([s["max"] for s in stats], [1, 3])
+
+    def test_get_level(self):
+        start_date = self._utc(2017, 11, 1)
+        end_date = self._utc(2017, 12, 31)
+        get_level = models.TimeseriesRollup.get_level
+        self.assertEqual(get_level(self.timeseries, start_date, end_date, 1), "month")
+        self.assertEqual(get_level(self.timeseries, start_date, end_date, 2), "day")
+        self.assertIsNone(get_level(self.timeseries, start_date, end_date, 3))
+
+    def test_chart_stats_from_rollups(self):
+        stats = self.timeseries.get_chart_stats(max_intervals=2)
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(
+            (stats[0]["min"], stats[0]["max"], stats[0]["mean"]), (1, 3, 2)
+        )
+        self.assertEqual(
+            (stats[1]["min"], stats[1]["max"], stats[1]["mean"]), (5, 5, 5)
+        )
+
 
 class TimeseriesDatesCacheInvalidationTestCase(TestCase):
     def setUp(self):
@@ -1,6 +1,8 @@
 from django.contrib.auth.models import AnonymousUser, Permission, User
 from django.test import TestCase, override_settings
 
+from enhydris import models
+from enhydris.rules import filter_timeseries_with_viewable_data
 from enhydris.tests import TestTimeseriesMixin
 
 
@@ -300,3 +302,68 @@ class ContentRulesTestCase(TestCase, TestTimeseriesMixin):
         self.assertTrue(
             self.david.has_perm("enhydris.view_timeseries_data", self.timeseries)
         )
+
+
+class FilterTimeseriesWithViewableDataTestCase(TestCase, TestTimeseriesMixin):
+    """Test that filter_timeseries_with_viewable_data() agrees with has_perm()."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.alice = User.objects.create_user(username="alice")
+        cls.david = User.objects.create_user(username="david")
+        cls.inactive = User.objects.create_user(username="frank", is_active=False)
+        cls.superuser = User.objects.create_superuser(username="eve")
+        cls.anonymous = AnonymousUser()
+
+    def _setup_test_stuff(self, publicly_available):
+        self._create_test_timeseries(publicly_available=publicly_available)
+
+    def _assert_agrees_with_has_perm(self, user):
+        queryset = models.Timeseries.objects.filter(id=self.timeseries.id)
+        filtered = filter_timeseries_with_viewable_data(user, queryset)
+        self.assertEqual(
+            filtered.exists(),
+            user.has_perm("enhydris.view_timeseries_data", self.timeseries),
+        )
+
+    def _assert_agrees_for_all_users(self):
+        for user in (self.anonymous, self.inactive, self.david, self.superuser):
+            with self.subTest(user=user):
+                self._assert_agrees_with_has_perm(user)
+
+    def test_publicly_available(self):
+        self._setup_test_stuff(publicly_available=True)
+        self._assert_agrees_for_all_users()
+
+    @override_settings(ENHYDRIS_ENABLE_TIMESERIES_DATA_VIEWERS=True)
+    def test_not_publicly_available_with_data_viewers(self):
+        self._setup_test_stuff(publicly_available=False)
+        self._assert_agrees_for_all_users()
+
+    @override_settings(ENHYDRIS_ENABLE_TIMESERIES_DATA_VIEWERS=False)
+    def test_not_publicly_available_without_data_viewers(self):
+        self._setup_test_stuff(publicly_available=False)
+        self._assert_agrees_for_all_users()
+
+    @override_settings(ENHYDRIS_ENABLE_TIMESERIES_DATA_VIEWERS=True)
+    def test_creator(self):
+        self._setup_test_stuff(publicly_available=False)
+        self.station.creator = self.david
+        self.station.save()
+        self._assert_agrees_with_has_perm(self.david)
+        self._assert_agrees_with_has_perm(self.alice)
+
+    @override_settings(ENHYDRIS_ENABLE_TIMESERIES_DATA_VIEWERS=True)
+    def test_maintainer(self):
+        self._setup_test_stuff(publicly_available=False)
+        self.station.maintainers.add(self.david)
+        self._assert_agrees_with_has_perm(self.david)
+        self._assert_agrees_with_has_perm(self.alice)
+
+    @override_settings(ENHYDRIS_ENABLE_TIMESERIES_DATA_VIEWERS=True)
+    def test_timeseries_data_viewer(self):
+        self._setup_test_stuff(publicly_available=False)
+        self.station.timeseries_data_viewers.add(self.david)
+        self._assert_agrees_with_has_perm(self.david)
+        self._assert_agrees_with_has_perm(self.alice)